@@ -0,0 +1,257 @@
+"""Type-ahead suggestions for the search box: composers, titles and genres.
+
+Backed by an in-memory sorted array of keys searched with bisect, so a lookup
+is a binary search plus a short scan - no database, no CPDL. Every word of a
+name starts a key, so "monte" finds "Claudio Monteverdi". Suggestions are
+ranked by how many pieces they cover.
+
+The array is built on first use, picks up other workers' new pieces every
+AUTOCOMPLETE_TTL seconds (by id, so it's incremental - re-checking the last
+REFRESH_WINDOW ids, which can commit out of order), is rebuilt every
+AUTOCOMPLETE_RELOAD seconds, and ingestion adds to it directly (add_pages).
+It holds at most AUTOCOMPLETE_MAX_KEYS keys; past that, the least used
+suggestions are left out."""
+
+import bisect
+import os
+import threading
+import time
+
+from sqlalchemy import func
+
+from local_search import REFRESH_WINDOW, WORD_RE, fold
+from model import Genre, Piece, PieceGenre, db
+
+# Suggestions returned per lookup, by default and at most.
+SUGGESTIONS = 10
+MAX_SUGGESTIONS = 25
+
+# Shortest prefix worth suggesting for.
+MIN_PREFIX = 2
+
+# Matching keys looked at per lookup, before ranking - bounds a lookup's time
+# for very short, common prefixes.
+SCAN_LIMIT = 500
+
+# Most keys held in memory.
+AUTOCOMPLETE_MAX_KEYS = int(os.environ.get("AUTOCOMPLETE_MAX_KEYS", 250000))
+
+# Seconds before checking the db for pieces added by other workers.
+AUTOCOMPLETE_TTL = int(os.environ.get("AUTOCOMPLETE_TTL", 60))
+
+# Seconds before rebuilding it all - catching anything committed further out
+# of order than REFRESH_WINDOW.
+AUTOCOMPLETE_RELOAD = int(os.environ.get("AUTOCOMPLETE_RELOAD", 60 * 60))
+
+# Words of a title that start a key - "Ecco mormorar l'onde" is found by
+# "ecco" and "mormorar", but long titles don't flood the array.
+TITLE_WORD_KEYS = 4
+
+
+def _keys(text, max_words=None):
+    """Returns the keys text is found under: the folded text from the start
+       of each of its words."""
+
+    folded = fold(text).strip()
+    starts = [match.start() for match in WORD_RE.finditer(folded)]
+
+    if max_words:
+        starts = starts[:max_words]
+
+    return set(folded[start:] for start in starts)
+
+
+class PrefixIndex(object):
+    """Sorted array of (key, kind, text) and a weight for each (kind, text)."""
+
+    def __init__(self, ttl=AUTOCOMPLETE_TTL, max_keys=AUTOCOMPLETE_MAX_KEYS,
+                 reload_after=AUTOCOMPLETE_RELOAD):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.reload_after = reload_after
+        self._keys = []                 # sorted (key, kind, text)
+        self._weights = {}              # (kind, text) -> number of pieces
+        self._max_piece_id = 0
+        self._max_genre_id = 0
+        self._seen_pieces = set()       # ids in the window we've already added
+        self._seen_genres = set()
+        self._checked_at = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _insert(self, kind, text, weight=1):
+        """Adds weight to a suggestion, adding its keys if it's new. Caller
+           holds the lock."""
+
+        if not text or not text.strip():
+            return
+
+        text = text.strip()
+
+        if (kind, text) in self._weights:
+            self._weights[(kind, text)] += weight
+            return
+
+        keys = _keys(text, TITLE_WORD_KEYS if kind == 'title' else None)
+
+        if len(self._keys) + len(keys) > self.max_keys:
+            return
+
+        self._weights[(kind, text)] = weight
+
+        for key in keys:
+            bisect.insort(self._keys, (key, kind, text))
+
+    def load(self):
+        """(Re)builds the whole array from the database, most used suggestions
+           first, up to max_keys."""
+
+        max_piece_id = db.session.query(func.max(Piece.piece_id)).scalar() or 0
+        max_genre_id = db.session.query(func.max(Genre.genre_id)).scalar() or 0
+
+        # The ids in the refresh window, read before the counts: anything
+        # committed after this is picked up by the next refresh. (Something
+        # committed in between is counted twice - a weight off by one.)
+        seen_pieces = set(row[0] for row in
+                          db.session.query(Piece.piece_id)
+                                    .filter(Piece.piece_id > max_piece_id - REFRESH_WINDOW))
+        seen_genres = set(row[0] for row in
+                          db.session.query(Genre.genre_id)
+                                    .filter(Genre.genre_id > max_genre_id - REFRESH_WINDOW))
+
+        composers = (db.session.query(Piece.composer, func.count(Piece.piece_id))
+                               .group_by(Piece.composer))
+        titles = (db.session.query(Piece.title, func.count(Piece.piece_id))
+                            .group_by(Piece.title))
+        genres = (db.session.query(Genre.name, func.count(PieceGenre.pg_id))
+                            .outerjoin(PieceGenre, PieceGenre.genre_id == Genre.genre_id)
+                            .group_by(Genre.name))
+
+        suggestions = ([('composer', text, count) for text, count in composers] +
+                       [('title', text, count) for text, count in titles] +
+                       [('genre', text, count) for text, count in genres])
+
+        # Built aside, then swapped in - lookups carry on meanwhile.
+        entries = []
+        weights = {}
+
+        for kind, text, count in sorted(suggestions, key=lambda s: -s[2]):
+            text = (text or '').strip()
+
+            if not text or (kind, text) in weights:
+                continue
+
+            keys = _keys(text, TITLE_WORD_KEYS if kind == 'title' else None)
+
+            if len(entries) + len(keys) > self.max_keys:
+                continue
+
+            weights[(kind, text)] = count
+            entries.extend((key, kind, text) for key in keys)
+
+        entries.sort()
+
+        with self._lock:
+            self._keys = entries
+            self._weights = weights
+            self._seen_pieces = seen_pieces
+            self._seen_genres = seen_genres
+            self._max_piece_id = max_piece_id
+            self._max_genre_id = max_genre_id
+            self._checked_at = self._loaded_at = time.time()
+
+    def refresh(self):
+        """Adds the pieces and genres other workers have added since we last
+           looked - including lower ids that committed late."""
+
+        pieces = (db.session.query(Piece.piece_id, Piece.composer, Piece.title)
+                            .filter(Piece.piece_id > self._max_piece_id - REFRESH_WINDOW)
+                            .all())
+        genres = (db.session.query(Genre.genre_id, Genre.name)
+                            .filter(Genre.genre_id > self._max_genre_id - REFRESH_WINDOW)
+                            .all())
+
+        with self._lock:
+            for piece_id, composer, title in pieces:
+                if piece_id not in self._seen_pieces:
+                    self._insert('composer', composer)
+                    self._insert('title', title)
+                    self._seen_pieces.add(piece_id)
+                self._max_piece_id = max(self._max_piece_id, piece_id)
+
+            for genre_id, name in genres:
+                if genre_id not in self._seen_genres:
+                    self._insert('genre', name, 0)
+                    self._seen_genres.add(genre_id)
+                self._max_genre_id = max(self._max_genre_id, genre_id)
+
+            # Ids below the window aren't looked at again.
+            self._seen_pieces = set(piece_id for piece_id in self._seen_pieces
+                                    if piece_id > self._max_piece_id - REFRESH_WINDOW)
+            self._seen_genres = set(genre_id for genre_id in self._seen_genres
+                                    if genre_id > self._max_genre_id - REFRESH_WINDOW)
+
+            self._checked_at = time.time()
+
+    def add_pages(self, pages):
+        """Adds newly committed pieces - (piece_id, ParsedPage) pairs - and
+           their genres."""
+
+        # Not built yet - the first lookup loads everything anyway.
+        if self._checked_at is None:
+            return
+
+        with self._lock:
+            for piece_id, page in pages:
+                if piece_id in self._seen_pieces:
+                    continue
+
+                self._insert('composer', page.composer)
+                self._insert('title', page.title)
+
+                for name in page.genres:
+                    self._insert('genre', name)
+
+                # Remembered, so the next refresh doesn't count it twice.
+                self._seen_pieces.add(piece_id)
+
+    def suggest(self, prefix, k=SUGGESTIONS):
+        """Returns up to k suggestions - dicts of text and kind ('composer',
+           'title' or 'genre') - for prefix, most used first."""
+
+        if self._checked_at is None or time.time() - self._loaded_at > self.reload_after:
+            self.load()
+        elif time.time() - self._checked_at > self.ttl:
+            self.refresh()
+
+        prefix = fold(prefix or u'').strip()
+
+        if len(prefix) < MIN_PREFIX:
+            return []
+
+        found = set()
+
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+
+            for key, kind, text in self._keys[i:i + SCAN_LIMIT]:
+                if not key.startswith(prefix):
+                    break
+                found.add((kind, text))
+
+            ranked = sorted(found, key=lambda s: (-self._weights[s], s[1]))
+
+        # Titles & names that only differ by case or accents are suggested once.
+        suggestions = []
+        seen = set()
+
+        for kind, text in ranked:
+            if (kind, fold(text)) not in seen:
+                seen.add((kind, fold(text)))
+                suggestions.append({'text': text, 'kind': kind})
+
+        return suggestions[:k]
+
+
+# This process's suggestions.
+autocomplete_index = PrefixIndex()
@@ -0,0 +1,422 @@
+"""Benchmarks the app's routes against generated data and a stub CPDL.
+
+Seeds a database with generate_data.py's data (if it's empty), starts
+cpdl_stub.py, and requests each route many times through the Flask test
+client - the route itself, with no network or web server in the way - as
+users picked at random. For each route it records latency (p50, p95, p99,
+max), throughput (requests per second, one request at a time) and SQL
+queries per request, and saves them as json:
+
+    python benchmark.py --scale 5 --out before.json
+    ... change something ...
+    python benchmark.py --scale 5 --out after.json --compare before.json
+
+--compare prints each route's change from the earlier run, and exits 1 if
+a route's p95 got slower by more than --tolerance (and a few ms), or it runs
+more queries.
+Compare runs of the same --scale, --seed and --db: the same options give the
+same data and the same requests, so only the code differs.
+
+The database defaults to a new SQLite file. Give --db to use Postgres, as in
+production - an empty database (it's seeded) or one a previous run seeded
+(it's reused as it is; --scale is then ignored).
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from timeit import default_timer
+
+# Default options.
+SCALE = 1
+SEED = 1
+REQUESTS = 200              # timed requests per route
+WARMUP = 10                 # untimed requests per route first
+STUB_DELAY = 0.05           # seconds the stub CPDL takes to answer
+TOLERANCE = 0.25            # p95 slowdown --compare lets through...
+MIN_SLOWDOWN_MS = 5.0       # ...and any under this (fast routes are noisy)
+
+PERCENTILES = (50, 95, 99)
+
+# Pages past any generated page_id - new to us, so /page_search queues them.
+NEW_PAGE_IDS = 900000
+
+
+def percentile(ordered, p):
+    """The p-th percentile (nearest rank) of an already sorted list."""
+
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(latencies, queries, statuses):
+    """Sums up one route's timings (seconds), query counts and response
+       statuses."""
+
+    ordered = sorted(latencies)
+    summary = {"requests": len(latencies),
+               "throughput": len(latencies) / sum(latencies),
+               "mean_ms": 1000 * sum(latencies) / len(latencies),
+               "max_ms": 1000 * ordered[-1],
+               "queries_mean": float(sum(queries)) / len(queries),
+               "queries_max": max(queries),
+               "errors": sum(1 for status in statuses if status >= 400)}
+
+    for p in PERCENTILES:
+        summary["p{}_ms".format(p)] = 1000 * percentile(ordered, p)
+
+    return summary
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_stub(port, delay):
+    """Starts cpdl_stub.py on port, and waits for it to listen."""
+
+    stub = subprocess.Popen([sys.executable,
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                          "cpdl_stub.py"),
+                             "--port", str(port), "--delay", str(delay)],
+                            stdout=open(os.devnull, "w"))
+
+    for attempt in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return stub
+        except socket.error:
+            time.sleep(0.05)
+
+    stub.kill()
+    raise RuntimeError("The stub CPDL didn't start on port {}".format(port))
+
+
+############ THE ROUTES ######################################################
+
+def scenarios(ids):
+    """Returns [(name, make)]: for each route, a function taking a Random
+       and returning the requests of one round - a list of (name, method,
+       url, json body or form, user_id). A round is usually one request;
+       library edits are an add and its undo, so the data ends as it began.
+
+       ids holds the ids to pick from, from fixtures()."""
+
+    def pick(rand, name):
+        return rand.choice(ids[name])
+
+    def one(name, url, user=True, method="GET", data=None):
+        def make(rand):
+            return [(name, method, url(rand), data and data(rand),
+                     pick(rand, "users") if user else None)]
+        return name, make
+
+    def undoable(add_name, del_name, add_url, del_url, body):
+        # Adds something not in the user's library, then takes it out again.
+        def make(rand):
+            user_id, item_id = rand.choice(ids["not_in_library"])
+            return [(add_name, "POST", add_url, body("add", item_id), user_id),
+                    (del_name, "POST", del_url, body("del", item_id), user_id)]
+        return add_name + " + " + del_name, make
+
+    def library_changes(op, piece_id):
+        return {"changes": [{"op": op, "kind": "piece", "id": piece_id}]}
+
+    search_words = ids["words"]
+
+    return [
+        one("/pieces/<id>", lambda r: "/pieces/{}".format(pick(r, "pieces"))),
+        one("/sheets/<id>", lambda r: "/sheets/{}".format(pick(r, "sheets"))),
+        one("/concerts/<id>", lambda r: "/concerts/{}".format(pick(r, "concerts"))),
+        one("/groups/<code>", lambda r: "/groups/{}".format(pick(r, "groups"))),
+        one("/performers/<id>",
+            lambda r: "/performers/{}".format(pick(r, "performers"))),
+        one("/users/<id>", lambda r: "/users/{}".format(pick(r, "users"))),
+        one("/library", lambda r: "/library?sort={}".format(
+            r.choice(["title", "composer"]))),
+        one("/library.json", lambda r: "/library.json?kind={}&sort={}".format(
+            r.choice(["pieces", "sheets", "files"]),
+            r.choice(["title", "composer"]))),
+        one("/search (local)", lambda r: "/search?search={}".format(
+            r.choice(search_words))),
+        # New searches go to CPDL; repeated ones come from the search cache.
+        one("/search (CPDL, new terms)",
+            lambda r: "/search?remote=1&search={}+{}".format(
+                r.choice(search_words), r.randint(1, 10 ** 9))),
+        one("/search (CPDL, repeated)",
+            lambda r: "/search?remote=1&search={}".format(
+                r.choice(search_words[:3]))),
+        one("/autocomplete.json", lambda r: "/autocomplete.json?q={}".format(
+            r.choice(search_words)[:3]), user=False),
+        one("/page_search (have it)", lambda r: "/page_search?page_id={}".format(
+            pick(r, "page_ids"))),
+        one("/page_search (new)", lambda r: "/page_search?page_id={}".format(
+            NEW_PAGE_IDS + r.randint(1, 10 ** 6))),
+        undoable("/add_upiece.json", "/del_upiece.json",
+                 "/add_upiece.json", "/del_upiece.json",
+                 lambda op, piece_id: {"piece_id": piece_id}),
+        undoable("/library_changes.json (add)", "/library_changes.json (del)",
+                 "/library_changes.json", "/library_changes.json",
+                 library_changes),
+    ]
+
+
+def fixtures(rand):
+    """The ids the benchmark requests are made of, from the database."""
+
+    from model import (User, Piece, SheetMusic, Concert, Group, Performer,
+                       UserPiece, db)
+    from generate_data import WORDS
+
+    def column(col):
+        return [row[0] for row in db.session.query(col).order_by(col)]
+
+    ids = {"users": column(User.user_id),
+           "pieces": column(Piece.piece_id),
+           "page_ids": column(Piece.page_id),
+           "sheets": column(SheetMusic.sheet_id),
+           "concerts": column(Concert.concert_id),
+           "groups": column(Group.group_code),
+           "performers": column(Performer.performer_id),
+           "words": [word for word in WORDS if len(word) >= 3]}
+
+    for name, values in ids.items():
+        if not values:
+            raise SystemExit("No {} in the database to benchmark with.".format(name))
+
+    # Pieces to add to (and take back out of) libraries.
+    saved = set(db.session.query(UserPiece.user_id, UserPiece.piece_id))
+    pairs = []
+
+    while len(pairs) < 100:
+        pair = (rand.choice(ids["users"]), rand.choice(ids["pieces"]))
+        if pair not in saved:
+            pairs.append(pair)
+
+    ids["not_in_library"] = pairs
+
+    return ids
+
+
+def run(client, rounds, make, rand, record=True):
+    """Runs rounds of a scenario. Returns {name: (latencies, queries,
+       statuses)}."""
+
+    from model import db
+    from query_profiles import count_queries
+
+    results = {}
+
+    for i in xrange(rounds):
+        for name, method, url, data, user_id in make(rand):
+            with client.session_transaction() as sess:
+                sess.clear()
+                if user_id is not None:
+                    sess["user_id"] = user_id
+
+            # Each request gets a fresh session, like a real one.
+            db.session.remove()
+
+            if isinstance(data, dict) and "changes" in data:
+                kwargs = {"data": json.dumps(data),
+                          "content_type": "application/json"}
+            else:
+                kwargs = {"data": data}
+
+            # (Some routes print as they go - not to the report.)
+            stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+
+            try:
+                with count_queries() as queries:
+                    began = default_timer()
+                    response = client.open(url, method=method, **kwargs)
+                    took = default_timer() - began
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+            if record:
+                latencies, counts, statuses = results.setdefault(name, ([], [], []))
+                latencies.append(took)
+                counts.append(queries[0])
+                statuses.append(response.status_code)
+
+    return results
+
+
+############ SEEDING #########################################################
+
+def seed(scale, seed, data_dir):
+    """Generates and bulk loads data, unless the database already has some.
+       Returns whether it seeded."""
+
+    from model import User, db
+    from generate_data import generate
+    from bulk_seed import bulk_load
+
+    db.create_all()
+
+    if db.session.query(User.user_id).first():
+        return False
+
+    generate(data_dir, scale, seed)
+    bulk_load(data_dir)
+    return True
+
+
+############ COMPARING #######################################################
+
+def compare(baseline, current, tolerance=TOLERANCE):
+    """Prints each route's change from the baseline run. Returns the names of
+       the routes that got worse."""
+
+    worse = []
+
+    print
+    print "{:<32} {:>10} {:>10} {:>8} {:>10}".format("vs baseline", "p50", "p95",
+                                                     "p95 x", "queries")
+
+    for name in sorted(current["routes"]):
+        now = current["routes"][name]
+        then = baseline["routes"].get(name)
+
+        if then is None:
+            print "{:<32} (new)".format(name)
+            continue
+
+        ratio = now["p95_ms"] / then["p95_ms"] if then["p95_ms"] else 1.0
+        more_queries = now["queries_max"] - then["queries_max"]
+
+        flag = ""
+        slower = (ratio > 1 + tolerance and
+                  now["p95_ms"] - then["p95_ms"] > MIN_SLOWDOWN_MS)
+
+        if slower or more_queries > 0:
+            worse.append(name)
+            flag = "  <- worse"
+
+        print "{:<32} {:>+9.1f}ms {:>+9.1f}ms {:>7.2f}x {:>+10}{}".format(
+            name, now["p50_ms"] - then["p50_ms"], now["p95_ms"] - then["p95_ms"],
+            ratio, more_queries, flag)
+
+    for name in sorted(set(baseline["routes"]) - set(current["routes"])):
+        print "{:<32} (gone)".format(name)
+
+    return worse
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the app's routes.")
+    parser.add_argument("--db", help="database to use (default: a new SQLite file)")
+    parser.add_argument("--scale", type=int, default=SCALE,
+                        help="generated data size (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=SEED,
+                        help="random seed, for data and requests (default %(default)s)")
+    parser.add_argument("--requests", type=int, default=REQUESTS,
+                        help="timed requests per route (default %(default)s)")
+    parser.add_argument("--warmup", type=int, default=WARMUP,
+                        help="untimed requests per route first (default %(default)s)")
+    parser.add_argument("--stub-delay", type=float, default=STUB_DELAY,
+                        help="stub CPDL answer time in seconds (default %(default)s)")
+    parser.add_argument("--only", action="append",
+                        help="just the routes whose names contain this (repeatable)")
+    parser.add_argument("--out", help="save the results to this json file")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="a previous run's json to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="p95 slowdown allowed by --compare (default %(default)s)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="quirify_bench_")
+    db_uri = args.db or "sqlite:///" + os.path.join(work_dir, "bench.db")
+
+    # CPDL is the stub, and its responses are cached afresh each run - both
+    # have to be set before cpdl is imported.
+    port = free_port()
+    os.environ["CPDL_API"] = "http://127.0.0.1:{}/api.php".format(port)
+    os.environ["CPDL_CACHE_PATH"] = os.path.join(work_dir, "cpdl_cache.sqlite")
+
+    from server import app
+    from model import connect_to_db
+
+    # (Not in testing mode: a route that fails counts as an error, a 500,
+    # rather than stopping the run.)
+    connect_to_db(app, db_uri)
+
+    stub = start_stub(port, args.stub_delay)
+
+    try:
+        with app.app_context():
+            seeded = seed(args.scale, args.seed, os.path.join(work_dir, "data"))
+
+            rand = random.Random(args.seed)
+            client = app.test_client()
+            routes = {}
+
+            for name, make in scenarios(fixtures(rand)):
+                if args.only and not any(part in name for part in args.only):
+                    continue
+
+                run(client, args.warmup, make, rand, record=False)
+
+                for route, measured in run(client, args.requests, make, rand).items():
+                    routes[route] = summarize(*measured)
+    finally:
+        stub.kill()
+
+    print
+    print "{:<32} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7} {:>6}".format(
+        "route", "p50 ms", "p95 ms", "p99 ms", "max ms", "req/s", "queries", "errors")
+
+    for name in sorted(routes):
+        route = routes[name]
+        print "{:<32} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.0f} {:>7.1f} {:>6}".format(
+            name, route["p50_ms"], route["p95_ms"], route["p99_ms"],
+            route["max_ms"], route["throughput"], route["queries_mean"],
+            route["errors"])
+
+    results = {"meta": {"date": datetime.utcnow().isoformat() + "Z",
+                        "commit": git_commit(),
+                        "python": platform.python_version(),
+                        "database": db_uri.split(":")[0],
+                        "seeded": seeded,
+                        "scale": args.scale,
+                        "seed": args.seed,
+                        "requests": args.requests,
+                        "warmup": args.warmup,
+                        "stub_delay": args.stub_delay},
+               "routes": routes}
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            worse = compare(json.load(f), results, args.tolerance)
+
+        if worse:
+            print
+            print "Worse than the baseline: {}".format(", ".join(worse))
+            sys.exit(1)
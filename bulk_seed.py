@@ -0,0 +1,421 @@
+"""Bulk seeding: loads the seed data files straight into their tables.
+
+seed.py's loaders build an ORM object per row, which is fine for the test
+data but takes hours for production-sized fixtures. Here each data file is
+streamed through a typed row parser (TABLES) and written with PostgreSQL's
+COPY FROM STDIN, or Core executemany batches on other databases - no ORM
+objects, one transaction per table. Tables that don't depend on each other
+load at the same time (see load_order.py).
+
+Rows are given ids in file order (the nth line of sheet.txt is sheet n, as
+the data files' foreign keys assume), and the serial sequences are moved past
+them afterwards so the app's own inserts don't collide. Loads into empty
+tables only.
+
+    python seed.py --bulk
+    python seed.py --bulk --data-dir /srv/fixtures --db postgres:///staging --workers 8
+"""
+
+import datetime
+import os
+import threading
+import time
+from collections import namedtuple
+
+from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
+                   PerformerGroup, Piece, SheetMusic, AudioFile, Provider,
+                   GroupSheet, ConcertSheet, PerformerInstrument, Assignment,
+                   EventAssignment, Genre, PieceGenre, SheetMusicProvider,
+                   SheetMusicOwner, UserPiece, UserSheet, UserAudioFile, db)
+
+from load_order import WORKERS, dependencies, levels, run_in_order
+
+# Where the data files are, by default.
+DATA_DIR = "data"
+
+# Rows per executemany batch (databases without COPY).
+BATCH_ROWS = 5000
+
+# Bytes of COPY data built up before handing it to the server.
+COPY_CHUNK = 256 * 1024
+
+
+class SeedDataError(ValueError):
+    """Raised for a data file row that doesn't parse."""
+
+
+########## TYPED FIELD PARSERS #############################################
+
+def text(value):
+    return value.decode('utf-8')
+
+
+def integer(value):
+    return int(value) if value.strip() else None
+
+
+def boolean(value):
+    if value.strip() not in ('True', 'False'):
+        raise ValueError("not True or False: {!r}".format(value))
+    return value.strip() == 'True'
+
+
+def date(value):
+    """mm/dd/yyyy, or None if blank."""
+
+    if not value.strip():
+        return None
+    return datetime.datetime.strptime(value, "%m/%d/%Y").date()
+
+
+def day_time(value):
+    """Mon-dd-yyyy-HH:MM"""
+
+    return datetime.datetime.strptime(value, "%b-%d-%Y-%H:%M")
+
+
+def cents(value):
+    """A dollar amount, stored in cents."""
+
+    return int(round(float(value) * 100)) if value.strip() else None
+
+
+########## THE DATA FILES ##################################################
+
+# A data file: the model it loads, its file name & field separator, and the
+# column & parser for each field (None for fields that aren't stored).
+DataFile = namedtuple('DataFile', ['model', 'filename', 'separator', 'fields'])
+
+TABLES = [
+    DataFile(User, "user.txt", ", ",
+             [('fname', text), ('lname', text), ('email', text),
+              ('password', text), (None, text), ('phone', text)]),
+    DataFile(Group, "group.txt", ", ",
+             [('group_code', text), ('name', text), ('description', text),
+              ('end_date', date), ('start_date', date)]),
+    DataFile(Owner, "owner.txt", ", ",
+             [('name', text), ('contact', text)]),
+    DataFile(Performer, "performer.txt", "| ",
+             [('fname', text), ('lname', text), ('email', text),
+              ('phone', text), ('start_date', date), ('end_date', date),
+              ('hourly_rate', cents), ('notes', text)]),
+    DataFile(Instrument, "instrument.txt", ", ",
+             [('instrument_code', text), ('name', text)]),
+    DataFile(PerformerInstrument, "perfinstrument.txt", ", ",
+             [('performer_id', integer), ('instrument_code', text)]),
+    DataFile(PerformerGroup, "perfgroup.txt", ", ",
+             [('group_code', text), ('performer_id', integer)]),
+    DataFile(Provider, "provider.txt", None,
+             [('name', text)]),
+    DataFile(Piece, "piece.txt", ", ",
+             [('title', text), ('page_id', integer), ('composer', text),
+              ('lyricist', text), ('publication_year', text),
+              ('original_num_voices', integer), ('original_voicing', text),
+              ('original_language', text),
+              ('original_instrumentation', text), ('text_original', text),
+              ('text_english', text), ('description', text)]),
+    DataFile(SheetMusic, "sheet.txt", ", ",
+             [('piece_id', integer), ('music_url', text), ('cpdl_num', text),
+              ('editor', text), ('edition_notes', text), ('voicing', text),
+              ('instrumentation', text), ('language', text), ('key', text),
+              ('time_signature', text), ('score_type', text),
+              ('license_type', text), ('duration', integer)]),
+    DataFile(AudioFile, "audiofile.txt", ", ",
+             [('sheet_id', integer), ('file_type', text),
+              ('voicing_details', text), ('url', text)]),
+    DataFile(Genre, "genre.txt", None,
+             [('name', text)]),
+    DataFile(PieceGenre, "piecegenre.txt", ", ",
+             [('genre_id', integer), ('piece_id', integer)]),
+    DataFile(Concert, "concert.txt", ", ",
+             [('user_id', integer), ('name', text), ('description', text)]),
+    DataFile(ConcertSheet, "consheet.txt", "| ",
+             [('sheet_id', integer), ('concert_id', integer),
+              ('sheet_finalized', boolean)]),
+    DataFile(GroupSheet, "grpsheet.txt", "| ",
+             [('group_code', text), ('cs_id', integer)]),
+    DataFile(Event, "event.txt", "| ",
+             [('concert_id', integer), ('name', text), ('location', text),
+              ('start_day_time', day_time), ('end_day_time', day_time),
+              ('event_logistics', text)]),
+    DataFile(Assignment, "assignment.txt", ", ",
+             [('cs_id', integer), ('pi_id', integer)]),
+    DataFile(EventAssignment, "evtassign.txt", "|",
+             [('assignment_id', integer), ('event_id', integer),
+              ('notes', text)]),
+    DataFile(SheetMusicProvider, "sheetprovider.txt", ", ",
+             [('sheet_id', integer), ('provider_id', integer)]),
+    DataFile(SheetMusicOwner, "sheetowner.txt", ", ",
+             [('sheet_id', integer), ('owner_id', integer)]),
+    DataFile(UserPiece, "userpiece.txt", ", ",
+             [('user_id', integer), ('piece_id', integer)]),
+    DataFile(UserSheet, "usersheet.txt", ", ",
+             [('user_id', integer), ('sheet_id', integer)]),
+    DataFile(UserAudioFile, "userfile.txt", ", ",
+             [('user_id', integer), ('file_id', integer)]),
+]
+
+
+def serial_column(table):
+    """The table's autoincrementing integer primary key column, or None (for
+       tables keyed by a code)."""
+
+    key = list(table.primary_key.columns)
+
+    if len(key) == 1 and isinstance(key[0].type, db.Integer):
+        return key[0]
+
+    return None
+
+
+def columns(data_file):
+    """The names of the columns a data file's rows fill, in row order."""
+
+    serial = serial_column(data_file.model.__table__)
+    names = [name for name, parse in data_file.fields if name]
+
+    return ([serial.name] if serial is not None else []) + names
+
+
+def read_rows(data_file, data_dir=DATA_DIR):
+    """Yields a data file's rows as tuples of typed values, in the order of
+       columns(data_file). Raises SeedDataError for a row that doesn't
+       parse."""
+
+    path = os.path.join(data_dir, data_file.filename)
+    numbered = serial_column(data_file.model.__table__) is not None
+    row_id = 0
+
+    with open(path) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+
+            if not line.strip():
+                continue
+
+            if data_file.separator:
+                values = line.split(data_file.separator)
+            else:
+                values = [line.rstrip()]
+
+            if len(values) != len(data_file.fields):
+                raise SeedDataError("{}:{}: expected {} fields, found {}".format(
+                    path, line_num, len(data_file.fields), len(values)))
+
+            try:
+                row = tuple(parse(value) for (name, parse), value
+                            in zip(data_file.fields, values) if name)
+            except ValueError as e:
+                raise SeedDataError("{}:{}: {}".format(path, line_num, e))
+
+            row_id += 1
+
+            yield (row_id,) + row if numbered else row
+
+
+########## WRITING ROWS ####################################################
+
+def _copy_value(value):
+    """A value in COPY's text format."""
+
+    if value is None:
+        return u"\\N"
+    if isinstance(value, bool):
+        return u"t" if value else u"f"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return unicode(value.isoformat())
+
+    return (unicode(value).replace(u"\\", u"\\\\")
+                          .replace(u"\t", u"\\t")
+                          .replace(u"\n", u"\\n")
+                          .replace(u"\r", u"\\r"))
+
+
+class CopyStream(object):
+    """A file-like object that COPY reads rows from as it needs them, so a
+       whole file is never held in memory."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ""
+        self.count = 0
+
+    def _fill(self, size):
+        parts = [self._buffer]
+        length = len(self._buffer)
+
+        for row in self._rows:
+            line = (u"\t".join(_copy_value(value) for value in row) +
+                    u"\n").encode('utf-8')
+            parts.append(line)
+            length += len(line)
+            self.count += 1
+
+            if length >= size:
+                break
+
+        self._buffer = "".join(parts)
+
+    def read(self, size=COPY_CHUNK):
+        if size is None or size < 0:
+            size = COPY_CHUNK
+
+        if len(self._buffer) < size:
+            self._fill(size)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+    def readline(self, size=-1):
+        if "\n" not in self._buffer:
+            self._fill(COPY_CHUNK)
+
+        end = self._buffer.find("\n") + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+
+        return line
+
+
+def copy_rows(engine, table, names, rows):
+    """Writes rows with COPY FROM STDIN (PostgreSQL) and commits. Returns the
+       number of rows."""
+
+    stream = CopyStream(rows)
+    connection = engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert("COPY \"{}\" ({}) FROM STDIN".format(
+            table.name, ", ".join('"{}"'.format(name) for name in names)),
+            stream)
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    return stream.count
+
+
+def insert_rows(engine, table, names, rows, batch_rows=BATCH_ROWS):
+    """Writes rows with executemany, batch_rows at a time, in one
+       transaction. Returns the number of rows."""
+
+    count = 0
+
+    with engine.begin() as connection:
+        batch = []
+
+        for row in rows:
+            batch.append(dict(zip(names, row)))
+
+            if len(batch) >= batch_rows:
+                connection.execute(table.insert(), batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            connection.execute(table.insert(), batch)
+            count += len(batch)
+
+    return count
+
+
+def reset_sequence(engine, table):
+    """Moves a table's serial sequence past its largest id (PostgreSQL - other
+       databases carry on from the max id by themselves)."""
+
+    serial = serial_column(table)
+
+    if serial is None or engine.dialect.name != 'postgresql':
+        return
+
+    engine.execute("SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+                   "COALESCE(MAX({1}), 1), MAX({1}) IS NOT NULL) "
+                   "FROM {0}".format(table.name, serial.name))
+
+
+########## LOADING #########################################################
+
+def load_table(data_file, data_dir=DATA_DIR, engine=None):
+    """Loads one data file into its (empty) table and fixes its sequence.
+       Returns (rows, seconds)."""
+
+    engine = engine or db.engine
+    table = data_file.model.__table__
+    names = columns(data_file)
+    rows = read_rows(data_file, data_dir)
+
+    start = time.time()
+
+    if engine.dialect.name == 'postgresql':
+        count = copy_rows(engine, table, names, rows)
+    else:
+        count = insert_rows(engine, table, names, rows)
+
+    reset_sequence(engine, table)
+
+    return count, time.time() - start
+
+
+def nonempty_tables(tables=TABLES, engine=None):
+    """Returns the names of the tables that already have rows."""
+
+    engine = engine or db.engine
+
+    return [data_file.model.__tablename__ for data_file in tables
+            if engine.execute(data_file.model.__table__.select().limit(1)).first()]
+
+
+def _report(name, count, seconds):
+    print "{:<22} {:>10,} rows {:>8.2f}s {:>12,.0f} rows/sec".format(
+        name, count, seconds, count / seconds if seconds else 0)
+
+
+def bulk_load(data_dir=DATA_DIR, tables=TABLES, engine=None, workers=WORKERS):
+    """Loads every data file, each table once those it refers to are in, up
+       to workers tables at once, reporting rows/sec per table. Returns
+       {table name: (rows, seconds)}."""
+
+    engine = engine or db.engine
+
+    full = nonempty_tables(tables, engine)
+
+    if full:
+        raise SeedDataError("Bulk seeding needs empty tables - these have "
+                            "rows: {}".format(", ".join(full)))
+
+    # SQLite takes one writer at a time - more would only wait on its lock.
+    if engine.dialect.name == 'sqlite':
+        workers = 1
+
+    depends_on = dependencies([data_file.model.__table__ for data_file in tables])
+
+    print "{} tables in {} levels, {} at a time".format(
+        len(tables), len(levels(depends_on)), workers)
+
+    print_lock = threading.Lock()
+
+    def loader(data_file):
+        def load():
+            count, seconds = load_table(data_file, data_dir, engine)
+
+            with print_lock:
+                _report(data_file.model.__tablename__, count, seconds)
+
+            return count, seconds
+
+        return load
+
+    start = time.time()
+
+    stats = run_in_order(dict((data_file.model.__tablename__, loader(data_file))
+                              for data_file in tables),
+                         depends_on, workers)
+
+    total = sum(count for count, seconds in stats.values())
+    _report("TOTAL", total, time.time() - start)
+
+    return stats
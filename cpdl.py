@@ -1,58 +1,224 @@
+"""CPDL (choralwiki) API client.
+
+All traffic to cpdl.org goes through here, so every call shares one pooled,
+keep-alive session with connect/read timeouts and bounded retries with
+backoff, and json responses are served from the on-disk cache when fresh.
+
+At most CPDL_MAX_CONCURRENT calls per process are in flight at once; callers
+past that wait up to CPDL_QUEUE_TIMEOUT seconds for a slot, then get
+CPDLUnavailable rather than piling up behind a slow cpdl.org. (Under
+serve_async.py, where one process serves many requests at once, this is what
+keeps a CPDL outage from tying up every request.)"""
+
+import os
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Cached CPDL API responses, shared by all workers.
+from cpdl_cache import response_cache
+
+# CPDL's API endpoint - all query options are passed as params. (Point it at
+# cpdl_stub.py to develop or load test without touching cpdl.org.)
+CPDL_API = os.environ.get("CPDL_API", 'http://www1.cpdl.org/wiki/api.php')
+
+# Max keep-alive connections held open to cpdl.org, per worker process.
+POOL_SIZE = int(os.environ.get("CPDL_POOL_SIZE", 10))
+
+# Seconds to wait for the connection to open, and then for each read.
+CONNECT_TIMEOUT = float(os.environ.get("CPDL_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.environ.get("CPDL_READ_TIMEOUT", 20))
+
+# Retries for failed connections / 5xx responses; waits backoff * 2^n secs
+# between attempts.
+MAX_RETRIES = int(os.environ.get("CPDL_MAX_RETRIES", 3))
+BACKOFF_FACTOR = float(os.environ.get("CPDL_BACKOFF_FACTOR", 0.5))
+
+# Max calls to cpdl.org in flight at once, per process, and how many seconds a
+# call waits for one of those slots before giving up.
+MAX_CONCURRENT = int(os.environ.get("CPDL_MAX_CONCURRENT", POOL_SIZE))
+QUEUE_TIMEOUT = float(os.environ.get("CPDL_QUEUE_TIMEOUT", 5))
+
+
+class CPDLUnavailable(Exception):
+    """Raised when cpdl.org can't be reached (or keeps failing) after retries."""
+
+
+class ConcurrencyLimit(object):
+    """Counts calls in flight, letting at most limit through at once; the
+       rest wait (up to a timeout) for one to finish."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Takes a slot, waiting up to timeout seconds (forever if None) for
+           one to free up. Returns False if none did."""
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._cond:
+            while self.in_flight >= self.limit:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+
+            self.in_flight += 1
+
+        return True
+
+    def release(self):
+        """Gives a slot back."""
+
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+# Slots for this process's calls to cpdl.org.
+cpdl_slots = ConcurrencyLimit(MAX_CONCURRENT)
+
+
+def make_session(pool_size=POOL_SIZE, max_retries=MAX_RETRIES,
+                 backoff_factor=BACKOFF_FACTOR):
+    """Returns a requests Session with a keep-alive connection pool and retry
+       policy for talking to cpdl.org."""
+
+    retries = Retry(total=max_retries,
+                    connect=max_retries,
+                    read=max_retries,
+                    backoff_factor=backoff_factor,
+                    status_forcelist=(500, 502, 503, 504),
+                    method_whitelist=frozenset(['GET']))
+
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retries)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# One session per process - a forked worker must not reuse its parent's
+# sockets, so the session is rebuilt whenever the pid changes.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Returns this process's shared CPDL session."""
+
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = make_session()
+            _session_pid = os.getpid()
+
+    return _session
+
+
+def get(params, timeout=None):
+    """Sends a GET to the CPDL API through the shared pool and returns the
+       response. Raises CPDLUnavailable if it times out or keeps failing, or
+       if too many calls are already waiting on cpdl.org."""
+
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    if not cpdl_slots.acquire(QUEUE_TIMEOUT):
+        raise CPDLUnavailable("{} calls to CPDL already in flight".format(
+            cpdl_slots.in_flight))
+
+    try:
+        response = get_session().get(CPDL_API, params=params, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise CPDLUnavailable(str(e))
+    finally:
+        cpdl_slots.release()
+
+    return response
+
 
-# to get a dictionary out of each one of these result objects (r1, r2, etc),
-# you can call .json() on the object:
-# EX:
-# r1.json()
+def _is_answer(params, results):
+    """Whether results is an answer to params: no error, and the top-level
+       key named after the action ('parse', 'query')."""
 
+    return (isinstance(results, dict) and 'error' not in results and
+            params.get('action') in results)
 
 
+def get_cpdl_json(params, use_cache=True):
+    """Returns CPDL's json response for the given API params, from the on-disk
+       cache when we have a fresh copy, otherwise from cpdl.org. use_cache=False
+       goes straight to cpdl.org and doesn't store the response."""
 
-# General search -- the different terms can all go in as
-# the value for the 'gsrsearch' key
-payload = {'gsrsearch': 'Ecco Gesualdo'}
+    results = response_cache.get(params) if use_cache else None
 
-# making the request
-r1 = requests.get(
-    'http://www1.cpdl.org/wiki/api.php?action=query&format=json&prop=info&generator=search',
-    params=payload
-)
+    if results is None:
+        start = time.time()
 
+        try:
+            results = get(params).json()
+        except ValueError as e:
+            # cpdl.org answered, but not with json (maintenance pages, etc).
+            raise CPDLUnavailable(str(e))
 
-# parsing a full page, specifying the id of the page to parse
-r2 = requests.get(
-    'http://www1.cpdl.org/wiki/api.php?action=parse&format=json&pageid=3788'
-)
+        # Remember how long the round trip took, so cache hits can report the
+        # latency they saved. Only real answers are kept - an {"error": ...}
+        # (or a search with no hits) would otherwise stand for CACHE_TTL.
+        if use_cache and _is_answer(params, results):
+            response_cache.set(params, results, (time.time() - start) * 1000)
 
+    return results
 
-# parsing a page for just the image names, for a particular page_id
-payload = {
-    'prop': 'images',
-    'pageid': 3788,
-}
 
-r3 = requests.get(
-    'http://www1.cpdl.org/wiki/api.php?action=parse&format=json',
-    params=payload,
-)
+if __name__ == "__main__":
+    # Examples of each kind of CPDL request the app makes.
 
-# You could also just hardcode the prop=images and pageid in the url:
-# r = requests.get('http://www.cpdl.org/wiki/api.php?action=parse&format=json&prop=images&pageid=3788')
+    # General search -- the different terms can all go in as
+    # the value for the 'gsrsearch' key
+    r1 = get_cpdl_json({'action': 'query',
+                        'format': 'json',
+                        'prop': 'info',
+                        'generator': 'search',
+                        'gsrsearch': 'Ecco Gesualdo'})
 
+    # parsing a full page, specifying the id of the page to parse
+    r2 = get_cpdl_json({'action': 'parse',
+                        'format': 'json',
+                        'pageid': 3788})
 
+    # parsing a page for just the image names, for a particular page_id
+    r3 = get_cpdl_json({'action': 'parse',
+                        'format': 'json',
+                        'prop': 'images',
+                        'pageid': 3788})
 
-# Getting an image url by image name
-payload = {
-    'titles': 'File:Peetrino-Ardenti miei sospiri.pdf',
-    'iiprop': 'url',
-}
+    # Getting an image url by image name
+    r4 = get_cpdl_json({'action': 'query',
+                        'format': 'json',
+                        'prop': 'imageinfo',
+                        'titles': 'File:Peetrino-Ardenti miei sospiri.pdf',
+                        'iiprop': 'url'})
 
-r4 = requests.get(
-    'http://www1.cpdl.org/wiki/api.php?action=query&format=json&prop=imageinfo',
-    params=payload,
-) 
+    print response_cache.stats()
 
 # Test = searching by CPDL #, in CPDL - this was URL for # 28188:
 # http://www2.cpdl.org/wiki/index.php?search=cpdl+%2328188&title=Special%3ASearch&go=Go
 # And for # 21767:
-# http://www2.cpdl.org/wiki/index.php?search=cpdl+%2321767&title=Special%3ASearch&go=Go
\ No newline at end of file
+# http://www2.cpdl.org/wiki/index.php?search=cpdl+%2321767&title=Special%3ASearch&go=Go
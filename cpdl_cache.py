@@ -0,0 +1,243 @@
+"""Persistent on-disk cache for CPDL API responses.
+
+Responses are stored in a small SQLite file so they survive restarts and are
+shared by every worker process on the box. Entries expire after a TTL, and
+once the stored bodies grow past a size limit the least recently used entries
+are evicted."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Where the cache file lives - every worker process on the box shares it.
+CACHE_PATH = os.environ.get("CPDL_CACHE_PATH", "cpdl_cache.sqlite")
+
+# How long (in seconds) a cached response is considered fresh.
+CACHE_TTL = int(os.environ.get("CPDL_CACHE_TTL", 24 * 60 * 60))
+
+# Max total size (in bytes) of the cached bodies before LRU eviction kicks in.
+CACHE_MAX_BYTES = int(os.environ.get("CPDL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Query values that CPDL treats case-insensitively, so "Byrd" and " byrd "
+# share one cache entry.
+CASE_INSENSITIVE_PARAMS = ('gsrsearch',)
+
+
+def normalize_params(params):
+    """Returns the query params as a canonical, sorted list of (key, value)
+       string pairs - whitespace collapsed, search terms lowercased."""
+
+    normalized = []
+
+    for key, value in params.items():
+        key = unicode(key).strip().lower()
+        value = u" ".join(unicode(value).split())
+
+        if key in CASE_INSENSITIVE_PARAMS:
+            value = value.lower()
+
+        normalized.append((key, value))
+
+    return sorted(normalized)
+
+
+def make_key(params):
+    """Returns the cache key (a sha1 hex digest) for a set of query params."""
+
+    canonical = json.dumps(normalize_params(params), ensure_ascii=True)
+
+    return hashlib.sha1(canonical).hexdigest()
+
+
+class ResponseCache(object):
+    """SQLite-backed TTL + LRU cache of decoded CPDL JSON responses."""
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # One connection per process, shared by its threads (greenlets, under
+        # serve_async) one at a time. (Thread-local connections meant one per
+        # greenlet: a new connection, with its setup, for every request.)
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        """Returns this process's connection, creating the tables if needed.
+           (Call with self._lock held.)"""
+
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        # Autocommit mode; WAL lets readers in other workers run while one
+        # worker is writing.
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                            key TEXT PRIMARY KEY,
+                            params TEXT NOT NULL,
+                            body TEXT NOT NULL,
+                            size INTEGER NOT NULL,
+                            created REAL NOT NULL,
+                            accessed REAL NOT NULL,
+                            fetch_ms REAL NOT NULL)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS entries_accessed
+                        ON entries (accessed)""")
+        # So evict() finds the expired entries, and totals the sizes, without
+        # reading every (large) row on each write.
+        conn.execute("""CREATE INDEX IF NOT EXISTS entries_created
+                        ON entries (created)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS entries_size
+                        ON entries (size)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                            name TEXT PRIMARY KEY,
+                            value REAL NOT NULL)""")
+
+        self._conn = conn
+        self._pid = os.getpid()
+
+        return conn
+
+    def _locked(self):
+        """Returns the lock around the connection - a new one in a process
+           forked since it was made, as the parent may have held it."""
+
+        if self._pid is not None and self._pid != os.getpid():
+            self._lock = threading.RLock()
+            self._conn = None
+            self._pid = None
+
+        return self._lock
+
+    def _bump(self, conn, name, amount=1):
+        """Adds amount to one of the shared counters."""
+
+        conn.execute("INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)",
+                     (name,))
+        conn.execute("UPDATE stats SET value = value + ? WHERE name = ?",
+                     (amount, name))
+
+    def get(self, params):
+        """Returns the cached response for params, or None if it is missing or
+           stale."""
+
+        key = make_key(params)
+        now = time.time()
+
+        with self._locked():
+            conn = self._connect()
+
+            row = conn.execute("SELECT body, created, fetch_ms FROM entries WHERE key = ?",
+                               (key,)).fetchone()
+
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._bump(conn, 'misses')
+                return None
+
+            # Touch the entry so it moves to the back of the LRU queue, and
+            # count the round trip we just saved - in one write, not three.
+            conn.execute("BEGIN")
+            try:
+                conn.execute("UPDATE entries SET accessed = ? WHERE key = ?",
+                             (now, key))
+                self._bump(conn, 'hits')
+                self._bump(conn, 'saved_ms', row[2])
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+
+        # (Decoded after letting go of the connection.)
+        return json.loads(row[0])
+
+    def set(self, params, data, fetch_ms=0):
+        """Stores a response, then evicts least recently used entries until the
+           cache is back under max_bytes."""
+
+        body = json.dumps(data)
+        now = time.time()
+
+        with self._locked():
+            conn = self._connect()
+
+            conn.execute("""INSERT OR REPLACE INTO entries
+                            (key, params, body, size, created, accessed, fetch_ms)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                         (make_key(params), json.dumps(normalize_params(params)),
+                          body, len(body), now, now, fetch_ms))
+
+            self._evict(conn)
+
+    def evict(self):
+        """Drops expired entries, then the least recently used ones while the
+           total size is over the limit. Returns the number of rows removed."""
+
+        with self._locked():
+            return self._evict(self._connect())
+
+    def _evict(self, conn):
+
+        removed = conn.execute("DELETE FROM entries WHERE created < ?",
+                               (time.time() - self.ttl,)).rowcount
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+        while total > self.max_bytes:
+            oldest = conn.execute("""SELECT key, size FROM entries
+                                     ORDER BY accessed LIMIT 50""").fetchall()
+            if not oldest:
+                break
+
+            for key, size in oldest:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                removed += 1
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+        if removed:
+            self._bump(conn, 'evictions', removed)
+
+        return removed
+
+    def stats(self):
+        """Returns the shared hit/miss counters plus the current cache size."""
+
+        stats = {'hits': 0, 'misses': 0, 'saved_ms': 0, 'evictions': 0}
+
+        with self._locked():
+            conn = self._connect()
+
+            for name, value in conn.execute("SELECT name, value FROM stats"):
+                stats[name] = value if name == 'saved_ms' else int(value)
+
+            entries, size = conn.execute("""SELECT COUNT(*), COALESCE(SUM(size), 0)
+                                            FROM entries""").fetchone()
+
+        stats['entries'] = entries
+        stats['bytes'] = size
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+
+        return stats
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+
+        with self._locked():
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM stats")
+
+
+# The cache shared by the app's CPDL calls.
+response_cache = ResponseCache()
@@ -0,0 +1,376 @@
+"""Parser for CPDL (choralwiki) piece pages.
+
+Turns the json from CPDL's action=parse API into an immutable ParsedPage of
+the fields we store for a Piece, its Genres and each edition's SheetMusic and
+AudioFiles. The page html is parsed once with lxml and walked once; the older
+BeautifulSoup version re-scanned the whole tree for every field.
+
+Parsing is pure - no database, no app context - so many pages can be parsed
+in parallel worker processes (parse_pages) and written afterwards in batches
+(helper_functions.add_parsed_pages)."""
+
+import multiprocessing
+import re
+from collections import namedtuple
+
+from lxml import etree, html
+
+from genre_cache import normalize_genre_name
+
+# Tags the walk stops at - everything we need hangs off one of these.
+WANTED_TAGS = ('a', 'b', 'big', 'dd', 'div', 'li')
+
+# CPDL files the year a piece was published under "Category:1603 works".
+YEAR_RE = re.compile(r"Category:\d\d\d\d works")
+
+# Internal file links are relative to CPDL's site.
+CPDL_SITE = "http://www1.cpdl.org"
+
+# Audio (and other) file types longer than this are skipped - they're links to
+# web pages, zips, etc, not files.
+MAX_FILE_TYPE_LEN = 4
+
+# Labels (the text of a <b> tag) for general info about the piece.
+COMPOSER = "Composer:"
+LYRICIST = "Lyricist:"
+NUM_VOICES = "Number of voices:"
+VOICINGS = ("Voicing:", "Voicings:")
+GENRE = "Genre:"
+LANGUAGE = "Language:"
+INSTRUMENTS = "Instruments:"
+DESCRIPTION = "Description:"
+
+
+# What a parsed page holds. Tuples all the way down, so a ParsedPage can't be
+# changed after parsing and pickles cheaply between processes.
+ParsedPage = namedtuple('ParsedPage', ['page_id',
+                                       'title',
+                                       'composer',
+                                       'lyricist',
+                                       'publication_year',
+                                       'original_num_voices',
+                                       'original_voicing',
+                                       'original_language',
+                                       'original_instrumentation',
+                                       'text_original',
+                                       'text_english',
+                                       'description',
+                                       'genres',        # tuple of names
+                                       'editions'])     # tuple of ParsedEditions
+
+# One edition (CPDL #) with a PDF of the music = one SheetMusic row.
+ParsedEdition = namedtuple('ParsedEdition', ['cpdl_num',
+                                             'music_url',
+                                             'editor',
+                                             'edition_notes',
+                                             'license_type',
+                                             'files'])  # tuple of ParsedFiles
+
+# One of an edition's other files (midi, mp3...) = one AudioFile row.
+ParsedFile = namedtuple('ParsedFile', ['file_type', 'url'])
+
+
+############ SMALL TREE HELPERS - LIKE BEAUTIFUL SOUP'S, FOR LXML ############
+
+def _contents(el):
+    """Returns a tag's direct children - strings and tags, in order."""
+
+    contents = [el.text] if el.text else []
+
+    for child in el:
+        contents.append(child)
+        if child.tail:
+            contents.append(child.tail)
+
+    return contents
+
+
+def _string(node):
+    """Returns node's only string (a tag with a single child string, or a
+       single child tag that has one), or None."""
+
+    while not isinstance(node, basestring):
+        contents = _contents(node)
+        if len(contents) != 1:
+            return None
+        node = contents[0]
+
+    return node
+
+
+def _walk(el):
+    """Yields a tag, then everything inside it, then its tail, in order."""
+
+    yield el
+
+    if el.text:
+        yield el.text
+
+    for child in el:
+        for node in _walk(child):
+            yield node
+
+    if el.tail:
+        yield el.tail
+
+
+def _next_elements(el):
+    """Yields the strings and tags that come after el's start tag, in document
+       order (Beautiful Soup's next_element chain)."""
+
+    walk = _walk(el)
+    next(walk)
+
+    for node in walk:
+        yield node
+
+    while el is not None:
+        for sibling in el.itersiblings():
+            for node in _walk(sibling):
+                yield node
+
+        el = el.getparent()
+
+        if el is not None and el.tail:
+            yield el.tail
+
+
+def _nth_next_string(el, n):
+    """Returns the string of the nth element after el's start tag."""
+
+    for i, node in enumerate(_next_elements(el)):
+        if i == n - 1:
+            return _string(node)
+
+    return None
+
+
+def _serialize(el):
+    """Returns el (without its tail) as an html string."""
+
+    return etree.tostring(el, method='xml', encoding=unicode, with_tail=False)
+
+
+def _truthy(node):
+    """Truthiness of a string or tag the way Beautiful Soup sees it."""
+
+    if isinstance(node, basestring):
+        return bool(node)
+
+    return bool(_contents(node))
+
+
+def _classes(el):
+    """Returns the tokens in el's class attribute."""
+
+    return el.get('class', '').split()
+
+
+####################### THE PARSER ###########################################
+
+def parse_page(results, page_id=None):
+    """Returns a ParsedPage of everything we keep from a CPDL action=parse json
+       response. page_id defaults to the one in the response."""
+
+    if page_id is None:
+        page_id = results['parse'].get('pageid')
+
+    fields = parse_fields(results)
+
+    # Only editions that have a PDF as the first file become sheets (ie, not
+    # the ones that direct to another website, etc). Their other short file
+    # types become the sheet's audio files.
+    editions = []
+
+    for edition in fields.pop('editions'):
+        files = edition['files']
+
+        if not files or files[0][0] != 'pdf':
+            continue
+
+        editions.append(ParsedEdition(cpdl_num=edition['cpdl'],
+                                      music_url=files[0][1],
+                                      editor=edition['editor'],
+                                      edition_notes=edition['ednote'],
+                                      license_type=edition['lic'],
+                                      files=tuple(ParsedFile(file_type, url)
+                                                  for file_type, url in files[1:]
+                                                  if len(file_type) <= MAX_FILE_TYPE_LEN)))
+
+    fields['genres'] = tuple(fields['genres'])
+
+    return ParsedPage(page_id=page_id, editions=tuple(editions), **fields)
+
+
+def _parse_one(args):
+    """parse_page, taking one (results, page_id) tuple - for Pool.map."""
+
+    return parse_page(*args)
+
+
+def parse_pages(results_list, processes=None, chunksize=4):
+    """Parses many CPDL page responses - (results, page_id) tuples - in a pool
+       of worker processes, and returns their ParsedPages in the same order.
+       processes defaults to the number of CPUs; 1 parses in this process."""
+
+    results_list = list(results_list)
+
+    if processes == 1 or len(results_list) < 2:
+        return [_parse_one(args) for args in results_list]
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        return pool.map(_parse_one, results_list, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parse_fields(results):
+    """Returns a plain dict of the raw fields on a CPDL action=parse json
+       response: the piece's fields, its genres, and each edition's CPDL
+       number, files, editor, license and edition notes."""
+
+    page = {'title': results['parse']['title'].split("(")[0],
+            'composer': 'Composer required',     # (not nullable!)
+            'lyricist': None,
+            'publication_year': None,
+            'original_num_voices': None,
+            'original_voicing': None,
+            'original_language': None,
+            'original_instrumentation': None,
+            'text_original': None,
+            'text_english': None,
+            'description': None,
+            'genres': [],
+            'editions': []}
+
+    page_txt = results['parse']['text']['*']
+
+    if not page_txt.strip():
+        return page
+
+    try:
+        root = html.document_fromstring(page_txt)
+    except etree.ParserError:
+        # Nothing but comments (MediaWiki's parser report) - an empty page.
+        return page
+
+    bigs = []           # <big> text headings, in order
+    poems = []          # first <p> of each "poem" div, same order as bigs
+    dds = []            # editor/copyright and edition notes, 2 per edition
+    year_found = False
+
+    # The one walk over the tree.
+    for el in root.iter(*WANTED_TAGS):
+        tag = el.tag
+
+        if tag == 'b':
+            labels = [node for node in _contents(el) if isinstance(node, basestring)]
+
+            # General info about the piece for PIECE table & GENRE table.
+            if COMPOSER in labels:
+                page['composer'] = _nth_next_string(el, 3)
+            if LYRICIST in labels:
+                page['lyricist'] = _nth_next_string(el, 3)
+            if NUM_VOICES in labels:
+                num_voices = _nth_next_string(el, 2) or ''
+                try:
+                    page['original_num_voices'] = int(num_voices.replace("vv", "")
+                                                                .replace("v", ""))
+                except ValueError:
+                    pass
+            if VOICINGS[0] in labels or VOICINGS[1] in labels:
+                parts = el.getparent().text_content().split(":")
+                if len(parts) > 2:
+                    page['original_voicing'] = parts[2].split("Genre")[0]
+            if GENRE in labels:
+                cats = el.getparent().text_content().strip().split(GENRE)[-1]
+                # Names come back padded (" Madrigals"), so clean them up.
+                genres = [normalize_genre_name(name) for name in cats.split(",")]
+                page['genres'] = [name for name in genres if name]
+            if LANGUAGE in labels:
+                page['original_language'] = _nth_next_string(el, 3)
+            if INSTRUMENTS in labels:
+                page['original_instrumentation'] = _nth_next_string(el, 3)
+            if DESCRIPTION in labels:
+                page['description'] = (el.getparent().text_content()
+                                         .replace("Description: ", ''))
+
+        elif tag == 'a':
+            # The year published - the first "Category:NNNN works" link.
+            if not year_found and YEAR_RE.search(el.get('title', '')):
+                page['publication_year'] = _string(el)
+                year_found = True
+
+        elif tag == 'big':
+            bigs.append(el)
+
+        elif tag == 'div':
+            if 'poem' in _classes(el):
+                poems.append(el.find('.//p'))
+
+        elif tag == 'li':
+            # The only place <li> tags with a <b> are used is CPDL's bulleted
+            # list of editions: the CPDL # and then the edition's file links.
+            b_tag = el.find('.//b')
+            if b_tag is None:
+                continue
+
+            font = b_tag.find('.//font')
+            edition = {'cpdl': _string(font) if font is not None else None,
+                       'files': [],
+                       'editor': None,
+                       'lic': None,
+                       'ednote': ''}           # (not nullable!)
+
+            for a in b_tag.getparent().iter('a'):
+                href = a.get('href')
+                if not href:
+                    continue
+                # There are both internal AND external links - internal ones
+                # need CPDL's site added.
+                if 'internal' in _classes(a):
+                    edition['files'].append((href.split(".")[-1], CPDL_SITE + href))
+                else:
+                    edition['files'].append((href.split(".")[-1], href))
+
+            page['editions'].append(edition)
+
+        elif tag == 'dd':
+            dds.append(el.text_content())
+
+    # Get the original language's text, if any provided.
+    if bigs and poems and poems[0] is not None:
+        first = _contents(bigs[0])
+        if len(first) > 1 and _truthy(first[1]):
+            page['text_original'] = _serialize(poems[0])
+
+    # Look to see if any text in English. If so, keep the related 'poem'.
+    if page['original_language'] != 'English':
+        for i, big_tag in enumerate(bigs):
+            heading = _contents(big_tag)
+            if (len(heading) > 1 and isinstance(heading[1], basestring) and
+                    'English' in heading[1] and i < len(poems) and
+                    poems[i] is not None):
+                page['text_english'] = _serialize(poems[i])
+
+    # Each edition has 2 <dd>s: editor & copyright ('lic'), then edition notes.
+    for j, text in enumerate(dds):
+        if j / 2 >= len(page['editions']):
+            break
+
+        edition = page['editions'][j / 2]
+        parts = text.split(":")
+
+        if len(parts) < 2:
+            continue
+
+        if not j % 2:
+            edition['editor'] = parts[1].rstrip().split(" (")[0].strip()
+            edition['lic'] = text.split(": ")[-1].strip()
+        else:
+            edition['ednote'] = parts[1].rstrip().split(" (")[0].strip()
+
+    return page
@@ -0,0 +1,170 @@
+"""CPDL search results, parsed once and kept sorted.
+
+A CPDL search's json is turned into a tuple of (page_id, title) pairs, sorted
+by title, once - and kept in memory by search terms, so the next person to
+search the same thing, and every page of a long result list, is served
+without fetching, decoding or sorting anything again. What we already have
+of each result (the piece, its sheets, whether it's in the user's library)
+is looked up per view, as it changes - in one query, for just the results
+being shown."""
+
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import exists, func, literal
+
+from model import Piece, SheetMusic, UserPiece, db
+
+from cpdl import get_cpdl_json
+
+# One CPDL search result.
+CPDLResult = namedtuple('CPDLResult', ['page_id', 'title'])
+
+# A result as shown. If we already have the page: its piece_id, how many
+# sheets it has, and whether it's in the user's library.
+SearchHit = namedtuple('SearchHit', ['page_id', 'title', 'piece_id', 'sheets',
+                                     'in_library'])
+
+# Results shown per page.
+RESULTS_PER_PAGE = 20
+
+# Searches kept in memory, and for how many seconds.
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 500))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 10 * 60))
+
+
+def is_search_answer(results):
+    """Whether a search's json is CPDL's answer - its hits ('query'), or
+       nothing found ('batchcomplete' alone) - rather than an error."""
+
+    return (isinstance(results, dict) and 'error' not in results and
+            ('query' in results or 'batchcomplete' in results))
+
+
+def parse_search_results(results):
+    """Returns the CPDLResults in a CPDL search's json, sorted by title
+       (empty if it found nothing)."""
+
+    pages = results.get('query', {}).get('pages', {})
+
+    return tuple(sorted((CPDLResult(int(page_id), page['title'])
+                         for page_id, page in pages.items()),
+                        key=lambda result: (result.title, result.page_id)))
+
+
+class SearchCache(object):
+    """Search terms -> sorted CPDLResults, least recently used dropped
+       first."""
+
+    def __init__(self, size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()       # key -> (stored at, results)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(terms):
+        # CPDL's search ignores case and spacing, so we do too.
+        return u" ".join(terms.lower().split())
+
+    def get(self, terms):
+        """Returns the cached results for terms, or None."""
+
+        key = self.key(terms)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+
+            # Back on the end - most recently used.
+            self._entries[key] = entry
+
+        return entry[1]
+
+    def set(self, terms, results):
+        key = self.key(terms)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), results)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# This process's searches.
+search_cache = SearchCache()
+
+
+def cpdl_results(terms):
+    """Returns CPDL's results for terms as sorted CPDLResults. Raises
+       CPDLUnavailable if CPDL can't be reached."""
+
+    if not terms or not terms.strip():
+        return ()
+
+    results = search_cache.get(terms)
+
+    if results is None:
+        answer = get_cpdl_json({'action': 'query',
+                                'format': 'json',
+                                'prop': 'info',
+                                'generator': 'search',
+                                'gsrlimit': 'max',
+                                'gsrsearch': terms})
+        results = parse_search_results(answer)
+
+        # An error parses to no results too - but isn't kept, or one hiccup
+        # would read as "nothing found" until it expired.
+        if is_search_answer(answer):
+            search_cache.set(terms, results)
+
+    return results
+
+
+def local_pieces(page_ids, user_id=None):
+    """Returns {page_id: (piece_id, number of sheets, in the user's library)}
+       for the pages we already have - in one query."""
+
+    if user_id:
+        in_library = (exists().where(UserPiece.piece_id == Piece.piece_id)
+                              .where(UserPiece.user_id == user_id))
+    else:
+        in_library = literal(False)
+
+    rows = (db.session.query(Piece.page_id, Piece.piece_id,
+                             func.count(SheetMusic.sheet_id),
+                             in_library)
+                      .outerjoin(SheetMusic, SheetMusic.piece_id == Piece.piece_id)
+                      .filter(Piece.page_id.in_(page_ids))
+                      .group_by(Piece.page_id, Piece.piece_id))
+
+    return dict((page_id, (piece_id, sheets, bool(saved)))
+                for page_id, piece_id, sheets, saved in rows)
+
+
+def results_page(results, page=1, per_page=RESULTS_PER_PAGE, user_id=None):
+    """Returns (hits, page, pages): the given page (from 1, kept in range) of
+       results as SearchHits, its number, and the number of pages."""
+
+    pages = max(1, (len(results) + per_page - 1) // per_page)
+    page = min(max(page, 1), pages)
+    shown = results[(page - 1) * per_page:page * per_page]
+
+    if not shown:
+        return [], page, pages
+
+    # What we already have of these - for just this page.
+    local = local_pieces([result.page_id for result in shown], user_id)
+
+    return [SearchHit(result.page_id, result.title,
+                      *local.get(result.page_id, (None, 0, False)))
+            for result in shown], page, pages
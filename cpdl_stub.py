@@ -0,0 +1,232 @@
+"""A stand-in for CPDL's API, for development and load testing.
+
+Answers the calls the app makes - search, parse, categorymembers and
+imageinfo - after a configurable delay, so we can see how the app behaves
+when cpdl.org is slow without asking anything of cpdl.org. Parsed pages come
+from a fixtures directory (page_<page_id>.json, saved CPDL responses) when
+one has the page, and are made up otherwise: every page id gets its own
+title, composer and editions, the same every time.
+
+    python cpdl_stub.py --port 8001 --delay 0.5
+    CPDL_API=http://localhost:8001/api.php python serve_async.py
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+import urlparse
+
+# Defaults for the command line options.
+HOST = "127.0.0.1"
+PORT = 8001
+DELAY = 0.2                 # seconds before each answer
+JITTER = 0.0                # up to this many seconds more, at random
+SEARCH_RESULTS = 50         # pages per search (CPDL's own limit)
+CATEGORY_SIZE = 120         # pages per category
+CATEGORY_BATCH = 50         # pages per categorymembers response
+
+# Made up pages are built from these.
+COMPOSERS = [u"Claudio Monteverdi", u"William Byrd", u"Thomas Tallis",
+             u"Giovanni Pierluigi da Palestrina", u"Josquin des Prez",
+             u"Tom\u00e1s Luis de Victoria", u"Orlande de Lassus",
+             u"Carlo Gesualdo", u"Heinrich Sch\u00fctz", u"John Dowland"]
+TITLE_WORDS = ["Ave", "Maria", "Ecco", "mormorar", "Sicut", "cervus",
+               "Laudate", "Dominum", "Miserere", "Ardenti", "miei", "sospiri",
+               "Exsultate", "Deo", "Magnificat", "O", "magnum", "mysterium"]
+VOICINGS = ["SATB", "SSATB", "SAATB", "SSAATTBB", "TTBB", "SSA"]
+LANGUAGES = ["Latin", "Italian", "English", "German", "French"]
+GENRES = ["Sacred", "Secular", "Motets", "Madrigals", "Masses", "Anthems"]
+
+PAGE_HTML = u"""<h2><span class="mw-headline" id="Music_files">Music files</span></h2>
+{editions}
+<h2><span class="mw-headline" id="General_Information">General Information</span></h2>
+<p><b>Title:</b> <i>{title}</i><br />
+<b>Composer:</b> <a href="/wiki/index.php/{composer_link}" title="{composer}">{composer}</a><br />
+<b>Lyricist:</b> Anonymous<br />
+</p><p><b>Number of voices:</b> {voices}vv&#160;&#160; <b>Voicing:</b> {voicing}<br />
+<b>Genre:</b> <a href="/wiki/index.php/Category:{genre}_music" title="Category:{genre} music">{genre}</a>
+</p><p><b>Language:</b> <a href="/wiki/index.php/Category:{language}_texts" title="Category:{language} texts">{language}</a><br />
+<b>Instruments:</b> <a href="/wiki/index.php/A_cappella" title="A cappella">A cappella</a><br />
+</p><p><b>First published:</b> {year}<br />
+<b>Description:</b> Stub page {page_id}.
+</p><p><b>External websites:</b>
+</p>
+<h2><span class="mw-headline" id="Original_text_and_translations">Original text and translations</span></h2>
+<div style="float:left"><b><big>{language}&#160;&#160;text</big></b>
+<div class="poem">
+<p>{title}<br />
+{title}
+</p>
+</div></div>
+"""
+
+EDITION_HTML = u"""<ul><li><b><font color="red">CPDL #{cpdl_number:05d}:</font></b>&#160;&#160;<a href="/wiki/images/{name}.pdf" class="internal" title="{name}.pdf"><img alt="Icon pdf.gif" src="/wiki/images/pdf.gif" /></a> <a href="/wiki/images/{name}.mid" class="internal" title="{name}.mid">MIDI</a></li></ul>
+<dl><dd><b>Editor:</b> <a href="/wiki/index.php/User:Stub_Editor" title="User:Stub Editor">Stub Editor</a> (submitted 2010-01-01).&#160;&#160; <b>Score information:</b> A4, {pages} pages, {kb} kB&#160;&#160; <b>Copyright:</b> <a href="/wiki/index.php/ChoralWiki:CPDL" title="ChoralWiki:CPDL">CPDL</a></dd>
+<dd><b>Edition notes:</b> Edition {number} of stub page {page_id}.</dd></dl>
+"""
+
+
+def made_up_page(page_id):
+    """Returns a CPDL-shaped parse response for page_id - always the same one
+       for the same id."""
+
+    rand = random.Random(page_id)
+
+    composer = rand.choice(COMPOSERS)
+    title = u" ".join(rand.sample(TITLE_WORDS, rand.randint(2, 4)))
+    voicing = rand.choice(VOICINGS)
+
+    editions = []
+    for number in range(1, rand.randint(1, 4) + 1):
+        name = u"Stub-{}-{}".format(page_id, number)
+        editions.append(EDITION_HTML.format(cpdl_number=page_id * 10 + number,
+                                            name=name,
+                                            number=number,
+                                            page_id=page_id,
+                                            pages=rand.randint(2, 20),
+                                            kb=rand.randint(40, 400)))
+
+    html = PAGE_HTML.format(editions=u"".join(editions),
+                            title=title,
+                            composer=composer,
+                            composer_link=composer.replace(u" ", u"_"),
+                            voices=len(voicing),
+                            voicing=voicing,
+                            genre=rand.choice(GENRES),
+                            language=rand.choice(LANGUAGES),
+                            year=rand.randint(1500, 1700),
+                            page_id=page_id)
+
+    return {'parse': {'title': u"{} ({})".format(title, composer),
+                      'pageid': page_id,
+                      'text': {'*': html},
+                      'images': []}}
+
+
+class StubCPDL(object):
+    """WSGI app answering CPDL API calls, slowly."""
+
+    def __init__(self, delay=DELAY, jitter=JITTER, fixtures=None):
+        self.delay = delay
+        self.jitter = jitter
+        self.fixtures = fixtures
+        self.calls = 0
+
+    def page(self, page_id):
+        """The parse response for page_id: the fixture if we have one."""
+
+        if self.fixtures:
+            path = os.path.join(self.fixtures, "page_{}.json".format(page_id))
+            if os.path.exists(path):
+                with open(path) as f:
+                    return json.load(f)
+
+        return made_up_page(page_id)
+
+    def search(self, term):
+        """Search results for term: SEARCH_RESULTS made up page ids, the same
+           every time for the same term."""
+
+        rand = random.Random(term.lower())
+        page_ids = rand.sample(xrange(1000, 1000000), SEARCH_RESULTS)
+
+        return {'query': {'pages': dict(
+                    (str(page_id), {'pageid': page_id,
+                                    'ns': 0,
+                                    'title': made_up_page(page_id)['parse']['title']})
+                    for page_id in page_ids)}}
+
+    def category(self, title, offset):
+        """One batch of a category's members, with a continuation if there
+           are more."""
+
+        rand = random.Random(title)
+        page_ids = rand.sample(xrange(1000, 1000000), CATEGORY_SIZE)
+        batch = page_ids[offset:offset + CATEGORY_BATCH]
+
+        results = {'query': {'categorymembers': [{'pageid': page_id, 'ns': 0}
+                                                 for page_id in batch]}}
+
+        if offset + CATEGORY_BATCH < CATEGORY_SIZE:
+            results['continue'] = {'cmcontinue': str(offset + CATEGORY_BATCH),
+                                   'continue': '-||'}
+
+        return results
+
+    def answer(self, params):
+        """The json for one API call's params (a dict of strings)."""
+
+        if params.get('action') == 'parse':
+            return self.page(int(params.get('pageid', 0)))
+
+        if params.get('generator') == 'search':
+            return self.search(params.get('gsrsearch', ''))
+
+        if params.get('list') == 'categorymembers':
+            return self.category(params.get('cmtitle', ''),
+                                 int(params.get('cmcontinue', 0)))
+
+        if params.get('prop') == 'imageinfo':
+            title = params.get('titles', '')
+            return {'query': {'pages': {'-1': {
+                        'title': title,
+                        'imageinfo': [{'url': 'http://localhost/wiki/images/' +
+                                              title.split(':', 1)[-1]}]}}}}
+
+        return {'error': {'code': 'unknown_action',
+                          'info': 'The stub does not answer that call.'}}
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+
+        params = dict((key, values[-1]) for key, values in
+                      urlparse.parse_qs(environ.get('QUERY_STRING', '')).items())
+
+        time.sleep(self.delay + random.random() * self.jitter)
+
+        body = json.dumps(self.answer(params))
+
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+def serve(app, host=HOST, port=PORT):
+    """Serves the stub on gevent if it's installed (so slow answers overlap),
+       otherwise on a thread per request."""
+
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+        from gevent.pywsgi import WSGIServer
+        WSGIServer((host, port), app, log=None).serve_forever()
+    except ImportError:
+        from SocketServer import ThreadingMixIn
+        from wsgiref.simple_server import WSGIServer, make_server
+
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        make_server(host, port, app,
+                    server_class=ThreadingWSGIServer).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub CPDL API.")
+    parser.add_argument("--host", default=HOST,
+                        help="interface to listen on (default %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port to listen on (default %(default)s)")
+    parser.add_argument("--delay", type=float, default=DELAY,
+                        help="seconds before each answer (default %(default)s)")
+    parser.add_argument("--jitter", type=float, default=JITTER,
+                        help="up to this many seconds more (default %(default)s)")
+    parser.add_argument("--fixtures",
+                        help="directory of saved page_<page_id>.json responses")
+    args = parser.parse_args()
+
+    print "Stub CPDL API on http://{}:{}/api.php".format(args.host, args.port)
+
+    serve(StubCPDL(args.delay, args.jitter, args.fixtures), args.host, args.port)
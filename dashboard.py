@@ -0,0 +1,151 @@
+"""Queries for the user dashboard (/users/<user_id>).
+
+The dashboard used to load every group and every performer in the database,
+and each performer's instruments one query at a time. Now it only shows the
+groups singing in the user's concerts and the performers on those groups'
+rosters. They come a page at a time, and the counts are done in SQL.
+
+Groups and performers are paged by keyset (see keyset.py); the client passes
+a page's cursor back as ?after= for the next page.
+"""
+
+from sqlalchemy import func
+
+from keyset import keyset_page
+
+from model import (Concert, ConcertSheet, Group, GroupSheet, Performer,
+                   PerformerGroup, PerformerInstrument, Piece, SheetMusic,
+                   AudioFile, UserPiece, UserSheet, UserAudioFile, db)
+
+# Groups / performers per page.
+PAGE_SIZE = 25
+
+# Most recent library items shown per kind - the rest are on /library.
+LIBRARY_PREVIEW = 10
+
+
+def _user_group_codes(user_id):
+    """Query for the codes of groups singing in any of the user's concerts."""
+
+    return (db.session.query(GroupSheet.group_code)
+                      .join(ConcertSheet, ConcertSheet.cs_id == GroupSheet.cs_id)
+                      .join(Concert, Concert.concert_id == ConcertSheet.concert_id)
+                      .filter(Concert.user_id == user_id)
+                      .distinct())
+
+
+def _user_performer_ids(user_id):
+    """Query for the ids of performers on those groups' rosters."""
+
+    return (db.session.query(PerformerGroup.performer_id)
+                      .filter(PerformerGroup.group_code.in_(_user_group_codes(user_id)))
+                      .distinct())
+
+
+def groups_page(user_id, after=None, limit=PAGE_SIZE):
+    """Returns (groups, cursor): a page of the user's groups, by name, each
+       with group_code, name and members (the size of its roster)."""
+
+    members = (db.session.query(PerformerGroup.group_code,
+                                func.count(PerformerGroup.perf_group_id)
+                                    .label('members'))
+                         .group_by(PerformerGroup.group_code)
+                         .subquery())
+
+    query = (db.session.query(Group.group_code,
+                              Group.name,
+                              func.coalesce(members.c.members, 0).label('members'))
+                       .outerjoin(members, members.c.group_code == Group.group_code)
+                       .filter(Group.group_code.in_(_user_group_codes(user_id))))
+
+    return keyset_page(query, [Group.name, Group.group_code], after, limit)
+
+
+def performers_page(user_id, after=None, limit=PAGE_SIZE):
+    """Returns (performers, cursor): a page of the performers in the user's
+       groups, by last then first name. Each is a dict of performer_id, fname,
+       lname and instruments (a list of instrument codes)."""
+
+    query = (db.session.query(Performer.performer_id,
+                              Performer.fname,
+                              Performer.lname)
+                       .filter(Performer.performer_id.in_(_user_performer_ids(user_id))))
+
+    rows, cursor = keyset_page(query,
+                               [Performer.lname, Performer.fname, Performer.performer_id],
+                               after, limit)
+
+    # One query for the whole page's instruments.
+    instruments = dict((row.performer_id, []) for row in rows)
+
+    if instruments:
+        for performer_id, code in (db.session.query(PerformerInstrument.performer_id,
+                                                    PerformerInstrument.instrument_code)
+                                             .filter(PerformerInstrument.performer_id
+                                                     .in_(instruments.keys()))
+                                             .order_by(PerformerInstrument.pi_id)):
+            instruments[performer_id].append(code)
+
+    performers = [{'performer_id': row.performer_id,
+                   'fname': row.fname,
+                   'lname': row.lname,
+                   'instruments': instruments[row.performer_id]}
+                  for row in rows]
+
+    return performers, cursor
+
+
+def dashboard_counts(user_id):
+    """Returns a dict of how many pieces, sheets, files, concerts, groups and
+       performers the user has - all in one query."""
+
+    def count(query):
+        return (db.session.query(func.count())
+                          .select_from(query.subquery())
+                          .as_scalar())
+
+    counts = db.session.query(
+        count(db.session.query(UserPiece.up_id)
+                        .filter(UserPiece.user_id == user_id)).label('pieces'),
+        count(db.session.query(UserSheet.us_id)
+                        .filter(UserSheet.user_id == user_id)).label('sheets'),
+        count(db.session.query(UserAudioFile.uaf_id)
+                        .filter(UserAudioFile.user_id == user_id)).label('files'),
+        count(db.session.query(Concert.concert_id)
+                        .filter(Concert.user_id == user_id)).label('concerts'),
+        count(_user_group_codes(user_id)).label('groups'),
+        count(_user_performer_ids(user_id)).label('performers')).one()
+
+    return counts._asdict()
+
+
+def recent_library(user_id, limit=LIBRARY_PREVIEW):
+    """Returns (pieces, sheets, files): the user's most recently saved items
+       of each kind, with just the columns the dashboard shows."""
+
+    pieces = (db.session.query(Piece.piece_id, Piece.title, Piece.composer)
+                        .join(UserPiece, UserPiece.piece_id == Piece.piece_id)
+                        .filter(UserPiece.user_id == user_id)
+                        .order_by(UserPiece.up_id.desc())
+                        .limit(limit)
+                        .all())
+
+    sheets = (db.session.query(SheetMusic.sheet_id, SheetMusic.edition_notes,
+                               Piece.title)
+                        .join(UserSheet, UserSheet.sheet_id == SheetMusic.sheet_id)
+                        .join(Piece, Piece.piece_id == SheetMusic.piece_id)
+                        .filter(UserSheet.user_id == user_id)
+                        .order_by(UserSheet.us_id.desc())
+                        .limit(limit)
+                        .all())
+
+    files = (db.session.query(AudioFile.file_id, AudioFile.file_type, Piece.title)
+                       .join(UserAudioFile, UserAudioFile.file_id == AudioFile.file_id)
+                       .join(SheetMusic, SheetMusic.sheet_id == AudioFile.sheet_id)
+                       .join(Piece, Piece.piece_id == SheetMusic.piece_id)
+                       .filter(UserAudioFile.user_id == user_id)
+                       .order_by(UserAudioFile.uaf_id.desc())
+                       .limit(limit)
+                       .all())
+
+    return pieces, sheets, files
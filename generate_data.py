@@ -0,0 +1,390 @@
+"""Generates large, realistic seed data for load testing.
+
+Writes the same data files as data/ (see bulk_seed.TABLES for the formats),
+scaled up: users, groups, performers with instruments, pieces with several
+sheets and audio files each, concerts with sheets, events, part assignments
+and event assignments, and users' library rows. Ids are line numbers, as the
+seed loaders assign them, so every reference points at a real row.
+
+Not every piece is equally popular: which pieces users save, and which
+sheets concerts program, follow a Zipf distribution, so a few pieces are in
+many libraries and most in few - as in real use, and as the indexes and
+caches will see it.
+
+    python generate_data.py --scale 10 --out /tmp/quirify_data
+    python seed.py --bulk --data-dir /tmp/quirify_data --db postgres:///loadtest
+
+or straight into a database (it must be empty):
+
+    python generate_data.py --scale 10 --out /tmp/quirify_data --load postgres:///loadtest
+
+Runs are repeatable: the same --scale and --seed give the same files.
+"""
+
+import argparse
+import bisect
+import datetime
+import os
+import random
+import time
+
+# Default options.
+SCALE = 1
+SEED = 1
+ZIPF_S = 1.1            # Zipf exponent - higher is more skewed
+
+# Rows per unit of scale.
+USERS = 10
+GROUPS = 3
+PERFORMERS = 40
+PIECES = 500
+
+# Per-row ranges.
+SHEETS_PER_PIECE = (1, 6)
+FILES_PER_SHEET = (0, 3)
+GENRES_PER_PIECE = (1, 3)
+INSTRUMENTS_PER_PERFORMER = (1, 3)
+GROUPS_PER_PERFORMER = (1, 2)
+CONCERTS_PER_USER = (1, 5)
+SHEETS_PER_CONCERT = (6, 20)
+EVENTS_PER_CONCERT = (1, 4)
+PARTS_PER_SHEET = (3, 8)
+LIBRARY_PIECES = (5, 150)       # pieces each user saves (before the skew)
+
+INSTRUMENTS = [("S1", "Soprano 1"), ("S2", "Soprano 2"), ("A1", "Alto 1"),
+               ("A2", "Alto 2"), ("T1", "Tenor 1"), ("T2", "Tenor 2"),
+               ("B1", "Bass 1"), ("B2", "Bass 2"), ("VLN1", "Violin 1"),
+               ("VLN2", "Violin 2"), ("VLA", "Viola"), ("VC", "Cello"),
+               ("PNO", "Piano"), ("ORG", "Organ")]
+GENRES = ["Sacred", "Secular", "Madrigal", "Motet", "Mass", "Anthem",
+          "Chanson", "Lied", "Carol", "Hymn", "Psalm", "Requiem", "Magnificat",
+          "Part song", "Spiritual", "Folk song", "Opera chorus", "Cantata",
+          "Oratorio", "Villancico", "Frottola", "Ballett", "Canzonetta",
+          "Lament", "Partsong", "Canon", "Round", "Glee", "Catch", "Chorale"]
+PROVIDERS = ["Choral Public Domain Library (CPDL)", "IMSLP", "Own copy",
+             "Library loan", "Publisher"]
+FIRST_NAMES = ["Anna", "Ben", "Clara", "David", "Emma", "Felix", "Grace",
+               "Henry", "Iris", "Jack", "Kate", "Liam", "Maria", "Noah",
+               "Olivia", "Paul", "Rosa", "Sam", "Tara", "Will"]
+LAST_NAMES = ["Adams", "Byrd", "Carver", "Dowland", "Elgar", "Finzi", "Gibbons",
+              "Holst", "Ives", "Jenkins", "Kodaly", "Lassus", "Morley", "Nyman",
+              "Ockeghem", "Parry", "Quilter", "Rutter", "Stanford", "Tallis"]
+COMPOSERS = ["Claudio Monteverdi", "William Byrd", "Thomas Tallis",
+             "Giovanni Pierluigi da Palestrina", "Josquin des Prez",
+             "Tomas Luis de Victoria", "Orlande de Lassus", "Carlo Gesualdo",
+             "Heinrich Schutz", "John Dowland", "Thomas Morley",
+             "Orlando Gibbons", "Johann Sebastian Bach", "Henry Purcell",
+             "Johannes Brahms", "Felix Mendelssohn", "Anton Bruckner",
+             "Gabriel Faure", "Charles Villiers Stanford", "Hubert Parry"]
+WORDS = ["ave", "maria", "gloria", "sanctus", "agnus", "dei", "kyrie",
+         "laudate", "dominum", "ecco", "mormorar", "onde", "sicut", "cervus",
+         "miserere", "ardenti", "sospiri", "exsultate", "jubilate", "deo",
+         "magnificat", "nunc", "dimittis", "o", "magnum", "mysterium", "in",
+         "the", "spring", "now", "is", "month", "of", "maying", "fair",
+         "phyllis", "weep", "no", "more", "sweet", "love", "rest", "silver",
+         "swan", "come", "again", "since", "first", "saw", "your", "face"]
+VOICINGS = ["SATB", "SSATB", "SAATB", "SATTB", "SSAATTBB", "TTBB", "SSA",
+            "SSAA", "SAB", "STB"]
+LANGUAGES = ["Latin", "Italian", "English", "German", "French", "Spanish"]
+KEYS = ["C", "F", "G", "D", "Bb", "a minor", "d minor", "g minor"]
+TIMES = ["4/4", "3/4", "2/2", "6/8", "3/2"]
+FILE_TYPES = ["Midi file", "Mp3 file", "Noteworthy file", "Sibelius file"]
+LOCATIONS = ["St. Aiden's", "Town Hall", "Grace Cathedral", "Danville",
+             "Community Center", "University Chapel"]
+
+
+class ZipfSampler(object):
+    """Picks 1..n, item k with probability proportional to 1 / rank(k)^s,
+       where the ranks are a shuffle of 1..n (so the popular items aren't
+       just the lowest ids)."""
+
+    def __init__(self, n, rand, s=ZIPF_S):
+        self.rand = rand
+        self.ids = range(1, n + 1)
+        rand.shuffle(self.ids)
+
+        total = 0.0
+        self.cumulative = []
+
+        for rank in xrange(1, n + 1):
+            total += 1.0 / rank ** s
+            self.cumulative.append(total)
+
+        self.total = total
+
+    def sample(self):
+        rank = bisect.bisect_left(self.cumulative, self.rand.random() * self.total)
+        return self.ids[min(rank, len(self.ids) - 1)]
+
+    def distinct(self, k):
+        """Up to k different items (fewer if the skew makes more too rare to
+           find)."""
+
+        picked = set()
+
+        for attempt in xrange(k * 4):
+            picked.add(self.sample())
+            if len(picked) >= k:
+                break
+
+        return sorted(picked)
+
+
+class DataWriter(object):
+    """Writes one data file's rows and counts them - a row's line number is
+       its id."""
+
+    def __init__(self, out_dir, filename, separator=", "):
+        self.filename = filename
+        self.separator = separator
+        self.count = 0
+        self._file = open(os.path.join(out_dir, filename), "w")
+
+    def write(self, *fields):
+        self._file.write(self.separator.join(unicode(field) for field in fields)
+                                       .encode('utf-8') + "\n")
+        self.count += 1
+        return self.count
+
+    def close(self):
+        self._file.close()
+
+
+def _date(day):
+    return day.strftime("%m/%d/%Y")
+
+
+def _words(rand, low, high):
+    return " ".join(rand.sample(WORDS, rand.randint(low, high)))
+
+
+def generate(out_dir, scale=SCALE, seed=SEED, zipf_s=ZIPF_S):
+    """Writes a dataset of the given scale to out_dir. Returns {file name: rows
+       written}."""
+
+    rand = random.Random(seed)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    files = {}
+
+    def writer(filename, separator=", "):
+        files[filename] = DataWriter(out_dir, filename, separator)
+        return files[filename]
+
+    users = writer("user.txt")
+    groups = writer("group.txt")
+    owners = writer("owner.txt")
+    performers = writer("performer.txt", "| ")
+    instruments = writer("instrument.txt")
+    perf_instruments = writer("perfinstrument.txt")
+    perf_groups = writer("perfgroup.txt")
+    providers = writer("provider.txt")
+    pieces = writer("piece.txt")
+    sheets = writer("sheet.txt")
+    audiofiles = writer("audiofile.txt")
+    genres = writer("genre.txt")
+    piece_genres = writer("piecegenre.txt")
+    concerts = writer("concert.txt")
+    concert_sheets = writer("consheet.txt", "| ")
+    group_sheets = writer("grpsheet.txt", "| ")
+    events = writer("event.txt", "| ")
+    assignments = writer("assignment.txt")
+    event_assignments = writer("evtassign.txt", "|")
+    sheet_providers = writer("sheetprovider.txt")
+    sheet_owners = writer("sheetowner.txt")
+    user_pieces = writer("userpiece.txt")
+    user_sheets = writer("usersheet.txt")
+    user_files = writer("userfile.txt")
+
+    start = datetime.date(2000, 1, 1)
+
+    ########## People ##########
+
+    for i in xrange(USERS * scale):
+        first, last = rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES)
+        users.write(first, last, "user{}@example.com".format(i + 1),
+                    "pw{}".format(i + 1), "Director", "555-{:04d}".format(i % 10000))
+
+    for i in xrange(max(1, USERS * scale // 5)):
+        owners.write("Owner {}".format(i + 1), "owner{}@example.com".format(i + 1))
+
+    group_codes = []
+    for i in xrange(GROUPS * scale):
+        code = "G{}".format(i + 1)
+        group_codes.append(code)
+        founded = start + datetime.timedelta(days=rand.randint(0, 6000))
+        groups.write(code, "Ensemble {}".format(i + 1), _words(rand, 3, 6), "",
+                     _date(founded))
+
+    for code, name in INSTRUMENTS:
+        instruments.write(code, name)
+
+    # performer_instruments ids, by group - who can be assigned a part.
+    parts_by_group = dict((code, []) for code in group_codes)
+
+    for performer_id in xrange(1, PERFORMERS * scale + 1):
+        joined = start + datetime.timedelta(days=rand.randint(0, 6000))
+        performers.write(rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES),
+                         "performer{}@example.com".format(performer_id),
+                         "555-{:04d}".format(performer_id % 10000),
+                         _date(joined), "",
+                         "{:.2f}".format(rand.uniform(20, 120)) if rand.random() < 0.5 else "",
+                         _words(rand, 2, 8))
+
+        pi_ids = [perf_instruments.write(performer_id, code)
+                  for code, name in rand.sample(INSTRUMENTS,
+                                                rand.randint(*INSTRUMENTS_PER_PERFORMER))]
+
+        for code in rand.sample(group_codes,
+                                min(len(group_codes),
+                                    rand.randint(*GROUPS_PER_PERFORMER))):
+            perf_groups.write(code, performer_id)
+            parts_by_group[code].extend(pi_ids)
+
+    ########## Music ##########
+
+    for name in PROVIDERS:
+        providers.write(name)
+
+    for name in GENRES:
+        genres.write(name)
+
+    # The sheets and files of each piece, by piece id.
+    piece_sheets = [None]
+    sheet_files = [None]
+
+    for piece_id in xrange(1, PIECES * scale + 1):
+        title = _words(rand, 2, 5).capitalize()
+        voicing = rand.choice(VOICINGS)
+        language = rand.choice(LANGUAGES)
+
+        pieces.write(title, 100000 + piece_id, rand.choice(COMPOSERS), "",
+                     rand.randint(1450, 1950), len(voicing), voicing, language,
+                     "A cappella", _words(rand, 8, 20), _words(rand, 8, 20),
+                     _words(rand, 5, 15))
+
+        for genre_id in rand.sample(xrange(1, len(GENRES) + 1),
+                                    rand.randint(*GENRES_PER_PIECE)):
+            piece_genres.write(genre_id, piece_id)
+
+        sheet_ids = []
+
+        for n in xrange(rand.randint(*SHEETS_PER_PIECE)):
+            sheet_id = sheets.write(piece_id,
+                                    "http://www.example.org/scores/{}-{}.pdf".format(piece_id, n),
+                                    rand.randint(1000, 60000),
+                                    "{} {}".format(rand.choice(FIRST_NAMES),
+                                                   rand.choice(LAST_NAMES)),
+                                    _words(rand, 3, 10), voicing, "a cappella",
+                                    language, rand.choice(KEYS),
+                                    rand.choice(TIMES), "Vocal score", "CPDL",
+                                    rand.randint(60, 900))
+            sheet_ids.append(sheet_id)
+
+            sheet_providers.write(sheet_id, rand.randint(1, len(PROVIDERS)))
+
+            if rand.random() < 0.1:
+                sheet_owners.write(sheet_id, rand.randint(1, owners.count))
+
+            sheet_files.append([audiofiles.write(sheet_id, rand.choice(FILE_TYPES),
+                                                 "All voices " + voicing,
+                                                 "http://www.example.org/audio/{}-{}.mid".format(sheet_id, f))
+                                for f in xrange(rand.randint(*FILES_PER_SHEET))])
+
+        piece_sheets.append(sheet_ids)
+
+    # Popular pieces are saved and programmed far more often than the rest.
+    popular = ZipfSampler(pieces.count, rand, zipf_s)
+
+    ########## Concerts ##########
+
+    for user_id in xrange(1, users.count + 1):
+        for c in xrange(rand.randint(*CONCERTS_PER_USER)):
+            group_code = rand.choice(group_codes)
+            concert_id = concerts.write(user_id, "Concert {}".format(concerts.count + 1),
+                                        _words(rand, 3, 8))
+
+            day = start + datetime.timedelta(days=rand.randint(0, 8000))
+            event_ids = []
+
+            for e in xrange(rand.randint(*EVENTS_PER_CONCERT)):
+                begins = datetime.datetime.combine(day + datetime.timedelta(days=e),
+                                                   datetime.time(19, 30))
+                event_ids.append(events.write(
+                    concert_id, "Concert {} night {}".format(concert_id, e + 1),
+                    rand.choice(LOCATIONS), begins.strftime("%b-%d-%Y-%H:%M"),
+                    (begins + datetime.timedelta(hours=2)).strftime("%b-%d-%Y-%H:%M"),
+                    _words(rand, 4, 12)))
+
+            parts = parts_by_group[group_code]
+
+            for piece_id in popular.distinct(rand.randint(*SHEETS_PER_CONCERT)):
+                cs_id = concert_sheets.write(rand.choice(piece_sheets[piece_id]),
+                                             concert_id,
+                                             rand.random() < 0.7)
+                group_sheets.write(group_code, cs_id)
+
+                if not parts:
+                    continue
+
+                for pi_id in rand.sample(parts, min(len(parts),
+                                                    rand.randint(*PARTS_PER_SHEET))):
+                    assignment_id = assignments.write(cs_id, pi_id)
+
+                    for event_id in event_ids:
+                        event_assignments.write(assignment_id, event_id,
+                                                _words(rand, 0, 5))
+
+    ########## Libraries ##########
+
+    for user_id in xrange(1, users.count + 1):
+        for piece_id in popular.distinct(rand.randint(*LIBRARY_PIECES)):
+            user_pieces.write(user_id, piece_id)
+
+            for sheet_id in piece_sheets[piece_id]:
+                if rand.random() < 0.5:
+                    user_sheets.write(user_id, sheet_id)
+
+                    for file_id in sheet_files[sheet_id]:
+                        if rand.random() < 0.5:
+                            user_files.write(user_id, file_id)
+
+    for data_file in files.values():
+        data_file.close()
+
+    return dict((name, data_file.count) for name, data_file in files.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate load test data.")
+    parser.add_argument("--scale", type=int, default=SCALE,
+                        help="size multiplier (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=SEED,
+                        help="random seed (default %(default)s)")
+    parser.add_argument("--zipf", type=float, default=ZIPF_S,
+                        help="popularity skew (default %(default)s)")
+    parser.add_argument("--out", required=True,
+                        help="directory to write the data files to")
+    parser.add_argument("--load", metavar="DB_URI",
+                        help="then bulk load them into this (empty) database")
+    args = parser.parse_args()
+
+    began = time.time()
+    counts = generate(args.out, args.scale, args.seed, args.zipf)
+
+    for name in sorted(counts):
+        print "{:<20} {:>12,}".format(name, counts[name])
+
+    print "{:<20} {:>12,} rows in {:.1f}s".format("TOTAL", sum(counts.values()),
+                                                 time.time() - began)
+
+    if args.load:
+        from server import app
+        from model import connect_to_db, db
+        from bulk_seed import bulk_load
+
+        connect_to_db(app, args.load)
+        db.create_all()
+        bulk_load(args.out)
@@ -0,0 +1,86 @@
+"""Process-local cache of genre names -> genre ids, used during ingestion."""
+
+import os
+import threading
+import time
+
+from model import Genre, db
+
+# Seconds before a worker reloads the whole dictionary from the database, so
+# it picks up genres other workers inserted (or an admin renamed/merged).
+GENRE_CACHE_TTL = int(os.environ.get("GENRE_CACHE_TTL", 5 * 60))
+
+
+def normalize_genre_name(name):
+    """Returns a genre name with the padding from CPDL's comma separated lists
+       (and any doubled-up inner whitespace) removed."""
+
+    return u" ".join(name.split())
+
+
+class GenreCache(object):
+    """Dictionary of normalized genre name -> genre_id.
+
+       Genres are a small, insert-only set, so a stale dictionary is safe: a
+       name it doesn't know falls through to the database, and the whole thing
+       is reloaded every GENRE_CACHE_TTL seconds (or on invalidate())."""
+
+    def __init__(self, ttl=GENRE_CACHE_TTL):
+        self.ttl = ttl
+        self._ids = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """(Re)loads every genre from the database - call at startup to warm
+           the cache."""
+
+        ids = {}
+
+        # Older rows may hold padded names; those and the clean name all map to
+        # the lowest genre_id, preferring a row that's already normalized.
+        for genre_id, name in (db.session.query(Genre.genre_id, Genre.name)
+                                         .order_by(Genre.genre_id)):
+            key = normalize_genre_name(name)
+            if key not in ids or (name == key and ids[key][1] != key):
+                ids[key] = (genre_id, name)
+
+        with self._lock:
+            self._ids = dict((key, value[0]) for key, value in ids.items())
+            self._loaded_at = time.time()
+
+    def invalidate(self):
+        """Drops the dictionary; it's reloaded on the next lookup."""
+
+        with self._lock:
+            self._ids = {}
+            self._loaded_at = None
+
+    def get(self, name):
+        """Returns the genre_id for name, or None if there's no such genre."""
+
+        if self._loaded_at is None or time.time() - self._loaded_at > self.ttl:
+            self.load()
+
+        name = normalize_genre_name(name)
+
+        genre_id = self._ids.get(name)
+
+        if genre_id is None:
+            # Another worker may have added it since we loaded.
+            genre = Genre.query.filter_by(name=name).first()
+            if genre:
+                genre_id = genre.genre_id
+                self.add(name, genre_id)
+
+        return genre_id
+
+    def add(self, name, genre_id):
+        """Records a newly committed genre."""
+
+        with self._lock:
+            self._ids[normalize_genre_name(name)] = genre_id
+
+
+# The genre dictionary shared by this process's ingestion.
+genre_cache = GenreCache()
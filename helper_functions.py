@@ -5,6 +5,10 @@ from jinja2 import StrictUndefined
 from flask import Flask, render_template, request, flash, redirect, session
 from flask_debugtoolbar import DebugToolbarExtension
 
+from sqlalchemy import exists, func, literal, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
 from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
                    PerformerGroup, Piece, SheetMusic, AudioFile, Provider,
                    GroupSheet, ConcertSheet, PerformerInstrument, Assignment,
@@ -12,207 +16,213 @@ from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
                    UserPiece, UserSheet, UserAudioFile, SheetMusicOwner,
                    connect_to_db, db)
 
-import requests
-# To get text from CPDL pages, need Beautiful Soup!!
-from bs4 import BeautifulSoup
-# For Beautiful Soup, need lxml's html
-from lxml import html
-# For Beautiful Soup, need regex
-import re
+# All requests to cpdl.org go through the pooled CPDL client.
+from cpdl import get_cpdl_json
+# Genre name -> id dictionary, so ingestion doesn't query for every genre.
+from genre_cache import genre_cache
+# Turns CPDL's page json into the fields we store (one lxml pass).
+from cpdl_parser import parse_page
+# Local full-text search & search box suggestions, kept current as pages are
+# ingested.
+import local_search
+from autocomplete import autocomplete_index
+# One fetch & parse per CPDL page, however many people ask for it at once.
+from single_flight import SingleFlight
 
 ####### HELPER FUNCTIONS USED IN SERVER.PY #####################################
 
 
-def parse_search_results(results):
-    """Converts search results page id and title data into a dictionary and
-       returns its items as a list of tuples."""
+def parse_page_results(results, pg_id):
+    """Parses a CPDL page's json and adds the piece, its genres, sheets and
+       files to the database. Returns the new piece_id."""
 
-    pages = results['query']['pages']
+    page = parse_page(results, pg_id)
 
-    data = {}
+    return add_parsed_page(page)
 
-    for page_id, page in pages.items():
-        title = page['title']
-        data[page_id] = title
 
-    return data.items()
+# CPDL pages being ingested by this process, by page_id.
+page_flights = SingleFlight()
 
+# First key of the Postgres advisory locks taken while ingesting a page (the
+# page_id is the second) - "CPDL" in ascii, so they're easy to spot in
+# pg_locks.
+PAGE_LOCK_SPACE = 0x4350444c
 
-def parse_page_results(results, pg_id):
-    """Returns each page's results."""
-    # Get the page title - abbreviated to pass into function.
-    ttl = results['parse']['title'].split("(")[0]
-    # Pull data from the page's html - first, get the page "text" from the json.
-    page_txt = results['parse']['text']['*']
-
-    # Make beautiful soup from page text's html
-    soup = BeautifulSoup(page_txt, "lxml")
-
-    # Abbreviated variables for brevity to pass into the function!
-    ol = None       # original_language
-    to = None       # text_original
-    te = None       # text_english
-    comp = 'Composer required'     # composer (not nullable!)
-    lrc = None      # lyricist
-    onv = None      # original_num_voices
-    ov = None       # original_voicing
-    # genre = None
-    oi = None       # original instrumentation
-    desc = None     # description
-    genres = []
-    # editors = []
-    # ed_notes = [] # edition_notes
-    # copyrights = []
-
-    # Get general info about the piece for PIECE table & GENRE table:
-    for b_tag in soup('b'):
-        if "Composer:" in b_tag.contents:
-            comp = b_tag.next_element.next_element.next_element.string
-        if "Lyricist:" in b_tag.contents:
-            lrc = b_tag.next_element.next_element.next_element.string
-        if "Number of voices:" in b_tag.contents:
-            onv = int((b_tag.next_element.next_element.string)
-                      .replace("vv", "").replace("v", ""))
-        if "Voicing:" in b_tag.contents or "Voicings:" in b_tag.contents:
-            ov = b_tag.parent.get_text().split(":")[2].split("Genre")[0]
-    ## GENRE IS A LIST, need to iterate & add each individually to GENRE table.
-        if "Genre:" in b_tag.contents:
-            cats = b_tag.parent.get_text().strip().split("Genre:")[-1]
-            genres = cats.split(",")
-        if "Language:" in b_tag.contents:
-            ol = b_tag.next_element.next_element.next_element.string
-        if "Instruments:" in b_tag.contents:
-            oi = b_tag.next_element.next_element.next_element.string
-        if "Description:" in b_tag.contents:
-            desc = b_tag.parent.get_text().replace("Description: ", '')
-
-    # Get the year published for PIECE table.
-    pb_yr = None
-
-    if soup.find('a', title=(re.compile("Category:\d\d\d\d works"))):
-        pb_yr = soup.find('a', title=(re.compile("Category:\d\d\d\d works"))).string
-
-    # Get the original language's text, if any provided, for PIECE table.
-    if soup.big and soup.big.contents[1]:
-        to = str(soup('div', 'poem', 'p')[0].p)
-
-    # Look to see if any text in English. If so, add related 'poem' to PIECE table.
-    if soup('big') and ol != 'English':
-        for i, big_tag in enumerate(soup('big')):
-            if 'English' in big_tag.contents[1]:
-                te = str(soup('div', 'poem', 'p')[i].p)
-
-    # Add the piece to Piece table and return the piece_id.
-    piece_id = add_piece(ttl, pg_id, comp, lrc, pb_yr, onv, ov, ol, oi, to, te, desc)
-
-    # If there were genre(s) on this page: make an empty list to hold genre id(s).
-    if genres:
-        genre_ids = []
-
-        # Check whether each genre already exists - if so, add id to list. If
-        # not, create it and add the id.
-        for name in genres:
-            if db.session.query(Genre.name).filter_by(name=name).first():
-                genre_id = db.session.query(Genre.genre_id).filter_by(name=name).first()
-                genre_ids.append(genre_id)
-            else:
-                genre_id = add_genre(name)
-                genre_ids.append(genre_id)
 
-        # Add piece & genre ids to the PieceGenre association table, if not there.
-        piece_genres = db.session.query(PieceGenre.genre_id).filter_by(piece_id=piece_id).all()
+def ingest_page(page_id):
+    """Returns the piece_id for a CPDL page, fetching, parsing and adding it
+       first if we don't have it yet. Raises CPDLUnavailable if CPDL can't be
+       reached.
 
-        for genre_id in genre_ids:
-            if genre_id not in piece_genres:
-                add_piece_genre(piece_id, genre_id)
+       However many requests ask for the same new page at once, it's fetched
+       and added once: within a process the callers share one call, and across
+       processes the page is locked (Postgres) or its unique page_id decides
+       (elsewhere)."""
 
-    ############ NEW - BETTER WAY TO GET CPDLs + ALL FILES ############
+    return page_flights.do(page_id, _ingest_page, page_id)
 
-    # The only place <li> tags are used is for CPDL bulleted list - so, grabbing
-    # all CPDL #s, file urls and edition info (for "Sheet" and "AudioFile" tables)
-    # based on whether the page has <li> tags.
 
-    # Cpdl numbers are the dictionary keys, and each edition's information will
-    # be the values: each pdf, [audiofile], [filetype], [url], editor, copyright,
-    # and edition notes associated with each CPDL number.
-    cpdl_dict = {}
+def _page_piece_id(page_id):
+    return (db.session.query(Piece.piece_id)
+                      .filter(Piece.page_id == page_id)
+                      .scalar())
 
-    if soup('li'):
-        for i, cpdl in enumerate(soup('li')):
-            if not cpdl.b:
-                continue
-            else:
-                cpdl_dict[i] = {'cpdl': cpdl.b.font.string,
-                                'files': []}
-                for a in cpdl.b.parent('a'):
-                    # Turns out there are both internal AND external pdf links, so
-                    # checking the class and then either adding the cpdl info or not.
-                    if 'internal' in a['class']:
-                        cpdl_dict[i]['files'].append((a['href'].split(".")[-1],
-                                                     "http://www1.cpdl.org" + a['href']))
-                    else:
-                        cpdl_dict[i]['files'].append((a['href'].split(".")[-1],
-                                                     a['href']))
-
-        print "\n\n\nFIRST DICT = CPDLS, URLS" + str(cpdl_dict)
-
-        # Since we know there were CPDL #s, grabbing the other info related to
-        # each edition of sheet music here, and adding to the edition_info list.
-        for j, dd in enumerate(soup('dd')):
-            # the text for each CPDL splits into 2 strings per CPDL #, so:
-            if not j % 2:
-                # Editor, Copyright('lic') @ even "i", so (i/2) gives correct dict key #
-                cpdl_dict[j/2]['editor'] = dd.get_text().split(":")[1].rstrip().split(" (")[0].strip()
-                cpdl_dict[j/2]['lic'] = dd.get_text().split(": ")[-1].strip()
-            if j % 2:
-                #  Edition notes @ odd "i"s, so ((i - 1 )/ 2) gives correct dict key #
-                cpdl_dict[(j-1)/2]['ednote'] = dd.get_text().split(":")[1].rstrip().split(" (")[0].strip()
-
-        # Use cpdl_dict to add Sheet & Files to the database. IGNORE any CPDL #
-        # edition that does not have a PDF as the first file!!! (ie, directs to
-        # another website, or etc - only want the editions w/a PDF of the music.)
-        print "\n\n\nSECOND CPDL DICT w/ED NOTES" + str(cpdl_dict)
-
-        for k, edition in enumerate(cpdl_dict):
-            if cpdl_dict[k]['files'][0][0] == 'pdf':
-                sheet_id = add_sheet(piece_id,
-                                     cpdl_dict[k]['files'][0][1],
-                                     cpdl_dict[k]['cpdl'],
-                                     cpdl_dict[k]['editor'],
-                                     cpdl_dict[k]['ednote'],
-                                     cpdl_dict[k]['lic'])
-                # Add the files for each sheet, if any.
-                if cpdl_dict[k]['files'][1]:
-                    for n, fle in enumerate(cpdl_dict[k]['files'][1:]):
-                        if len(cpdl_dict[k]['files'][n + 1][0]) < 5:
-                            (add_file(sheet_id,
-                                      cpdl_dict[k]['files'][n + 1][0],
-                                      cpdl_dict[k]['files'][n + 1][1]))
-                            print "Added {}".format(cpdl_dict[k]['files'][n + 1][1])
-    return piece_id
+
+def _ingest_page(page_id):
+    piece_id = _page_piece_id(page_id)
+
+    # Done reading - no transaction (or pooled connection) is held open
+    # through the CPDL round trip below.
+    db.session.commit()
+
+    if piece_id:
+        return piece_id
+
+    # Fetched & parsed before locking anything: CPDL can take many seconds.
+    page = parse_page(get_cpdl_json({'action': 'parse',
+                                     'format': 'json',
+                                     'pageid': page_id}), page_id)
+
+    try:
+        # Other processes writing this page wait here until we commit (or roll
+        # back), then find the piece on the check below - just for the write.
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(select([func.pg_advisory_xact_lock(PAGE_LOCK_SPACE,
+                                                                  page_id)]))
+
+            piece_id = _page_piece_id(page_id)
+
+            if piece_id:
+                db.session.commit()
+                return piece_id
+
+        return add_parsed_page(page)
+
+    except IntegrityError:
+        # Another process added the page while we were fetching it - use theirs.
+        db.session.rollback()
+        piece_id = _page_piece_id(page_id)
+
+        if not piece_id:
+            raise
+
+        return piece_id
+
+    except:
+        # Lets go of the lock.
+        db.session.rollback()
+        raise
+
+
+def add_parsed_page(page):
+    """Adds a ParsedPage (see cpdl_parser.parse_page) to the database and
+       returns the new piece_id."""
+
+    return add_parsed_pages([page])[0]
+
+
+def add_parsed_pages(pages):
+    """Adds a batch of ParsedPages to the database and returns their new
+       piece_ids, in order."""
+
+    # This is ONE unit of work: every piece, genre, sheet and file is built and
+    # added to the session, flushed once (to get the ids) and committed once -
+    # so a failure partway through leaves nothing half written.
+    new_genres = {}
+
+    try:
+        pieces = [add_parsed_page_objects(page, new_genres) for page in pages]
+
+        # One flush assigns every id, then one commit for the whole batch.
+        # (Read the ids before committing - the commit expires the objects.)
+        db.session.flush()
+        piece_ids = [piece.piece_id for piece in pieces]
+        genre_ids = dict(new_genres)
+        db.session.commit()
+
+    except:
+        db.session.rollback()
+        raise
+
+    # Only now that they're committed, remember the new genres' ids, and make
+    # the pieces searchable.
+    for name, genre_id in genre_ids.items():
+        genre_cache.add(name, genre_id)
+
+    local_search.add_pages(zip(piece_ids, pages))
+    autocomplete_index.add_pages(zip(piece_ids, pages))
+
+    return piece_ids
 
 ######### HELPER FUNCTIONS FOR THE ABOVE FUNCTIONS - NOT USED ELSEWHERE ########
 
 
+def add_parsed_page_objects(page, new_genres):
+    """Adds one ParsedPage's Piece, PieceGenres, Sheets and AudioFiles to the
+       session (the caller flushes & commits) and returns the Piece. new_genres
+       holds the ids of the genres added so far in this batch, by name."""
+
+    # Add the piece to the Piece table.
+    piece = add_piece(page.title, page.page_id, page.composer, page.lyricist,
+                      page.publication_year, page.original_num_voices,
+                      page.original_voicing, page.original_language,
+                      page.original_instrumentation, page.text_original,
+                      page.text_english, page.description)
+
+    # Link each of the page's genres to the piece, looking up ids in the genre
+    # cache and creating any genre that doesn't exist yet. (No autoflush, so a
+    # cache miss doesn't write the half-built batch out early.)
+    with db.session.no_autoflush:
+        linked = set()
+
+        for name in page.genres:
+            if name in linked:
+                continue
+
+            genre = new_genres.get(name) or genre_cache.get(name)
+
+            if not genre:
+                genre = new_genres[name] = add_genre(name)
+
+            add_piece_genre(piece, genre)
+            linked.add(name)
+
+    # Add each edition's Sheet, and the files for each sheet, if any.
+    for edition in page.editions:
+        sheet = add_sheet(piece,
+                          edition.music_url,
+                          edition.cpdl_num,
+                          edition.editor,
+                          edition.edition_notes,
+                          edition.license_type)
+
+        for audiofile in edition.files:
+            add_file(sheet, audiofile.file_type, audiofile.url)
+            print "Added {}".format(audiofile.url)
+
+    return piece
+
+
 def get_urls(filelist, num):
     """Takes names of all page's images, sorts them, sends arequest to cpdl, and
         returns each image's url, sorted to match the initial list's order."""
     # Puts the image filelist into the payload.
     payload = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'imageinfo',
         'titles': filelist,
         'iiprop': 'url',
     }
-    # Sends request to cpdl.org & captures the request's results as r4.
-    r4 = requests.get(
-        'http://www1.cpdl.org/wiki/api.php?action=query&format=json&prop=imageinfo',
-        params=payload,
-    )
+    # Sends request to cpdl.org & captures the request's json results as r4.
+    r4 = get_cpdl_json(payload)
 
     # Gets the url data from the results json and saves it as 'urls_raw'.
     urls_raw = []
 
     for i in range(num):
-        url = r4.json()['query']['pages'].values()[i-1]['imageinfo'][0]['url']
+        url = r4['query']['pages'].values()[i-1]['imageinfo'][0]['url']
         urls_raw.append(url)
     # Sort the urls to be in the same order as the file_tuples list
     urls = sorted(urls_raw, key=lambda x: x.split('/')[7])
@@ -221,7 +231,7 @@ def get_urls(filelist, num):
 
 
 def add_piece(ttl, pg_id, comp, lrc, pb_yr, onv, ov, ol, oi, to, te, desc):
-    """Adds piece to the database."""
+    """Adds piece to the session (the caller commits) and returns it."""
 
     piece = Piece(title=ttl,
                   page_id=pg_id,
@@ -239,44 +249,56 @@ def add_piece(ttl, pg_id, comp, lrc, pb_yr, onv, ov, ol, oi, to, te, desc):
     # Add to the session.
     db.session.add(piece)
 
-    # Commit the session/data to the dbase.
-    db.session.commit()
+    return piece
 
-    return piece.piece_id
+
+# Keyword making an INSERT skip rows that break a unique constraint, by
+# database (Postgres uses ON CONFLICT instead).
+INSERT_IGNORE = {'sqlite': 'OR IGNORE', 'mysql': 'IGNORE'}
 
 
 def add_genre(name):
-    """Adds genres to the database."""
+    """Adds a genre (the caller commits) and returns its genre_id. Written
+       straight away: if another ingest is adding the same new genre, this
+       waits for it and uses its row, rather than failing on the unique name."""
 
-    genre = Genre(name=name)
+    table = Genre.__table__
 
-    # Add to the session.
-    db.session.add(genre)
+    if db.engine.dialect.name == 'postgresql':
+        insert = (pg_insert(table).values(name=name)
+                                  .on_conflict_do_nothing(index_elements=[table.c.name]))
+    else:
+        insert = table.insert().values(name=name)
 
-    # Commit the session/data to the dbase.
-    db.session.commit()
+        if db.engine.dialect.name in INSERT_IGNORE:
+            insert = insert.prefix_with(INSERT_IGNORE[db.engine.dialect.name])
+
+    db.session.execute(insert)
 
-    return genre.genre_id
+    # Ours, or theirs.
+    return db.session.query(Genre.genre_id).filter(Genre.name == name).scalar()
 
 
-def add_piece_genre(piece_id, genre_id):
-    """Adds piece's genre association to the database."""
+def add_piece_genre(piece, genre):
+    """Adds piece's genre association to the session (the caller commits) and
+       returns it. genre is either a new Genre or an existing genre_id."""
 
-    piece_genre = PieceGenre(piece_id=piece_id,
-                             genre_id=genre_id)
+    if isinstance(genre, Genre):
+        piece_genre = PieceGenre(piece=piece,
+                                 genre=genre)
+    else:
+        piece_genre = PieceGenre(piece=piece,
+                                 genre_id=genre)
     # Add to the session.
     db.session.add(piece_genre)
 
-    # Commit the session/data to the dbase.
-    db.session.commit()
-
-    return piece_genre.pg_id
+    return piece_genre
 
 
-def add_sheet(pid, url, cpdl, ed, ednote, lic):
-    """Adds a sheet to the database."""
+def add_sheet(piece, url, cpdl, ed, ednote, lic):
+    """Adds a sheet to the session (the caller commits) and returns it."""
 
-    sheet = SheetMusic(piece_id=pid,
+    sheet = SheetMusic(piece=piece,
                        music_url=url,
                        cpdl_num=cpdl,
                        editor=ed,
@@ -286,26 +308,20 @@ def add_sheet(pid, url, cpdl, ed, ednote, lic):
     # Add to the session.
     db.session.add(sheet)
 
-    # Commit the session/data to the dbase.
-    db.session.commit()
-
-    return sheet.sheet_id
+    return sheet
 
 
-def add_file(sheet_id, file_type, url):
-    """Adds an AudioFile to the database."""
+def add_file(sheet, file_type, url):
+    """Adds an AudioFile to the session (the caller commits) and returns it."""
 
-    audiofile = AudioFile(sheet_id=sheet_id,
+    audiofile = AudioFile(sheet=sheet,
                           file_type=file_type,
                           url=url)
 
     # Add to the session.
     db.session.add(audiofile)
 
-    # Commit the session/data to the dbase.
-    db.session.commit()
-
-    return audiofile.file_id
+    return audiofile
 
 
 def add_sheet_provider(sheet_id, provider_id):
@@ -324,49 +340,55 @@ def add_sheet_provider(sheet_id, provider_id):
 
 
 ############ FUNCTIONS TO MANIPULATE THE DATABASE ###########################
-def add_piece_to_library(user_id, piece_id):
-    """Adds a UserPiece to the database, and the User's library (of pieces)."""
+def _add_one_to_library(model, id_name, user_id, item_id):
+    """Adds an item to the user's library (model is UserPiece, UserSheet or
+       UserAudioFile) and returns the row - or the one that's already there,
+       if it was added before (a double click, or two tabs)."""
 
-    userpiece = UserPiece(piece_id=piece_id,
-                          user_id=user_id)
+    def existing():
+        return model.query.filter(model.user_id == user_id,
+                                  getattr(model, id_name) == item_id).first()
+
+    row = existing()
+
+    if row:
+        return row
+
+    row = model(user_id=user_id, **{id_name: item_id})
 
     # Add to the session.
-    db.session.add(userpiece)
+    db.session.add(row)
 
     # Commit the session/data to the dbase.
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request added it since we looked - the unique index says so.
+        db.session.rollback()
+        row = existing()
 
-    return userpiece.up_id
+        if not row:
+            raise
 
+    return row
 
-def add_sheet_to_library(user_id, sheet_id):
-    """Adds a UserSheet to the database, and the User's library (of sheet music)."""
 
-    usersheet = UserSheet(sheet_id=sheet_id,
-                          user_id=user_id)
+def add_piece_to_library(user_id, piece_id):
+    """Adds a UserPiece to the database, and the User's library (of pieces)."""
 
-    # Add to the session.
-    db.session.add(usersheet)
+    return _add_one_to_library(UserPiece, 'piece_id', user_id, piece_id).up_id
 
-    # Commit the session/data to the dbase.
-    db.session.commit()
 
-    return usersheet.us_id
+def add_sheet_to_library(user_id, sheet_id):
+    """Adds a UserSheet to the database, and the User's library (of sheet music)."""
+
+    return _add_one_to_library(UserSheet, 'sheet_id', user_id, sheet_id).us_id
 
 
 def add_audiofile_to_library(user_id, file_id):
     """Adds a UserAudioFile to the database, and the User's library (of A/V files)."""
 
-    userfile = UserAudioFile(file_id=file_id,
-                             user_id=user_id)
-
-    # Add to the session.
-    db.session.add(userfile)
-
-    # Commit the session/data to the dbase.
-    db.session.commit()
-
-    return userfile.uaf_id
+    return _add_one_to_library(UserAudioFile, 'file_id', user_id, file_id).uaf_id
 
 
 def del_piece_from_library(user_id, piece_id):
@@ -409,6 +431,97 @@ def del_audiofile_from_library(user_id, file_id):
     # Commit the session/data to the dbase.
     db.session.commit()
 
+
+# kind -> (library table's model, its item id column, the item's model & id)
+LIBRARY_KINDS = {'piece': (UserPiece, 'piece_id', Piece.piece_id),
+                 'sheet': (UserSheet, 'sheet_id', SheetMusic.sheet_id),
+                 'file': (UserAudioFile, 'file_id', AudioFile.file_id)}
+
+
+def _add_to_library(model, id_name, item_id_col, user_id, item_ids):
+    """Adds the items in item_ids that exist and aren't in the user's library
+       yet, with one INSERT ... SELECT. Returns the number added."""
+
+    table = model.__table__
+    user_col = table.c.user_id
+    id_col = table.c[id_name]
+
+    items = (select([literal(user_id), item_id_col])
+             .where(item_id_col.in_(item_ids)))
+
+    if db.engine.dialect.name == 'postgresql':
+        # The unique (user_id, item id) index makes a concurrent double add
+        # a no-op, instead of an error.
+        insert = (pg_insert(table).from_select([user_col, id_col], items)
+                                  .on_conflict_do_nothing(index_elements=[user_col, id_col]))
+    else:
+        items = items.where(~exists().where(user_col == user_id)
+                                     .where(id_col == item_id_col))
+        insert = table.insert().from_select([user_col, id_col], items)
+
+    return db.session.execute(insert).rowcount
+
+
+def _del_from_library(model, id_name, user_id, item_ids):
+    """Removes the items in item_ids from the user's library, with one DELETE.
+       Returns the number removed."""
+
+    table = model.__table__
+
+    delete = (table.delete().where(table.c.user_id == user_id)
+                            .where(table.c[id_name].in_(item_ids)))
+
+    return db.session.execute(delete).rowcount
+
+
+def change_library(user_id, changes):
+    """Applies a batch of library changes - dicts of op ('add' or 'del'), kind
+       ('piece', 'sheet' or 'file') and id - in one transaction, with one
+       statement per op & kind. If an item is changed twice, the last change
+       wins. Returns {(op, kind): number of rows changed}. Raises ValueError
+       (before touching the database) for a malformed change."""
+
+    # (kind, id) -> op, so the last change to an item wins.
+    latest = {}
+
+    for change in changes:
+        try:
+            op, kind, item_id = change['op'], change['kind'], int(change['id'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Bad library change: {}".format(change))
+
+        if (op not in ('add', 'del') or not isinstance(kind, basestring) or
+                kind not in LIBRARY_KINDS):
+            raise ValueError("Bad library change: {}".format(change))
+
+        latest[(kind, item_id)] = op
+
+    # (op, kind) -> the ids to change
+    batches = {}
+
+    for (kind, item_id), op in latest.items():
+        batches.setdefault((op, kind), []).append(item_id)
+
+    counts = {}
+
+    try:
+        for (op, kind), item_ids in sorted(batches.items()):
+            model, id_name, item_id_col = LIBRARY_KINDS[kind]
+
+            if op == 'add':
+                counts[(op, kind)] = _add_to_library(model, id_name, item_id_col,
+                                                     user_id, item_ids)
+            else:
+                counts[(op, kind)] = _del_from_library(model, id_name,
+                                                       user_id, item_ids)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return counts
+
 #####################  OLD ATTEMPTS = DELETE? ##################################
 
     # ## Editors IS A LIST, need to iterate & add each individually to SHEET table.
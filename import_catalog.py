@@ -0,0 +1,351 @@
+"""Bulk import of CPDL pages into the music database.
+
+Takes CPDL page ids, search terms, and/or whole categories (e.g.
+"Category:Giovanni Pierluigi da Palestrina"), fetches the pages concurrently
+(with a rate limit, so we stay polite to cpdl.org), skips any page we already
+have, and parses & writes them in batches. Progress is saved to a checkpoint
+file after every batch, so an interrupted import picks up where it left off.
+
+    python import_catalog.py 3788 "Byrd" "Category:Thomas Tallis"
+    python import_catalog.py --file page_ids.txt --workers 8 --rate 4
+"""
+
+import argparse
+import json
+import os
+import Queue
+import threading
+import time
+
+from model import Piece, connect_to_db, db
+
+from cpdl import get_cpdl_json, CPDLUnavailable
+from cpdl_parser import parse_pages
+from genre_cache import genre_cache
+from helper_functions import add_parsed_pages
+
+# Defaults for the command line options.
+WORKERS = 6                 # concurrent fetches
+RATE = 5.0                  # max requests per second to cpdl.org
+BATCH_SIZE = 25             # pages parsed & committed together
+CHECKPOINT = "import_checkpoint.json"
+
+# Page ids per "WHERE page_id IN (...)" when checking what we already have.
+LOOKUP_CHUNK = 500
+
+
+class RateLimiter(object):
+    """Spaces out calls to wait() so they average at most rate per second,
+       across every thread that shares it."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until this caller's slot comes up."""
+
+        with self._lock:
+            now = time.time()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+########## FINDING THE PAGES TO IMPORT ######################################
+
+def search_page_ids(term, limiter):
+    """Returns the page ids of a CPDL search for term."""
+
+    limiter.wait()
+
+    results = get_cpdl_json({'action': 'query',
+                             'format': 'json',
+                             'prop': 'info',
+                             'generator': 'search',
+                             'gsrlimit': 'max',
+                             'gsrsearch': term})
+
+    return [int(page_id) for page_id in results.get('query', {}).get('pages', {})]
+
+
+def category_page_ids(category, limiter):
+    """Returns the page ids of every page in a CPDL category, following the
+       API's continuation until the category is exhausted."""
+
+    page_ids = []
+    params = {'action': 'query',
+              'format': 'json',
+              'list': 'categorymembers',
+              'cmtitle': category,
+              'cmtype': 'page',
+              'cmlimit': 'max'}
+
+    while True:
+        limiter.wait()
+
+        results = get_cpdl_json(params, use_cache=False)
+
+        for member in results.get('query', {}).get('categorymembers', []):
+            page_ids.append(member['pageid'])
+
+        if 'continue' not in results:
+            return page_ids
+
+        params.update(results['continue'])
+
+
+def resolve_page_ids(terms, limiter):
+    """Turns the command line's page ids, search terms and categories into one
+       de-duplicated list of page ids, in the order given."""
+
+    page_ids = []
+
+    for term in terms:
+        term = term.strip()
+
+        if not term:
+            continue
+        elif term.isdigit():
+            found = [int(term)]
+        elif term.startswith("Category:"):
+            found = category_page_ids(term, limiter)
+        else:
+            found = search_page_ids(term, limiter)
+
+        print "{}: {} page(s)".format(term, len(found))
+        page_ids.extend(found)
+
+    unique = []
+    seen = set()
+
+    for page_id in page_ids:
+        if page_id not in seen:
+            seen.add(page_id)
+            unique.append(page_id)
+
+    return unique
+
+
+def existing_page_ids(page_ids):
+    """Returns the set of page ids that are already in the Piece table."""
+
+    existing = set()
+
+    for i in range(0, len(page_ids), LOOKUP_CHUNK):
+        chunk = page_ids[i:i + LOOKUP_CHUNK]
+        rows = (db.session.query(Piece.page_id)
+                          .filter(Piece.page_id.in_(chunk))
+                          .all())
+        existing.update(page_id for page_id, in rows)
+
+    return existing
+
+
+########## CHECKPOINTS ######################################################
+
+def load_checkpoint(path):
+    """Returns the (done, failed) page id sets saved at path, if any."""
+
+    if not path or not os.path.exists(path):
+        return set(), set()
+
+    with open(path) as f:
+        saved = json.load(f)
+
+    return set(saved.get('done', [])), set(saved.get('failed', []))
+
+
+def save_checkpoint(path, done, failed):
+    """Saves progress at path (written to a temp file first, so an interrupt
+       mid-write can't corrupt it)."""
+
+    if not path:
+        return
+
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump({'done': sorted(done), 'failed': sorted(failed)}, f)
+
+    os.rename(tmp_path, path)
+
+
+########## FETCHING & IMPORTING #############################################
+
+def fetch_pages(page_ids, workers, limiter):
+    """Fetches each page's action=parse json using a pool of worker threads.
+       Yields (page_id, results) as they arrive - results is None if the page
+       couldn't be fetched."""
+
+    todo = Queue.Queue()
+    fetched = Queue.Queue(maxsize=workers * 4)
+
+    for page_id in page_ids:
+        todo.put(page_id)
+
+    def worker():
+        while True:
+            try:
+                page_id = todo.get_nowait()
+            except Queue.Empty:
+                return
+
+            limiter.wait()
+
+            try:
+                # Skip the response cache - a bulk import would just evict
+                # the pages our users are actually looking at.
+                results = get_cpdl_json({'action': 'parse',
+                                         'format': 'json',
+                                         'pageid': page_id},
+                                        use_cache=False)
+                if 'parse' not in results:
+                    results = None
+            except CPDLUnavailable as e:
+                print "Page {} failed: {}".format(page_id, e)
+                results = None
+            except Exception as e:
+                # Anything else (a bad response, etc) fails just this page -
+                # and the page must still be put, or the import waits for it
+                # forever.
+                print "Page {} failed: {!r}".format(page_id, e)
+                results = None
+
+            fetched.put((page_id, results))
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for i in range(len(page_ids)):
+        yield fetched.get()
+
+
+def import_pages(page_ids, workers=WORKERS, rate=RATE, batch_size=BATCH_SIZE,
+                 processes=1, checkpoint=CHECKPOINT):
+    """Fetches, parses and writes every page in page_ids that we don't have
+       yet. Returns the number of pages imported."""
+
+    done, failed = load_checkpoint(checkpoint)
+
+    # Skip what an earlier run finished, and anything already in the db.
+    todo = [page_id for page_id in page_ids if page_id not in done]
+    existing = existing_page_ids(todo)
+    todo = [page_id for page_id in todo if page_id not in existing]
+    done.update(existing)
+
+    print "{} page(s) to import ({} already in the db).".format(len(todo),
+                                                               len(existing))
+
+    limiter = RateLimiter(rate)
+    start = time.time()
+    imported = 0
+    batch = []
+
+    def write(batch):
+        try:
+            add_parsed_pages(parse_pages(batch, processes=processes))
+            written = [page_id for results, page_id in batch]
+
+        except Exception as e:
+            # One bad page (or one /page_search added while we fetched it)
+            # sinks its whole batch - so try the batch's pages one by one,
+            # and only the bad ones fail.
+            db.session.rollback()
+            print "Batch failed ({!r}), writing its pages one at a time.".format(e)
+            written = write_one_by_one(batch)
+
+        done.update(written)
+        failed.difference_update(written)
+        save_checkpoint(checkpoint, done, failed)
+
+        return len(written)
+
+    def write_one_by_one(batch):
+        written = []
+        existing = existing_page_ids([page_id for results, page_id in batch])
+
+        for results, page_id in batch:
+            if page_id in existing:
+                done.add(page_id)
+                failed.discard(page_id)
+                continue
+
+            try:
+                add_parsed_pages(parse_pages([(results, page_id)], processes=1))
+                written.append(page_id)
+            except Exception as e:
+                db.session.rollback()
+                print "Page {} failed: {!r}".format(page_id, e)
+                failed.add(page_id)
+
+        return written
+
+    for page_id, results in fetch_pages(todo, workers, limiter):
+        if results is None:
+            failed.add(page_id)
+            continue
+
+        batch.append((results, page_id))
+
+        if len(batch) >= batch_size:
+            imported += write(batch)
+            batch = []
+
+            elapsed = time.time() - start
+            print "{} page(s) imported, {:.1f} pages/sec".format(imported,
+                                                                 imported / elapsed)
+
+    if batch:
+        imported += write(batch)
+
+    save_checkpoint(checkpoint, done, failed)
+
+    elapsed = time.time() - start
+    print "Imported {} page(s) in {:.1f}s ({:.1f} pages/sec), {} failed.".format(
+        imported, elapsed, imported / elapsed if elapsed else 0, len(failed))
+
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import CPDL pages.")
+    parser.add_argument("terms", nargs="*",
+                        help="page ids, search terms, or Category:Names")
+    parser.add_argument("--file",
+                        help="file with more page ids / terms, one per line")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="concurrent fetches (default %(default)s)")
+    parser.add_argument("--rate", type=float, default=RATE,
+                        help="max requests per second (default %(default)s)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE,
+                        help="pages per commit (default %(default)s)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="parser processes per batch (default %(default)s)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT,
+                        help="progress file (default %(default)s)")
+    args = parser.parse_args()
+
+    terms = list(args.terms)
+
+    if args.file:
+        terms.extend(line.strip() for line in open(args.file))
+
+    from server import app
+    connect_to_db(app)
+    genre_cache.load()
+
+    page_ids = resolve_page_ids(terms, RateLimiter(args.rate))
+
+    import_pages(page_ids,
+                 workers=args.workers,
+                 rate=args.rate,
+                 batch_size=args.batch,
+                 processes=args.processes,
+                 checkpoint=args.checkpoint)
@@ -0,0 +1,228 @@
+"""Background import of CPDL pages, queued in the import_jobs table.
+
+The first person to open a piece we don't have yet used to wait while the
+whole CPDL page was fetched, parsed and written. Now /page_search queues the
+page (enqueue_import) and shows an "importing" page that polls
+import_status until a worker has done it. No broker - the table is the queue:
+
+    python import_queue.py --workers 2
+
+Workers claim the oldest ready job (SELECT ... FOR UPDATE SKIP LOCKED on
+PostgreSQL, so they never wait on each other), import it with ingest_page,
+and record the piece_id. When CPDL is unavailable a job is retried
+MAX_ATTEMPTS times, backing off; a job whose worker died is picked up again
+after JOB_TIMEOUT seconds (and failed, once it has had MAX_ATTEMPTS tries).
+
+Background imports are off unless IMPORT_IN_BACKGROUND=1 - with no workers
+running, queued pages would never be imported."""
+
+import argparse
+import multiprocessing
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from model import ImportJob, connect_to_db, db
+
+from cpdl import CPDLUnavailable
+from genre_cache import genre_cache
+from helper_functions import ingest_page
+
+# Whether /page_search hands new pages to the workers (otherwise it imports
+# them itself, while the user waits). Only turn it on where workers run.
+IMPORT_IN_BACKGROUND = os.environ.get("IMPORT_IN_BACKGROUND", "0") != "0"
+
+# Tries before a job is given up on, and seconds to wait after the nth failed
+# try before the next (RETRY_DELAY * n).
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 10
+
+# Seconds after which a running job is assumed lost (its worker died).
+JOB_TIMEOUT = int(os.environ.get("IMPORT_JOB_TIMEOUT", 300))
+
+# Ready jobs looked at per claim where rows can't be locked (SQLite).
+CLAIM_CANDIDATES = 5
+
+# Defaults for the command line options.
+WORKERS = 2                 # worker processes
+POLL = 0.5                  # seconds between looks at an empty queue
+
+# Jobs the app shows as still going.
+PENDING = ('queued', 'running')
+
+
+def enqueue_import(page_id):
+    """Queues a CPDL page for import, unless it's already queued or running.
+       (A page that failed, or was imported and has since been deleted, is
+       queued again.)"""
+
+    now = datetime.utcnow()
+
+    job = ImportJob.query.filter_by(page_id=page_id).first()
+
+    if job is None:
+        try:
+            db.session.add(ImportJob(page_id=page_id,
+                                     status='queued',
+                                     attempts=0,
+                                     queued_at=now,
+                                     run_after=now))
+            db.session.commit()
+        except IntegrityError:
+            # Someone else queued it first.
+            db.session.rollback()
+
+    elif job.status not in PENDING:
+        (ImportJob.query.filter_by(job_id=job.job_id, status=job.status)
+                        .update({'status': 'queued',
+                                 'attempts': 0,
+                                 'error': None,
+                                 'piece_id': None,
+                                 'queued_at': now,
+                                 'run_after': now},
+                                synchronize_session=False))
+        db.session.commit()
+
+
+def import_status(page_id):
+    """Returns a dict of the page's import status ('queued', 'running', 'done'
+       or 'failed'), piece_id and error - or None if it was never queued."""
+
+    row = (db.session.query(ImportJob.status, ImportJob.piece_id,
+                            ImportJob.error)
+                     .filter(ImportJob.page_id == page_id)
+                     .first())
+
+    return row._asdict() if row else None
+
+
+def claim_job():
+    """Takes the oldest ready job for this worker. Returns its (job_id,
+       page_id), or None if there's nothing to do."""
+
+    now = datetime.utcnow()
+    lost = and_(ImportJob.status == 'running',
+                ImportJob.started_at < now - timedelta(seconds=JOB_TIMEOUT))
+
+    # Lost jobs that have had all their tries are given up on, rather than
+    # handed to worker after worker (a page that kills whoever imports it).
+    (ImportJob.query.filter(lost, ImportJob.attempts >= MAX_ATTEMPTS)
+                    .update({'status': 'failed',
+                             'error': "Gave up: the import stopped {} times."
+                                      .format(MAX_ATTEMPTS),
+                             'finished_at': now},
+                            synchronize_session=False))
+
+    ready = or_(and_(ImportJob.status == 'queued',
+                     ImportJob.run_after <= now),
+                and_(lost, ImportJob.attempts < MAX_ATTEMPTS))
+
+    query = (db.session.query(ImportJob.job_id, ImportJob.page_id,
+                              ImportJob.status, ImportJob.attempts)
+                       .filter(ready)
+                       .order_by(ImportJob.job_id))
+
+    if db.engine.dialect.name == 'postgresql':
+        # Locked rows are other workers' - skip straight past them.
+        candidates = query.with_for_update(skip_locked=True).limit(1).all()
+    else:
+        # No row locks: try a few, in case another worker beats us to one.
+        candidates = query.limit(CLAIM_CANDIDATES).all()
+
+    for job_id, page_id, status, attempts in candidates:
+        # Only if nobody has claimed it since we looked.
+        claimed = (ImportJob.query.filter_by(job_id=job_id,
+                                             status=status,
+                                             attempts=attempts)
+                                  .update({'status': 'running',
+                                           'attempts': attempts + 1,
+                                           'started_at': now},
+                                          synchronize_session=False))
+
+        if claimed:
+            db.session.commit()
+            return job_id, page_id
+
+    db.session.commit()
+
+    return None
+
+
+def _finish(job_id, **values):
+    ImportJob.query.filter_by(job_id=job_id).update(values,
+                                                    synchronize_session=False)
+    db.session.commit()
+
+
+def run_job(job_id, page_id):
+    """Imports a claimed job's page and records how it went."""
+
+    try:
+        piece_id = ingest_page(page_id)
+
+    except CPDLUnavailable as e:
+        attempts = (db.session.query(ImportJob.attempts)
+                              .filter(ImportJob.job_id == job_id)
+                              .scalar())
+
+        if attempts < MAX_ATTEMPTS:
+            _finish(job_id,
+                    status='queued',
+                    error=str(e)[:1024],
+                    run_after=datetime.utcnow() +
+                              timedelta(seconds=RETRY_DELAY * attempts))
+        else:
+            _finish(job_id, status='failed', error=str(e)[:1024],
+                    finished_at=datetime.utcnow())
+
+    except Exception as e:
+        # Not CPDL's fault (a page we can't parse, etc) - trying again won't
+        # help.
+        db.session.rollback()
+        _finish(job_id, status='failed', error=repr(e)[:1024],
+                finished_at=datetime.utcnow())
+
+    else:
+        _finish(job_id, status='done', piece_id=piece_id, error=None,
+                finished_at=datetime.utcnow())
+
+
+def work(poll=POLL):
+    """Runs jobs as they come in, forever."""
+
+    from server import app
+    connect_to_db(app)
+    genre_cache.load()
+
+    while True:
+        job = claim_job()
+
+        if job:
+            run_job(*job)
+        else:
+            time.sleep(poll)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run CPDL import workers.")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="worker processes (default %(default)s)")
+    parser.add_argument("--poll", type=float, default=POLL,
+                        help="seconds between looks at an empty queue "
+                             "(default %(default)s)")
+    args = parser.parse_args()
+
+    # Each worker connects to the db itself, after the fork.
+    workers = [multiprocessing.Process(target=work, args=(args.poll,))
+               for i in range(args.workers)]
+
+    for worker in workers:
+        worker.start()
+
+    print "{} import worker(s) running.".format(len(workers))
+
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,52 @@
+"""Keyset pagination for long lists (dashboard groups & roster, the library).
+
+A page is "the next limit rows after this sort key", rather than OFFSET n:
+that stays fast however deep you page, and rows added meanwhile can't shift
+or repeat what's already been shown. The sort key of a page's last row is its
+cursor - a short json list, e.g. ["Chamber Singers", "CS"] - which the client
+passes back (as ?after=) for the next page.
+
+The sort columns must end in something unique (usually the id), and must not
+be nullable - NULLs don't compare.
+"""
+
+import json
+
+from sqlalchemy import and_, or_
+
+
+def after_key(columns, key):
+    """Filter for rows sorting after key on columns (a row-value comparison,
+       spelled out so it works on any database)."""
+
+    column, rest = columns[0], columns[1:]
+
+    if not rest:
+        return column > key[0]
+
+    return or_(column > key[0],
+               and_(column == key[0], after_key(rest, key[1:])))
+
+
+def keyset_page(query, columns, after=None, limit=25):
+    """Returns (rows, cursor) for the page of query, sorted by columns, after
+       the cursor `after`. query must select each of the columns. cursor is
+       None on the last page. Raises ValueError for a bad cursor."""
+
+    if after:
+        key = json.loads(after)
+
+        if not isinstance(key, list) or len(key) != len(columns):
+            raise ValueError("Bad cursor: {}".format(after))
+
+        query = query.filter(after_key(columns, key))
+
+    rows = query.order_by(*columns).limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+
+    return rows, json.dumps([getattr(last, column.key) for column in columns])
@@ -0,0 +1,82 @@
+"""Which pieces, sheets and files are in the logged in user's library.
+
+Pages show an Add / Remove button for every piece, sheet and audio file on
+them. Each of those used to walk the item's whole user_* collection (every
+user who ever saved it). Now the session user's saved ids are loaded once per
+request, as sets, so each button is a set lookup. Templates get the current
+request's LibraryMembership as `library`:
+
+    {% if sheet.sheet_id in library.sheet_ids %}
+"""
+
+from flask import g, session
+
+from model import UserPiece, UserSheet, UserAudioFile, db
+
+
+class LibraryMembership(object):
+    """The ids a user has saved. Each set is loaded the first time it's used,
+       so a page with only sheets on it never queries the user's pieces."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._piece_ids = None
+        self._sheet_ids = None
+        self._file_ids = None
+
+    def _load_ids(self, id_col, user_col):
+        """Returns the set of id_col values in the user's rows of a library
+           table (an empty set if no one is logged in)."""
+
+        if self.user_id is None:
+            return set()
+
+        return set(row_id for row_id, in (db.session.query(id_col)
+                                                     .filter(user_col == self.user_id)))
+
+    @property
+    def piece_ids(self):
+        if self._piece_ids is None:
+            self._piece_ids = self._load_ids(UserPiece.piece_id,
+                                             UserPiece.user_id)
+        return self._piece_ids
+
+    @property
+    def sheet_ids(self):
+        if self._sheet_ids is None:
+            self._sheet_ids = self._load_ids(UserSheet.sheet_id,
+                                             UserSheet.user_id)
+        return self._sheet_ids
+
+    @property
+    def file_ids(self):
+        if self._file_ids is None:
+            self._file_ids = self._load_ids(UserAudioFile.file_id,
+                                            UserAudioFile.user_id)
+        return self._file_ids
+
+    def has_piece(self, piece_id):
+        """Is this piece in the user's library?"""
+
+        return piece_id in self.piece_ids
+
+    def has_sheet(self, sheet_id):
+        """Is this sheet in the user's library?"""
+
+        return sheet_id in self.sheet_ids
+
+    def has_file(self, file_id):
+        """Is this audio file in the user's library?"""
+
+        return file_id in self.file_ids
+
+
+def current_library():
+    """Returns the session user's LibraryMembership for this request."""
+
+    library = getattr(g, '_library_membership', None)
+
+    if library is None or library.user_id != session.get("user_id"):
+        library = g._library_membership = LibraryMembership(session.get("user_id"))
+
+    return library
@@ -0,0 +1,66 @@
+"""Pages of a user's library, for /library and /library.json.
+
+A library can hold thousands of sheets, so it's served a keyset page at a
+time (see keyset.py), selecting only the columns the page shows - no model
+objects, no relationships walked per row."""
+
+from keyset import keyset_page
+
+from model import (Piece, SheetMusic, AudioFile, UserPiece, UserSheet,
+                   UserAudioFile, db)
+
+# Library items per page.
+PAGE_SIZE = 50
+
+# The kinds of item in a library.
+KINDS = ('pieces', 'sheets', 'files')
+
+# Ways to sort a library: the sort columns, ending with something unique.
+SORTS = {'title': (Piece.title, Piece.composer),
+         'composer': (Piece.composer, Piece.title)}
+
+
+def _pieces(user_id):
+    return (db.session.query(Piece.piece_id, Piece.title, Piece.composer)
+                      .join(UserPiece, UserPiece.piece_id == Piece.piece_id)
+                      .filter(UserPiece.user_id == user_id))
+
+
+def _sheets(user_id):
+    return (db.session.query(SheetMusic.sheet_id, Piece.title, Piece.composer,
+                             SheetMusic.edition_notes, SheetMusic.music_url)
+                      .join(UserSheet, UserSheet.sheet_id == SheetMusic.sheet_id)
+                      .join(Piece, Piece.piece_id == SheetMusic.piece_id)
+                      .filter(UserSheet.user_id == user_id))
+
+
+def _files(user_id):
+    return (db.session.query(AudioFile.file_id, Piece.title, Piece.composer,
+                             AudioFile.file_type, AudioFile.url)
+                      .join(UserAudioFile, UserAudioFile.file_id == AudioFile.file_id)
+                      .join(SheetMusic, SheetMusic.sheet_id == AudioFile.sheet_id)
+                      .join(Piece, Piece.piece_id == SheetMusic.piece_id)
+                      .filter(UserAudioFile.user_id == user_id))
+
+
+# kind -> (query of the user's items, the item's unique id column)
+_QUERIES = {'pieces': (_pieces, Piece.piece_id),
+            'sheets': (_sheets, SheetMusic.sheet_id),
+            'files': (_files, AudioFile.file_id)}
+
+
+def library_page(user_id, kind, sort='title', after=None, limit=PAGE_SIZE):
+    """Returns (items, cursor): a page of the user's pieces, sheets or files,
+       by title or composer, as dicts. Raises ValueError for an unknown kind
+       or sort, or a bad cursor."""
+
+    if kind not in _QUERIES or sort not in SORTS:
+        raise ValueError("Unknown library kind / sort: {} / {}".format(kind, sort))
+
+    make_query, id_col = _QUERIES[kind]
+
+    rows, cursor = keyset_page(make_query(user_id),
+                               SORTS[sort] + (id_col,),
+                               after, limit)
+
+    return [row._asdict() for row in rows], cursor
@@ -0,0 +1,114 @@
+"""Loads tables in foreign key order, as many at once as the order allows.
+
+The seed loaders used to run one after another, though most tables don't
+refer to each other - users, groups, owners, performers, instruments,
+providers and genres can all load at the same time, and so can their
+dependents once they're in. The order comes from model.py's foreign keys: a
+table starts as soon as every table it refers to has finished, each load in
+its own thread (and so on its own connection)."""
+
+import threading
+from collections import deque
+
+# Tables loaded at once, by default.
+WORKERS = 4
+
+
+def dependencies(tables):
+    """Returns {table name: names of the tables it has foreign keys to} for
+       the given sqlalchemy Tables (only counting those among them)."""
+
+    names = set(table.name for table in tables)
+
+    return dict((table.name,
+                 set(fk.column.table.name for fk in table.foreign_keys
+                     if fk.column.table.name in names and
+                        fk.column.table.name != table.name))
+                for table in tables)
+
+
+def levels(depends_on):
+    """Returns the tables in levels - lists of names, each needing only those
+       in earlier levels. Raises ValueError if the foreign keys go round in a
+       circle."""
+
+    done = set()
+    result = []
+
+    while len(done) < len(depends_on):
+        level = sorted(name for name, needs in depends_on.items()
+                       if name not in done and needs <= done)
+
+        if not level:
+            raise ValueError("Circular foreign keys between: {}".format(
+                ", ".join(sorted(set(depends_on) - done))))
+
+        result.append(level)
+        done.update(level)
+
+    return result
+
+
+def run_in_order(tasks, depends_on, workers=WORKERS):
+    """Runs tasks ({name: function}), each once those it depends on have
+       finished, up to workers at a time. Returns {name: what it returned}.
+       If one fails, no more are started, and its exception is raised once
+       those running finish."""
+
+    levels(depends_on)      # checks for cycles up front
+
+    waiting_on = dict((name, set(depends_on.get(name, ())) & set(tasks))
+                      for name in tasks)
+    ready = deque(sorted(name for name, needs in waiting_on.items() if not needs))
+    results = {}
+    errors = []
+    running = [0]
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                while not ready and running[0] and not errors:
+                    cond.wait()
+
+                if errors or not ready:
+                    cond.notify_all()
+                    return
+
+                name = ready.popleft()
+                running[0] += 1
+
+            try:
+                result = tasks[name]()
+            except Exception as e:
+                with cond:
+                    errors.append(e)
+                    running[0] -= 1
+                    cond.notify_all()
+                return
+
+            with cond:
+                results[name] = result
+                running[0] -= 1
+
+                # Whatever was only waiting for this one can go now.
+                for other, needs in waiting_on.items():
+                    if name in needs:
+                        needs.discard(name)
+                        if not needs and other not in results:
+                            ready.append(other)
+
+                cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
@@ -0,0 +1,305 @@
+"""Full-text search over the pieces we've already ingested.
+
+/search looks here before asking CPDL, so a search for anything already in
+our pieces table never leaves the building. Results are ranked (title and
+composer count most, then lyricist, then description and texts), and can be
+filtered by voicing, language and genre.
+
+On PostgreSQL this is a weighted tsvector with a GIN expression index on the
+pieces table (created along with the table, or by migrate_indexes.py), so it
+stays current as rows are written. Other databases (SQLite in development)
+get an in-process inverted index instead. It's built on first use, picks up
+other workers' new pieces every LOCAL_SEARCH_TTL seconds, and ingestion adds
+to it directly (add_pages)."""
+
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import DDL, event, func
+from sqlalchemy.dialects import postgresql
+
+from model import Genre, Piece, PieceGenre, db
+
+# Results returned per search.
+SEARCH_LIMIT = 50
+
+# One search result.
+SearchResult = namedtuple('SearchResult', ['piece_id', 'page_id', 'title',
+                                           'composer', 'rank'])
+
+# Seconds before the in-process index checks the db for pieces added by other
+# workers.
+LOCAL_SEARCH_TTL = int(os.environ.get("LOCAL_SEARCH_TTL", 60))
+
+# Ids below the highest we've seen that a refresh looks at again. Ids are
+# handed out at insert, not commit, so a slow transaction can commit a lower
+# id after a faster one's higher id has been seen.
+REFRESH_WINDOW = int(os.environ.get("REFRESH_WINDOW", 1000))
+
+# Postgres text search configuration.
+TS_CONFIG = 'english'
+
+# Searchable columns and their weight: Postgres weight class, and the score
+# each match is worth in the in-process index.
+SEARCH_FIELDS = (('title', 'A', 4.0),
+                 ('composer', 'A', 4.0),
+                 ('lyricist', 'B', 2.0),
+                 ('description', 'C', 1.0),
+                 ('text_original', 'D', 1.0),
+                 ('text_english', 'D', 1.0))
+
+
+################ POSTGRES ####################################################
+
+def search_vector():
+    """The weighted tsvector expression for a piece. The GIN index is built on
+       exactly this expression, so queries must use it verbatim."""
+
+    vector = None
+
+    for name, weight, score in SEARCH_FIELDS:
+        part = func.setweight(func.to_tsvector(TS_CONFIG,
+                                               func.coalesce(getattr(Piece, name), '')),
+                              weight)
+        vector = part if vector is None else vector.op('||')(part)
+
+    return vector
+
+
+def _search_index_ddl():
+    """CREATE INDEX statement for the search vector's GIN index."""
+
+    vector = search_vector().compile(dialect=postgresql.dialect(),
+                                     compile_kwargs={'literal_binds': True})
+
+    return ("CREATE INDEX IF NOT EXISTS ix_pieces_search ON pieces "
+            "USING gin (({}))".format(vector))
+
+
+def create_search_index(engine=None):
+    """Creates the pieces table's GIN search index if it's missing (Postgres
+       only - a no-op elsewhere)."""
+
+    engine = engine or db.engine
+
+    if engine.dialect.name == 'postgresql':
+        engine.execute(_search_index_ddl())
+
+
+# New Postgres databases get the index along with the pieces table.
+event.listen(Piece.__table__, 'after_create',
+             DDL(_search_index_ddl()).execute_if(dialect='postgresql'))
+
+
+def _postgres_search(terms):
+    """Query of (piece_id, rank) for the pieces matching every word in
+       terms."""
+
+    query = func.plainto_tsquery(TS_CONFIG, terms)
+    vector = search_vector()
+    rank = func.ts_rank(vector, query).label('rank')
+
+    return (db.session.query(Piece.piece_id, rank)
+                      .filter(vector.op('@@')(query)))
+
+
+############ IN-PROCESS INVERTED INDEX #######################################
+
+# Words too common to be worth indexing.
+STOP_WORDS = frozenset("a an and are as at be by de del der di du for from "
+                       "in is it la le of on or the to with".split())
+
+TAG_RE = re.compile(r"<[^>]+>")
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fold(text):
+    """Returns text lowercased, with accents folded ("Pr\u00e9s" -> "pres")."""
+
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+
+    text = unicodedata.normalize('NFKD', text.lower())
+
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Returns the searchable words in text: html stripped, folded, and stop
+       words dropped."""
+
+    if not text:
+        return []
+
+    return [word for word in WORD_RE.findall(fold(TAG_RE.sub(' ', text)))
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+class InvertedIndex(object):
+    """word -> {piece_id: score} over the SEARCH_FIELDS of every piece."""
+
+    def __init__(self, ttl=LOCAL_SEARCH_TTL):
+        self.ttl = ttl
+        self._postings = defaultdict(dict)
+        self._indexed = set()
+        self._max_id = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _add(self, row):
+        """Indexes one row of (piece_id, *SEARCH_FIELDS). Caller holds the
+           lock."""
+
+        piece_id = row[0]
+
+        if piece_id in self._indexed:
+            return
+
+        for (name, weight, score), text in zip(SEARCH_FIELDS, row[1:]):
+            for word in tokenize(text):
+                postings = self._postings[word]
+                postings[piece_id] = postings.get(piece_id, 0) + score
+
+        self._indexed.add(piece_id)
+
+    def refresh(self):
+        """Indexes any pieces added to the db since we last looked."""
+
+        columns = [Piece.piece_id] + [getattr(Piece, name)
+                                      for name, weight, score in SEARCH_FIELDS]
+
+        # (Pieces already indexed are skipped by _add.)
+        rows = (db.session.query(*columns)
+                          .filter(Piece.piece_id > self._max_id - REFRESH_WINDOW)
+                          .order_by(Piece.piece_id)
+                          .all())
+
+        with self._lock:
+            for row in rows:
+                self._add(row)
+                self._max_id = max(self._max_id, row[0])
+            self._checked_at = time.time()
+
+    def add_pages(self, pages):
+        """Indexes newly committed pieces - (piece_id, ParsedPage) pairs. (They
+           don't move the refresh point on: other workers may have committed
+           lower ids meanwhile, which the next refresh still has to find.)"""
+
+        # Not built yet - the first search loads everything anyway.
+        if self._checked_at is None:
+            return
+
+        with self._lock:
+            for piece_id, page in pages:
+                self._add([piece_id] + [getattr(page, name)
+                                        for name, weight, score in SEARCH_FIELDS])
+
+    def clear(self):
+        """Forgets everything; rebuilt from the db on the next search."""
+
+        with self._lock:
+            self._postings = defaultdict(dict)
+            self._indexed = set()
+            self._max_id = 0
+            self._checked_at = None
+
+    def search(self, terms):
+        """Returns {piece_id: score} for the pieces containing every word in
+           terms, scored by tf-idf."""
+
+        if self._checked_at is None or time.time() - self._checked_at > self.ttl:
+            self.refresh()
+
+        words = set(tokenize(terms))
+
+        if not words:
+            return {}
+
+        with self._lock:
+            postings = [self._postings.get(word, {}) for word in words]
+            total = float(len(self._indexed)) or 1.0
+
+            # Rarest word first, so the intersection starts small.
+            postings.sort(key=len)
+            scores = dict((piece_id, 0.0) for piece_id in postings[0])
+
+            for posting in postings:
+                idf = math.log(1 + total / (len(posting) or 1))
+
+                for piece_id in scores.keys():
+                    if piece_id in posting:
+                        scores[piece_id] += posting[piece_id] * idf
+                    else:
+                        del scores[piece_id]
+
+        return scores
+
+
+# This process's index, for databases without Postgres full-text search.
+search_index = InvertedIndex()
+
+
+#################### SEARCHING ###############################################
+
+def _filter(query, voicing=None, language=None, genre=None):
+    """Adds the voicing / language (substring, any case) and genre (exact name)
+       filters to a query of pieces."""
+
+    if voicing:
+        query = query.filter(Piece.original_voicing.ilike(u"%{}%".format(voicing)))
+
+    if language:
+        query = query.filter(Piece.original_language.ilike(u"%{}%".format(language)))
+
+    if genre:
+        query = query.filter(Piece.piece_id.in_(
+            db.session.query(PieceGenre.piece_id)
+                      .join(Genre, Genre.genre_id == PieceGenre.genre_id)
+                      .filter(Genre.name == genre)))
+
+    return query
+
+
+def search_pieces(terms, voicing=None, language=None, genre=None,
+                  limit=SEARCH_LIMIT):
+    """Returns up to limit pieces matching every word in terms, best first, as
+       SearchResults."""
+
+    columns = (Piece.piece_id, Piece.page_id, Piece.title, Piece.composer)
+
+    if db.engine.dialect.name == 'postgresql':
+        matches = _filter(_postgres_search(terms),
+                          voicing, language, genre).subquery()
+
+        rows = (db.session.query(*columns + (matches.c.rank,))
+                          .join(matches, matches.c.piece_id == Piece.piece_id)
+                          .order_by(matches.c.rank.desc(), Piece.title)
+                          .limit(limit))
+
+        return [SearchResult(*row) for row in rows]
+
+    scores = search_index.search(terms)
+
+    if not scores:
+        return []
+
+    rows = (_filter(db.session.query(*columns), voicing, language, genre)
+            .filter(Piece.piece_id.in_(scores.keys()))
+            .all())
+
+    rows.sort(key=lambda row: (-scores[row.piece_id], row.title))
+
+    return [SearchResult(*row + (scores[row.piece_id],)) for row in rows[:limit]]
+
+
+def add_pages(pages):
+    """Makes newly committed pieces - (piece_id, ParsedPage) pairs - searchable
+       straight away. (Postgres indexes them itself.)"""
+
+    if db.engine.dialect.name != 'postgresql':
+        search_index.add_pages(pages)
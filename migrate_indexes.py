@@ -0,0 +1,151 @@
+"""Brings an existing music database up to date with the indexes and unique
+constraints declared in model.py.
+
+New databases get them from db.create_all(). Older ones can hold rows that
+break the new unique rules, so first this removes duplicate library rows and
+merges genres that only differ by whitespace. Then it creates each missing
+index. Duplicate user emails and CPDL page ids can't be merged safely, so
+they're reported and that table's unique index is skipped until they're fixed
+by hand. Tables added since (import_jobs) are created too. It's safe to run
+more than once.
+
+    python migrate_indexes.py
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import func, inspect
+
+from model import (Genre, PieceGenre, Piece, User, UserPiece, UserSheet,
+                   UserAudioFile, connect_to_db, db)
+
+from genre_cache import normalize_genre_name
+from local_search import create_search_index
+
+
+def delete_duplicates(model, id_col, *cols):
+    """Deletes all but the first (lowest id) row for each combination of cols.
+       Returns the number of rows deleted."""
+
+    keepers = (db.session.query(func.min(id_col))
+                         .group_by(*cols)
+                         .subquery())
+
+    deleted = (model.query.filter(~id_col.in_(keepers))
+                          .delete(synchronize_session=False))
+
+    if deleted:
+        print "{}: removed {} duplicate row(s)".format(model.__tablename__, deleted)
+
+    return deleted
+
+
+def merge_genres():
+    """Merges genres whose names only differ by whitespace (" Madrigals" vs
+       "Madrigals") into the lowest genre_id, and normalizes the names."""
+
+    by_name = defaultdict(list)
+
+    for genre in Genre.query.order_by(Genre.genre_id):
+        by_name[normalize_genre_name(genre.name)].append(genre)
+
+    merged = 0
+
+    for name, genres in by_name.items():
+        keeper = genres[0]
+
+        for genre in genres[1:]:
+            (PieceGenre.query.filter_by(genre_id=genre.genre_id)
+                             .update({'genre_id': keeper.genre_id},
+                                     synchronize_session=False))
+            db.session.delete(genre)
+            merged += 1
+
+        keeper.name = name
+
+    if merged:
+        print "genres: merged {} duplicate genre(s)".format(merged)
+
+    return merged
+
+
+def find_duplicates(column):
+    """Returns the values of column that appear more than once."""
+
+    return [value for value, count in
+            (db.session.query(column, func.count())
+                       .filter(column.isnot(None))
+                       .group_by(column)
+                       .having(func.count() > 1))]
+
+
+def create_missing_indexes(skip=()):
+    """Creates every index declared in model.py that isn't in the database yet,
+       except those named in skip. Returns the names created."""
+
+    inspector = inspect(db.engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing or index.name in skip:
+                continue
+
+            print "Creating index {}".format(index.name)
+            index.create(bind=db.engine)
+            created.append(index.name)
+
+    return created
+
+
+def migrate():
+    """Creates any missing tables, cleans up duplicate rows, then creates the
+       missing indexes."""
+
+    # Tables new to this database - created along with their indexes.
+    db.metadata.create_all(bind=db.engine, checkfirst=True)
+
+    # Library rows: each user saves a piece / sheet / file once.
+    delete_duplicates(UserPiece, UserPiece.up_id,
+                      UserPiece.user_id, UserPiece.piece_id)
+    delete_duplicates(UserSheet, UserSheet.us_id,
+                      UserSheet.user_id, UserSheet.sheet_id)
+    delete_duplicates(UserAudioFile, UserAudioFile.uaf_id,
+                      UserAudioFile.user_id, UserAudioFile.file_id)
+
+    # Genres: merge padded duplicates, then any piece now linked twice.
+    merge_genres()
+    delete_duplicates(PieceGenre, PieceGenre.pg_id,
+                      PieceGenre.piece_id, PieceGenre.genre_id)
+
+    db.session.commit()
+
+    # These need a person to decide which row wins.
+    skip = []
+
+    emails = find_duplicates(User.email)
+    if emails:
+        print "SKIPPING ix_users_email - duplicate emails: {}".format(emails)
+        skip.append('ix_users_email')
+
+    page_ids = find_duplicates(Piece.page_id)
+    if page_ids:
+        print "SKIPPING ix_pieces_page_id - duplicate page ids: {}".format(page_ids)
+        skip.append('ix_pieces_page_id')
+
+    created = create_missing_indexes(skip)
+
+    # The full-text search index is an expression index, so it isn't in
+    # the model's metadata. (Postgres only.)
+    create_search_index()
+
+    print "Done: created {} index(es).".format(len(created))
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    migrate()
@@ -24,7 +24,7 @@ class User(db.Model):
                         nullable=False)
     fname = db.Column(db.String(48), nullable=False)
     lname = db.Column(db.String(48), nullable=False)
-    email = db.Column(db.String(100), nullable=False)
+    email = db.Column(db.String(100), nullable=False, unique=True, index=True)
     password = db.Column(db.String(25), nullable=False)
     title = db.Column(db.String(128))
     phone = db.Column(db.String(48))
@@ -134,9 +134,11 @@ class PerformerInstrument(db.Model):
                       primary_key=True,
                       autoincrement=True)
     performer_id = db.Column(db.Integer,
-                             db.ForeignKey('performers.performer_id'))
+                             db.ForeignKey('performers.performer_id'),
+                             index=True)
     instrument_code = db.Column(db.String(48),
-                                db.ForeignKey('instruments.instrument_code'))
+                                db.ForeignKey('instruments.instrument_code'),
+                                index=True)
 
     # Define a relationship w/Performer class via performer_id foreign key.
     performer = db.relationship('Performer', backref='performer_instruments')
@@ -163,10 +165,12 @@ class PerformerGroup(db.Model):
                               autoincrement=True)
     group_code = db.Column(db.String(48),
                            db.ForeignKey('groups.group_code'),
-                           nullable=False)
+                           nullable=False,
+                           index=True)
     performer_id = db.Column(db.Integer,
                              db.ForeignKey('performers.performer_id'),
-                             nullable=False)
+                             nullable=False,
+                             index=True)
 
     # Define a relationship w/Group class via group_code foreign key.
     group = db.relationship('Group', backref='performer_groups')
@@ -211,7 +215,7 @@ class Piece(db.Model):
     title = db.Column(db.String(150), nullable=False)
     # page_id = this is from CPDL API, they have "page id" that is useful! create
     # a disparate "page id" system for uploads, like initial letter(s)? #########
-    page_id = db.Column(db.Integer)
+    page_id = db.Column(db.Integer, unique=True, index=True)
     composer = db.Column(db.String(248), nullable=False)
     lyricist = db.Column(db.String(248))
     publication_year = db.Column(db.String(56))
@@ -227,13 +231,11 @@ class Piece(db.Model):
     def is_users_piece(self, user_id):
         """checks if a user is associated with this piece."""
 
-        is_found = False
-
-        for upiece in self.user_pieces:
-            if upiece.user_id == user_id:
-                is_found = True
+        # Asks the db about just this user's row, rather than loading every
+        # user who saved it. (Templates use library_membership instead.)
+        query = UserPiece.query.filter_by(user_id=user_id, piece_id=self.piece_id)
 
-        return is_found
+        return db.session.query(query.exists()).scalar()
 
     # define repr function to print some useful info re:db objects.
     def __repr__(self):
@@ -254,7 +256,8 @@ class SheetMusic(db.Model):
                          autoincrement=True)
     # ASK = OK for this FK to be nullable? (piece not yet owned/borrowed...)
     piece_id = db.Column(db.Integer,
-                         db.ForeignKey('pieces.piece_id'))
+                         db.ForeignKey('pieces.piece_id'),
+                         index=True)
     music_url = db.Column(db.String(248))
     cpdl_num = db.Column(db.String(10))
     editor = db.Column(db.String(248))
@@ -282,13 +285,11 @@ class SheetMusic(db.Model):
     def is_users_sheet(self, user_id):
         """checks if a user is associated with this sheet."""
 
-        is_found = False
+        # Asks the db about just this user's row, rather than loading every
+        # user who saved it. (Templates use library_membership instead.)
+        query = UserSheet.query.filter_by(user_id=user_id, sheet_id=self.sheet_id)
 
-        for usheet in self.user_sheets:
-            if usheet.user_id == user_id:
-                is_found = True
-
-        return is_found
+        return db.session.query(query.exists()).scalar()
 
     # define repr function to print some useful info re:db objects.
     def __repr__(self):
@@ -308,7 +309,8 @@ class AudioFile(db.Model):
                         autoincrement=True)
     sheet_id = db.Column(db.Integer,
                          db.ForeignKey('sheets.sheet_id'),
-                         nullable=False)
+                         nullable=False,
+                         index=True)
     file_type = db.Column(db.String(48),
                           nullable=False)
     voicing_details = db.Column(db.String(248))
@@ -321,13 +323,11 @@ class AudioFile(db.Model):
     def is_users_file(self, user_id):
         """checks if a user is associated with this file."""
 
-        is_found = False
-
-        for ufile in self.user_files:
-            if ufile.user_id == user_id:
-                is_found = True
+        # Asks the db about just this user's row, rather than loading every
+        # user who saved it. (Templates use library_membership instead.)
+        query = UserAudioFile.query.filter_by(user_id=user_id, file_id=self.file_id)
 
-        return is_found
+        return db.session.query(query.exists()).scalar()
 
     # define repr function to print some useful info re:db objects.
     def __repr__(self):
@@ -347,7 +347,9 @@ class Genre(db.Model):
                          primary_key=True,
                          autoincrement=True)
     name = db.Column(db.String(248),
-                     nullable=False)
+                     nullable=False,
+                     unique=True,
+                     index=True)
 
     # define repr function to print some useful info re:db objects.
     def __repr__(self):
@@ -361,12 +363,17 @@ class PieceGenre(db.Model):
 
     __tablename__ = "piece_genres"
 
+    # Each genre is linked to a piece once - this also indexes piece_id.
+    __table_args__ = (db.Index('ix_piece_genres_piece_id_genre_id',
+                               'piece_id', 'genre_id', unique=True),)
+
     #create the db columns.
     pg_id = db.Column(db.Integer,
                       primary_key=True,
                       autoincrement=True)
     genre_id = db.Column(db.Integer,
-                         db.ForeignKey('genres.genre_id'))
+                         db.ForeignKey('genres.genre_id'),
+                         index=True)
     piece_id = db.Column(db.Integer,
                          db.ForeignKey('pieces.piece_id'))
 
@@ -394,7 +401,8 @@ class Concert(db.Model):
                            autoincrement=True)
     user_id = db.Column(db.Integer,
                         db.ForeignKey('users.user_id'),
-                        nullable=False)
+                        nullable=False,
+                        index=True)
     name = db.Column(db.String(128),
                      nullable=False)
     description = db.Column(db.String(2048))
@@ -423,10 +431,12 @@ class ConcertSheet(db.Model):
                       autoincrement=True)
     sheet_id = db.Column(db.Integer,
                          db.ForeignKey('sheets.sheet_id'),
-                         nullable=False)
+                         nullable=False,
+                         index=True)
     concert_id = db.Column(db.Integer,
                            db.ForeignKey('concerts.concert_id'),
-                           nullable=False)
+                           nullable=False,
+                           index=True)
     sheet_finalized = db.Column(db.Boolean)
 
     # Define a relationship w/Sheet class via sheet_id foreign key.
@@ -454,10 +464,12 @@ class GroupSheet(db.Model):
                       autoincrement=True)
     group_code = db.Column(db.String(48),
                            db.ForeignKey('groups.group_code'),
-                           nullable=False)
+                           nullable=False,
+                           index=True)
     cs_id = db.Column(db.Integer,
                       db.ForeignKey('concert_sheets.cs_id'),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
 
     # Define a relationship w/Group class via group_code foreign key.
     group = db.relationship('Group', backref='group_sheets')
@@ -483,7 +495,8 @@ class Event(db.Model):
                          primary_key=True,
                          autoincrement=True)
     concert_id = db.Column(db.Integer,
-                           db.ForeignKey('concerts.concert_id'))
+                           db.ForeignKey('concerts.concert_id'),
+                           index=True)
     name = db.Column(db.String(128))
     location = db.Column(db.String(256))
     start_day_time = db.Column(db.DateTime)
@@ -513,9 +526,11 @@ class Assignment(db.Model):
                               autoincrement=True)
     cs_id = db.Column(db.Integer,
                       db.ForeignKey('concert_sheets.cs_id'),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
     pi_id = db.Column(db.Integer,
-                      db.ForeignKey('performer_instruments.pi_id'))
+                      db.ForeignKey('performer_instruments.pi_id'),
+                      index=True)
 
     # Define a relationship w/SheetMusic class via sheet_id foreign key.
     concert_sheet = db.relationship('ConcertSheet', backref='assignments')
@@ -544,10 +559,12 @@ class EventAssignment(db.Model):
                              autoincrement=True)
     assignment_id = db.Column(db.Integer,
                               db.ForeignKey('assignments.assignment_id'),
-                              nullable=False)
+                              nullable=False,
+                              index=True)
     event_id = db.Column(db.Integer,
                          db.ForeignKey('events.event_id'),
-                         nullable=False)
+                         nullable=False,
+                         index=True)
     notes = db.Column(db.String(248))
 
     # Define a relationship w/Assignment class via assignment_id foreign key.
@@ -575,9 +592,11 @@ class SheetMusicProvider(db.Model):
                            primary_key=True,
                            autoincrement=True)
     sheet_id = db.Column(db.Integer,
-                         db.ForeignKey('sheets.sheet_id'))
+                         db.ForeignKey('sheets.sheet_id'),
+                         index=True)
     provider_id = db.Column(db.Integer,
-                            db.ForeignKey('providers.provider_id'))
+                            db.ForeignKey('providers.provider_id'),
+                            index=True)
 
     # Define a relationship w/SheetMusic class via sheet_id foreign key.
     sheet = db.relationship('SheetMusic', backref='sheet_providers')
@@ -602,9 +621,11 @@ class SheetMusicOwner(db.Model):
                             primary_key=True,
                             autoincrement=True)
     sheet_id = db.Column(db.Integer,
-                         db.ForeignKey('sheets.sheet_id'))
+                         db.ForeignKey('sheets.sheet_id'),
+                         index=True)
     owner_id = db.Column(db.Integer,
-                         db.ForeignKey('owners.owner_id'))
+                         db.ForeignKey('owners.owner_id'),
+                         index=True)
 
     # Define a relationship w/Sheet class via sheet_id foreign key.
     sheet = db.relationship('SheetMusic', backref='sheet_owners')
@@ -626,6 +647,10 @@ class UserPiece(db.Model):
 
     __tablename__ = "user_pieces"
 
+    # A user saves each piece once - this also indexes the user's library.
+    __table_args__ = (db.Index('ix_user_pieces_user_id_piece_id',
+                               'user_id', 'piece_id', unique=True),)
+
     # create the db columns.
     up_id = db.Column(db.Integer,
                       primary_key=True,
@@ -635,7 +660,8 @@ class UserPiece(db.Model):
                         nullable=False)
     piece_id = db.Column(db.Integer,
                          db.ForeignKey('pieces.piece_id'),
-                         nullable=False)
+                         nullable=False,
+                         index=True)
 
     # Define a relationship w/User class via user_id foreign key.
     user = db.relationship('User', backref='user_pieces')
@@ -656,6 +682,10 @@ class UserSheet(db.Model):
 
     __tablename__ = "user_sheets"
 
+    # A user saves each sheet once - this also indexes the user's library.
+    __table_args__ = (db.Index('ix_user_sheets_user_id_sheet_id',
+                               'user_id', 'sheet_id', unique=True),)
+
     # create the db columns.
     us_id = db.Column(db.Integer,
                       primary_key=True,
@@ -665,7 +695,8 @@ class UserSheet(db.Model):
                         nullable=False)
     sheet_id = db.Column(db.Integer,
                          db.ForeignKey('sheets.sheet_id'),
-                         nullable=False)
+                         nullable=False,
+                         index=True)
 
     # Define a relationship w/User class via user_id foreign key.
     user = db.relationship('User', backref='user_sheets')
@@ -687,6 +718,10 @@ class UserAudioFile(db.Model):
 
     __tablename__ = "user_files"
 
+    # A user saves each file once - this also indexes the user's library.
+    __table_args__ = (db.Index('ix_user_files_user_id_file_id',
+                               'user_id', 'file_id', unique=True),)
+
     # create the db columns.
     uaf_id = db.Column(db.Integer,
                        primary_key=True,
@@ -696,7 +731,8 @@ class UserAudioFile(db.Model):
                         nullable=False)
     file_id = db.Column(db.Integer,
                         db.ForeignKey('audiofiles.file_id'),
-                        nullable=False)
+                        nullable=False,
+                        index=True)
 
     # Define a relationship w/User class via user_id foreign key.
     user = db.relationship('User', backref='user_files')
@@ -712,6 +748,42 @@ class UserAudioFile(db.Model):
                                                   self.file.file_type)
 
 
+class ImportJob(db.Model):
+    """A CPDL page queued for import by the background workers
+       (import_queue.py) - one job per page."""
+
+    __tablename__ = "import_jobs"
+
+    # Workers look for the oldest jobs that are ready to run.
+    __table_args__ = (db.Index('ix_import_jobs_status_job_id',
+                               'status', 'job_id'),)
+
+    # create the db columns.
+    job_id = db.Column(db.Integer,
+                       primary_key=True,
+                       autoincrement=True)
+    page_id = db.Column(db.Integer, nullable=False, unique=True)
+    # queued, running, done or failed.
+    status = db.Column(db.String(16), nullable=False)
+    # Set once the page has been imported.
+    piece_id = db.Column(db.Integer,
+                         db.ForeignKey('pieces.piece_id'))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(1024))
+    queued_at = db.Column(db.DateTime, nullable=False)
+    # Not run before this (retries back off).
+    run_after = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    # define repr function to print some useful info re:db objects.
+    def __repr__(self):
+        """Print more useful info."""
+        return "<ImportJob job_id=%d page_id=%d status=%s>" % (self.job_id,
+                                                              self.page_id,
+                                                              self.status)
+
+
 # End Part 1
 
 
@@ -728,11 +800,11 @@ def init_app():
 
 
 # Configure to use our PostgreSQL database.
-def connect_to_db(app):
+def connect_to_db(app, db_uri='postgres:///music'):
     """Connect the database to our Flask app."""
 
     # Configure to use our database.
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///music'
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
     app.config['SQLALCHEMY_ECHO'] = False
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.app = app
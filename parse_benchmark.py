@@ -0,0 +1,339 @@
+"""Micro-benchmarks the CPDL page parser on a corpus of saved pages.
+
+fixtures/cpdl_pages holds CPDL action=parse responses (page_<page_id>.json,
+the same files cpdl_stub.py --fixtures serves), from small to huge, and
+expected/ the ParsedPage each should parse to. This times parse_page on each
+- parsing alone, no database - reports its peak memory (each page parsed in a
+process of its own), and checks every field against the expected output:
+
+    python parse_benchmark.py
+    python parse_benchmark.py --repeat 200 --out parse.json
+    python parse_benchmark.py --writes      # also time the database writes
+
+After changing the parser, the check says whether it still gets the same
+fields out of every page; if a change is meant to alter them, look over the
+differences and then save the new output with --update-expected.
+
+The expected output was saved by this parser (--update-expected), so "ok"
+means a page parses as it did then - not that it was right. When it was
+saved, it was checked once against the BeautifulSoup parser this one
+replaced: every field of all five pages matched, once genre names were
+cleaned up the same way. That parser crashes on the edition lists of four
+of the pages, so their editions were checked against a copy of it with
+those crashes patched.
+
+The pages so far were made by hand in CPDL's page markup (cpdl.org couldn't
+be reached when the corpus was started). Add real ones with
+
+    python parse_benchmark.py --record 3788 10945 --update-expected
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from glob import glob
+from timeit import default_timer
+
+from cpdl_parser import parse_page
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "fixtures", "cpdl_pages")
+
+# Default options.
+REPEAT = 50                 # parses of each page timed
+
+
+def page_path(corpus_dir, page_id):
+    return os.path.join(corpus_dir, "page_{}.json".format(page_id))
+
+
+def expected_path(corpus_dir, page_id):
+    return os.path.join(corpus_dir, "expected", "page_{}.json".format(page_id))
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """Returns [(page_id, size in bytes, json response)] for each saved page,
+       smallest first."""
+
+    corpus = []
+
+    for path in glob(os.path.join(corpus_dir, "page_*.json")):
+        with open(path) as f:
+            raw = f.read()
+
+        page_id = int(os.path.basename(path)[len("page_"):-len(".json")])
+        corpus.append((page_id, len(raw), json.loads(raw)))
+
+    return sorted(corpus, key=lambda page: (page[1], page[0]))
+
+
+def as_json(parsed):
+    """A ParsedPage as plain dicts and lists, for saving and comparing."""
+
+    if hasattr(parsed, '_asdict'):
+        return dict((field, as_json(value))
+                    for field, value in parsed._asdict().items())
+
+    if isinstance(parsed, (tuple, list)):
+        return [as_json(value) for value in parsed]
+
+    return parsed
+
+
+def save_json(path, data):
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write(unicode(json.dumps(data, indent=1, sort_keys=True,
+                                   ensure_ascii=False)))
+
+
+def differences(expected, actual, where="page"):
+    """Returns a description of each place actual differs from expected."""
+
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        found = []
+        for key in sorted(set(expected) | set(actual)):
+            found.extend(differences(expected.get(key), actual.get(key),
+                                     "{}.{}".format(where, key)))
+        return found
+
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return ["{}: {} items, expected {}".format(where, len(actual),
+                                                       len(expected))]
+        found = []
+        for i, (old, new) in enumerate(zip(expected, actual)):
+            found.extend(differences(old, new, "{}[{}]".format(where, i)))
+        return found
+
+    if expected != actual:
+        return [u"{}: {!r}, expected {!r}".format(where, actual, expected)]
+
+    return []
+
+
+def check(corpus, corpus_dir=CORPUS_DIR, update=False):
+    """Parses each page and compares it with its expected output (or, with
+       update, saves the output as expected). Returns {page_id: differences}
+       for the pages that don't match."""
+
+    failures = {}
+
+    for page_id, size, results in corpus:
+        actual = as_json(parse_page(results, page_id))
+        path = expected_path(corpus_dir, page_id)
+
+        if update:
+            save_json(path, actual)
+            continue
+
+        if not os.path.exists(path):
+            failures[page_id] = ["no expected output - run with --update-expected"]
+            continue
+
+        with open(path) as f:
+            found = differences(json.load(f), actual)
+
+        if found:
+            failures[page_id] = found
+
+    return failures
+
+
+############ TIMING & MEMORY #################################################
+
+def time_parse(results, page_id, repeat=REPEAT):
+    """Returns the seconds each of repeat parses of a page took, sorted."""
+
+    times = []
+
+    for i in xrange(repeat):
+        began = default_timer()
+        parse_page(results, page_id)
+        times.append(default_timer() - began)
+
+    return sorted(times)
+
+
+def parse_memory(corpus_dir, page_id):
+    """Returns the kB of memory parsing a page takes at its peak (above what
+       the process held before), measured in a new process."""
+
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      "--corpus", corpus_dir,
+                                      "--memory-of", str(page_id)])
+    return int(output.split()[-1])
+
+
+def _peak_memory():
+    """This process's peak resident memory so far, in kB."""
+
+    # Linux's VmHWM starts afresh in a new process. (ru_maxrss carries over
+    # the peak of the process that started it, so it's only the fallback.)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # (In bytes on macOS.)
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _report_memory(corpus_dir, page_id):
+    # (In the new process.) The parse's own peak is how far it pushes the
+    # process's peak past where it was with the json loaded.
+    with open(page_path(corpus_dir, page_id)) as f:
+        results = json.load(f)
+
+    before = _peak_memory()
+    parse_page(results, page_id)
+    after = _peak_memory()
+
+    print after - before
+
+
+def time_writes(corpus, repeat):
+    """Returns {page_id: sorted seconds} for adding each parsed page to a new
+       SQLite database, repeat times (under new page_ids)."""
+
+    from server import app
+    from model import connect_to_db, db
+    from helper_functions import add_parsed_page
+
+    work_dir = tempfile.mkdtemp(prefix="quirify_parse_")
+    connect_to_db(app, "sqlite:///" + os.path.join(work_dir, "writes.db"))
+
+    times = {}
+
+    with app.app_context():
+        db.create_all()
+
+        parsed = [parse_page(results, page_id) for page_id, size, results in corpus]
+
+        # (add_parsed_page prints each file it adds - not to the report.)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+
+        try:
+            for i in xrange(repeat):
+                for page in parsed:
+                    copy = page._replace(page_id=page.page_id * 1000 + i)
+
+                    began = default_timer()
+                    add_parsed_page(copy)
+                    times.setdefault(page.page_id, []).append(default_timer() - began)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    return dict((page_id, sorted(seconds)) for page_id, seconds in times.items())
+
+
+############ RECORDING #######################################################
+
+def record(page_ids, corpus_dir=CORPUS_DIR):
+    """Saves CPDL's parse response for each page to the corpus."""
+
+    from cpdl import get_cpdl_json
+
+    for page_id in page_ids:
+        results = get_cpdl_json({'action': 'parse',
+                                 'format': 'json',
+                                 'pageid': page_id}, use_cache=False)
+
+        if 'parse' not in results:
+            print "No page {} on CPDL - skipped.".format(page_id)
+            continue
+
+        save_json(page_path(corpus_dir, page_id), results)
+        print "Saved page {}: {}".format(page_id, results['parse']['title'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CPDL page parser.")
+    parser.add_argument("--corpus", default=CORPUS_DIR,
+                        help="directory of saved pages (default fixtures/cpdl_pages)")
+    parser.add_argument("--repeat", type=int, default=REPEAT,
+                        help="timed parses of each page (default %(default)s)")
+    parser.add_argument("--writes", action="store_true",
+                        help="also time adding each parsed page to a database")
+    parser.add_argument("--out", help="save the results to this json file")
+    parser.add_argument("--update-expected", action="store_true",
+                        help="save the parser's output as the expected output")
+    parser.add_argument("--record", type=int, nargs="+", metavar="PAGE_ID",
+                        help="first save these pages from CPDL to the corpus")
+    parser.add_argument("--memory-of", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.memory_of:
+        _report_memory(args.corpus, args.memory_of)
+        sys.exit()
+
+    if args.record:
+        record(args.record, args.corpus)
+
+    corpus = load_corpus(args.corpus)
+
+    if not corpus:
+        raise SystemExit("No pages in {}".format(args.corpus))
+
+    failures = check(corpus, args.corpus, args.update_expected)
+
+    if args.update_expected:
+        print "Saved the expected output of {} pages.".format(len(corpus))
+
+    writes = time_writes(corpus, args.repeat) if args.writes else {}
+
+    print
+    print "{:<8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9}  {}".format(
+        "page", "size kB", "sheets", "min ms", "p50 ms", "max ms", "peak kB",
+        "write ms", "check")
+
+    pages = {}
+
+    for page_id, size, results in corpus:
+        times = time_parse(results, page_id, args.repeat)
+        parsed = parse_page(results, page_id)
+
+        pages[page_id] = {"title": parsed.title,
+                          "bytes": size,
+                          "sheets": len(parsed.editions),
+                          "files": sum(len(edition.files) for edition in parsed.editions),
+                          "min_ms": 1000 * times[0],
+                          "p50_ms": 1000 * times[len(times) // 2],
+                          "max_ms": 1000 * times[-1],
+                          "peak_kb": parse_memory(args.corpus, page_id),
+                          "matches_expected": page_id not in failures}
+
+        if page_id in writes:
+            pages[page_id]["write_p50_ms"] = 1000 * writes[page_id][len(writes[page_id]) // 2]
+
+        page = pages[page_id]
+        print "{:<8} {:>9.1f} {:>8} {:>8.2f} {:>8.2f} {:>8.2f} {:>9} {:>9}  {}".format(
+            page_id, size / 1024.0, page["sheets"], page["min_ms"],
+            page["p50_ms"], page["max_ms"], page["peak_kb"],
+            "{:.2f}".format(page["write_p50_ms"]) if "write_p50_ms" in page else "-",
+            "ok" if page["matches_expected"] else "DIFFERENT")
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump({"repeat": args.repeat, "pages": pages}, out, indent=2,
+                      sort_keys=True)
+
+    if failures:
+        print
+
+        for page_id in sorted(failures):
+            print "Page {} doesn't parse as expected:".format(page_id)
+            for difference in failures[page_id]:
+                print u"    {}".format(difference).encode('utf-8')
+
+        sys.exit(1)
@@ -0,0 +1,98 @@
+"""Eager-loading options for each detail page.
+
+A detail route fetches one object, and then its template walks the object's
+relationships (sheet.sheet_owners[].owner, sheet.audiofiles...). Left lazy,
+each of those is another query - per edition, per file, per performer. These
+profiles load everything a page's template touches up front, so a page renders
+in the same handful of queries however much hangs off it:
+
+    sheet = SheetMusic.query.options(*SHEET_PAGE).get(sheet_id)
+
+Collections use subqueryload (one extra query per collection, however many
+rows); single related objects use joinedload (no extra query). Keep each
+profile in step with its template when either changes.
+
+tests.py renders each page on a small SQLite database, with 1 and with 20 of
+everything hanging off it, and checks it takes the same number of queries
+both times and no more than its QUERY_LIMITS - so a template that starts
+walking a relationship its profile doesn't load gets caught:
+
+    python tests.py
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, subqueryload
+
+from model import db
+
+
+############ PROFILES, BY PAGE ###############################################
+
+# piece_page.html - the piece, its genres and its sheets.
+PIECE_PAGE = (subqueryload('piece_genres').joinedload('genre'),
+              subqueryload('sheets'))
+
+# sheet_page.html - the sheet, its piece, owners, providers and audio files.
+SHEET_PAGE = (joinedload('piece'),
+              subqueryload('sheet_owners').joinedload('owner'),
+              subqueryload('sheet_providers').joinedload('provider'),
+              subqueryload('audiofiles'))
+
+# concert_page.html - the concert's events, then (queried separately) each of
+# its ConcertSheets with the piece, the group singing it and its assignments.
+CONCERT_PAGE = (subqueryload('events'),)
+
+CONCERT_PAGE_SHEETS = (joinedload('sheet').joinedload('piece'),
+                       subqueryload('group_sheets').joinedload('group'),
+                       subqueryload('assignments'))
+
+# group_page.html - the group's concerts (via group_sheets) and their events.
+GROUP_PAGE = (subqueryload('group_sheets')
+              .joinedload('concert_sheet')
+              .joinedload('concert')
+              .subqueryload('events'),)
+
+# performer_page.html - the performer's PerformerGroups & PerformerInstruments.
+PERFORMER_PAGE_GROUPS = (joinedload('group'),)
+
+PERFORMER_PAGE_INSTRUMENTS = (joinedload('instrument'),)
+
+# (user.html selects just the columns it shows - see dashboard.py.)
+
+# Most queries each page may take, with its profile (checked in tests.py).
+# The same however much hangs off the object - if one goes up, a lazy load
+# has crept back in.
+QUERY_LIMITS = {"/users/{}": 9,
+                "/pieces/{}": 5,
+                "/sheets/{}": 6,
+                "/concerts/{}": 5,
+                "/groups/{}": 4,
+                "/performers/{}": 3}
+
+
+############ COUNTING QUERIES ################################################
+
+@contextmanager
+def count_queries(engine=None):
+    """Counts the SQL statements run inside the with block:
+
+           with count_queries() as queries:
+               ...
+           print queries[0]
+    """
+
+    engine = engine or db.engine
+    queries = [0]
+
+    def before_cursor_execute(*args):
+        queries[0] += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+    try:
+        yield queries
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
@@ -1,6 +1,8 @@
 """Utility file to seed music database from test data files that I created. """
 
+import argparse
 import datetime
+import os
 # from sqlalchemy import func
 
 from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
@@ -12,13 +14,19 @@ from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
 
 from server import app
 
+import bulk_seed
+from load_order import WORKERS, dependencies, run_in_order
+
+# Where the data files are (--data-dir).
+DATA_DIR = bulk_seed.DATA_DIR
+
 
 def load_users():
     """Load users from user.txt into database."""
 
     print "Users"
 
-    for i, row in enumerate(open("data/user.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "user.txt"))):
         row = row.rstrip()
         fname, lname, email, password, title, phone = row.split(", ")
 
@@ -40,7 +48,7 @@ def load_groups():
 
     print "Groups"
 
-    for i, row in enumerate(open("data/group.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "group.txt"))):
         row = row.rstrip()
 
         group_code, name, description, end, start = row.split(", ")
@@ -70,7 +78,7 @@ def load_owners():
 
     print "Owners"
 
-    for i, row in enumerate(open("data/owner.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "owner.txt"))):
         row = row.rstrip()
 
         name, contact = row.split(", ")
@@ -90,7 +98,7 @@ def load_performers():
 
     print "Performers"
 
-    for i, row in enumerate(open("data/performer.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "performer.txt"))):
         row = row.rstrip()
 
         fname, lname, email, phone, start, end, rate, notes = row.split("| ")
@@ -129,7 +137,7 @@ def load_instruments():
 
     print "Instruments"
 
-    for i, row in enumerate(open("data/instrument.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "instrument.txt"))):
         row = row.rstrip()
 
         instrument_code, name = row.split(", ")
@@ -149,7 +157,7 @@ def load_performer_instruments():
 
     print "Performer Instruments"
 
-    for i, row in enumerate(open("data/perfinstrument.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "perfinstrument.txt"))):
         row = row.rstrip()
 
         performer_id, instrument_code = row.split(", ")
@@ -169,7 +177,7 @@ def load_performer_groups():
 
     print "Performer Group"
 
-    for i, row in enumerate(open("data/perfgroup.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "perfgroup.txt"))):
         row = row.rstrip()
 
         group_code, performer_id = row.split(", ")
@@ -189,7 +197,7 @@ def load_providers():
 
     print "Providers"
 
-    for i, name in enumerate(open("data/provider.txt")):
+    for i, name in enumerate(open(os.path.join(DATA_DIR, "provider.txt"))):
         name = name.rstrip()
 
         provider = Provider(name=name)
@@ -206,7 +214,7 @@ def load_pieces():
 
     print "Pieces"
 
-    for i, row in enumerate(open("data/piece.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "piece.txt"))):
         row = row.rstrip()
 
         title, pg_id, comp, lyr, pub_yr, onv, ov, lang, oi, to, te, d = row.split(", ")
@@ -236,7 +244,7 @@ def load_sheets():
 
     print "Sheet Music"
 
-    for i, row in enumerate(open("data/sheet.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "sheet.txt"))):
         row = row.rstrip()
 
         (pid, url, cpdl, ed, edn, vc, inst,
@@ -268,7 +276,7 @@ def load_audiofiles():
 
     print "Audio Files"
 
-    for i, row in enumerate(open("data/audiofile.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "audiofile.txt"))):
         row = row.rstrip()
 
         sheet_id, file_type, voicing, url = row.split(", ")
@@ -290,7 +298,7 @@ def load_genres():
 
     print "Genres"
 
-    for i, name in enumerate(open("data/genre.txt")):
+    for i, name in enumerate(open(os.path.join(DATA_DIR, "genre.txt"))):
         name = name.rstrip()
 
         genre = Genre(name=name)
@@ -307,7 +315,7 @@ def load_piecegenres():
 
     print "Piece-genres"
 
-    for i, row in enumerate(open("data/piecegenre.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "piecegenre.txt"))):
         row = row.rstrip()
 
         genre_id, piece_id = row.split(", ")
@@ -327,7 +335,7 @@ def load_concerts():
 
     print "Concerts"
 
-    for i, row in enumerate(open("data/concert.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "concert.txt"))):
         row = row.rstrip()
 
         user_id, name, description = row.split(", ")
@@ -348,7 +356,7 @@ def load_concert_sheets():
 
     print "Concert Sheets"
 
-    for i, row in enumerate(open("data/consheet.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "consheet.txt"))):
         row = row.rstrip()
 
         sheet_id, concert_id, sheet_finalized = row.split("| ")
@@ -369,7 +377,7 @@ def load_group_sheets():
 
     print "Setlists"
 
-    for i, row in enumerate(open("data/grpsheet.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "grpsheet.txt"))):
         row = row.rstrip()
 
         group_code, cs_id = row.split("| ")
@@ -388,7 +396,7 @@ def load_events():
 
     print "Events"
 
-    for i, row in enumerate(open("data/event.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "event.txt"))):
         row = row.rstrip()
 
         concert_id, name, location, start, end, logistics = row.split("| ")
@@ -415,7 +423,7 @@ def load_assignments():
 
     print "Assignments"
 
-    for i, row in enumerate(open("data/assignment.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "assignment.txt"))):
         row = row.rstrip()
 
         cs_id, pi_id = row.split(", ")
@@ -435,7 +443,7 @@ def load_event_assignments():
 
     print "Event Assignments"
 
-    for i, row in enumerate(open("data/evtassign.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "evtassign.txt"))):
         row = row.rstrip()
 
         assignment_id, event_id, notes = row.split("|")
@@ -456,7 +464,7 @@ def load_sheet_providers():
 
     print "Sheet Providers"
 
-    for i, row in enumerate(open("data/sheetprovider.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "sheetprovider.txt"))):
         row = row.rstrip()
 
         sheet_id, provider_id = row.split(", ")
@@ -476,7 +484,7 @@ def load_sheet_owners():
 
     print "Sheet Owners"
 
-    for i, row in enumerate(open("data/sheetowner.txt")):
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "sheetowner.txt"))):
         row = row.rstrip()
 
         sheet_id, owner_id = row.split(", ")
@@ -490,6 +498,115 @@ def load_sheet_owners():
     # Commit the session/data to the dbase.
     db.session.commit()
 
+
+def load_user_pieces():
+    """Load users' saved pieces from userpiece.txt into database."""
+
+    print "User Pieces"
+
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "userpiece.txt"))):
+        row = row.rstrip()
+
+        user_id, piece_id = row.split(", ")
+
+        userpiece = UserPiece(user_id=user_id,
+                              piece_id=piece_id)
+
+        # Add to the session.
+        db.session.add(userpiece)
+
+    # Commit the session/data to the dbase.
+    db.session.commit()
+
+
+def load_user_sheets():
+    """Load users' saved sheet music from usersheet.txt into database."""
+
+    print "User Sheets"
+
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "usersheet.txt"))):
+        row = row.rstrip()
+
+        user_id, sheet_id = row.split(", ")
+
+        usersheet = UserSheet(user_id=user_id,
+                              sheet_id=sheet_id)
+
+        # Add to the session.
+        db.session.add(usersheet)
+
+    # Commit the session/data to the dbase.
+    db.session.commit()
+
+
+def load_user_files():
+    """Load users' saved audio files from userfile.txt into database."""
+
+    print "User Files"
+
+    for i, row in enumerate(open(os.path.join(DATA_DIR, "userfile.txt"))):
+        row = row.rstrip()
+
+        user_id, file_id = row.split(", ")
+
+        userfile = UserAudioFile(user_id=user_id,
+                                 file_id=file_id)
+
+        # Add to the session.
+        db.session.add(userfile)
+
+    # Commit the session/data to the dbase.
+    db.session.commit()
+
+
+# Each table's loader.
+LOADERS = {'users': load_users,
+           'groups': load_groups,
+           'owners': load_owners,
+           'performers': load_performers,
+           'instruments': load_instruments,
+           'performer_instruments': load_performer_instruments,
+           'performer_groups': load_performer_groups,
+           'providers': load_providers,
+           'pieces': load_pieces,
+           'sheets': load_sheets,
+           'audiofiles': load_audiofiles,
+           'genres': load_genres,
+           'piece_genres': load_piecegenres,
+           'concerts': load_concerts,
+           'concert_sheets': load_concert_sheets,
+           'group_sheets': load_group_sheets,
+           'events': load_events,
+           'assignments': load_assignments,
+           'event_assignments': load_event_assignments,
+           'sheet_providers': load_sheet_providers,
+           'sheet_owners': load_sheet_owners,
+           'user_pieces': load_user_pieces,
+           'user_sheets': load_user_sheets,
+           'user_files': load_user_files}
+
+
+def load_all(workers=WORKERS):
+    """Runs every loader, each once the tables it refers to are loaded, up to
+       workers at once (see load_order.py)."""
+
+    # SQLite takes one writer at a time.
+    if db.engine.dialect.name == 'sqlite':
+        workers = 1
+
+    def in_thread(load):
+        def run():
+            try:
+                load()
+            finally:
+                # This thread's session & connection.
+                db.session.remove()
+        return run
+
+    run_in_order(dict((name, in_thread(load)) for name, load in LOADERS.items()),
+                 dependencies([db.metadata.tables[name] for name in LOADERS]),
+                 workers)
+
 #  ??????????? USE TEST DB, OR DO I NEED THE BELOW FOR ALL INT PKs? ?????????????
 #
 # def set_val_user_id():
@@ -505,29 +622,25 @@ def load_sheet_owners():
 #     db.session.commit()
 
 if __name__ == "__main__":
-    connect_to_db(app)
+    parser = argparse.ArgumentParser(description="Seed the music database.")
+    parser.add_argument("--bulk", action="store_true",
+                        help="load with COPY / executemany (see bulk_seed.py)")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help="where the data files are (default %(default)s)")
+    parser.add_argument("--db", default='postgres:///music',
+                        help="database URI (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="tables loaded at once (default %(default)s)")
+    args = parser.parse_args()
+
+    DATA_DIR = args.data_dir
+
+    connect_to_db(app, args.db)
     db.create_all()
 
-    load_users()
-    load_groups()
-    load_owners()
-    load_performers()
-    load_instruments()
-    load_performer_instruments()
-    load_performer_groups()
-    load_providers()
-    load_pieces()
-    load_sheets()
-    load_audiofiles()
-    load_genres()
-    load_piecegenres()
-    load_concerts()
-    load_concert_sheets()
-    load_group_sheets()
-    load_events()
-    load_assignments()
-    load_event_assignments()
-    load_sheet_providers()
-    load_sheet_owners()
+    if args.bulk:
+        bulk_seed.bulk_load(args.data_dir, workers=args.workers)
+    else:
+        load_all(args.workers)
 
     # set_val_user_id()
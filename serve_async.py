@@ -0,0 +1,66 @@
+"""Runs the app on gevent, so requests waiting on cpdl.org don't block.
+
+Under "python server.py" (or any threaded/forked WSGI server) a search that
+goes to CPDL parks a whole worker until cpdl.org answers, so a slow cpdl.org
+soon has every worker waiting and the site stops responding. Here each request
+is a greenlet instead: sockets (requests' included) are patched to yield while
+they wait, so one process serves many searches at once, and the CPDL calls
+among them are capped and timed out by cpdl.py (CPDL_MAX_CONCURRENT,
+CPDL_QUEUE_TIMEOUT, CPDL_CONNECT_TIMEOUT / CPDL_READ_TIMEOUT).
+
+    python serve_async.py --port 5000
+    CPDL_API=http://localhost:8001/api.php python serve_async.py
+
+Needs gevent (and psycogreen, so PostgreSQL queries yield too)."""
+
+# Must happen before anything else imports socket, threading, etc.
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    patch_psycopg = None
+
+from model import connect_to_db
+from genre_cache import genre_cache
+from server import app
+
+# Defaults for the command line options.
+HOST = "0.0.0.0"
+PORT = 5000
+MAX_CONNECTIONS = 1000      # requests served at once
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Quirify on gevent.")
+    parser.add_argument("--host", default=HOST,
+                        help="interface to listen on (default %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port to listen on (default %(default)s)")
+    parser.add_argument("--connections", type=int, default=MAX_CONNECTIONS,
+                        help="requests served at once (default %(default)s)")
+    args = parser.parse_args()
+
+    if patch_psycopg:
+        patch_psycopg()
+    else:
+        print "psycogreen isn't installed - database queries will block."
+
+    app.debug = False
+
+    connect_to_db(app)
+
+    # Warm the genre dictionary used when ingesting CPDL pages.
+    genre_cache.load()
+
+    server = WSGIServer((args.host, args.port), app,
+                        spawn=Pool(args.connections))
+
+    print "Serving on http://{}:{}/".format(args.host, args.port)
+    server.serve_forever()
@@ -2,7 +2,8 @@
 
 from jinja2 import StrictUndefined
 
-from flask import Flask, render_template, request, flash, redirect, session, jsonify
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   jsonify, url_for)
 from flask_debugtoolbar import DebugToolbarExtension
 
 from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
@@ -12,13 +13,29 @@ from model import (User, Concert, Event, Instrument, Owner, Group, Performer,
                    UserPiece, UserSheet, UserAudioFile, SheetMusicOwner,
                    connect_to_db, db)
 
-from helper_functions import (parse_search_results, parse_page_results,
+from helper_functions import (parse_page_results,
                               add_piece_to_library, del_piece_from_library,
                               add_sheet_to_library, del_sheet_from_library,
                               add_audiofile_to_library,
-                              del_audiofile_from_library)
+                              del_audiofile_from_library, change_library,
+                              ingest_page)
+
+from cpdl import get_cpdl_json, CPDLUnavailable
+from cpdl_cache import response_cache
+from genre_cache import genre_cache
+from library_membership import current_library
+from query_profiles import (PIECE_PAGE, SHEET_PAGE, CONCERT_PAGE,
+                            CONCERT_PAGE_SHEETS, GROUP_PAGE,
+                            PERFORMER_PAGE_GROUPS, PERFORMER_PAGE_INSTRUMENTS)
+from dashboard import (groups_page, performers_page, dashboard_counts,
+                       recent_library)
+from local_search import search_pieces
+from cpdl_search import cpdl_results, results_page
+from autocomplete import autocomplete_index, SUGGESTIONS, MAX_SUGGESTIONS
+from import_queue import enqueue_import, import_status, IMPORT_IN_BACKGROUND
+from library_pages import (library_page, KINDS as LIBRARY_KINDS,
+                           SORTS as LIBRARY_SORTS)
 
-import requests
 # To get text from CPDL pages, need Beautiful Soup!!
 # from bs4 import BeautifulSoup
 # # For Beautiful Soup, need lxml's html
@@ -62,6 +79,13 @@ def mins_secs(seconds):
 app.jinja_env.filters['mins_secs'] = mins_secs
 
 
+# Every template gets the session user's library ids as `library`, loaded
+# (at most) once per request - for the Add / Remove from Library buttons.
+@app.context_processor
+def inject_library():
+    return {'library': current_library()}
+
+
 ############# HOMEPAGE & NAVBAR ROUTES #################
 @app.route('/')
 def index():
@@ -172,48 +196,121 @@ def search_cpdl():
 
     value = request.args.get("search")
 
-    payload = {'gsrsearch': value}
+    # Look in our own pieces first (unless asked to search CPDL) - only go to
+    # CPDL if we have nothing.
+    if not request.args.get("remote"):
+        local_results = search_pieces(value,
+                                      voicing=request.args.get("voicing"),
+                                      language=request.args.get("language"),
+                                      genre=request.args.get("genre"))
+
+        if local_results:
+            return render_template("search_result.html",
+                                   search=value,
+                                   local_results=local_results,
+                                   results=[])
+
+    try:
+        results = cpdl_results(value)
+    except CPDLUnavailable:
+        flash("CPDL isn't responding right now, please try again shortly.")
+        return render_template("homepage.html")
 
-    r1 = requests.get('http://www1.cpdl.org/wiki/api.php?action=query&format=json&prop=info&generator=search&gsrlimit=max', params=payload)
+    if not results:
+        flash("No results found for that search, try again.")
+        return render_template("homepage.html")
 
-    # print "THIS IS THE JSON: " + str(r1.json())
+    try:
+        page = int(request.args.get("page", 1))
+    except ValueError:
+        page = 1
 
-    if str(r1.json()) != "{u'limits': {u'search': 50}}":
-        results = r1.json()
+    hits, page, pages = results_page(results, page,
+                                     user_id=session.get("user_id"))
 
-        results = parse_search_results(results)
+    return render_template("search_result.html",
+                           search=value,
+                           local_results=[],
+                           results=hits,
+                           page=page,
+                           pages=pages)
 
-        results.sort(key=lambda x: x[1])
 
-        return render_template("search_result.html", results=results)
-    else:
-        flash("No results found for that search, try again.")
+@app.route("/autocomplete.json")
+def autocomplete():
+    """Suggested composers, titles and genres for what's been typed (?q=) in
+       the search box - from memory, never CPDL."""
 
-        return render_template("homepage.html")
+    try:
+        k = min(int(request.args.get("k", SUGGESTIONS)), MAX_SUGGESTIONS)
+    except ValueError:
+        k = SUGGESTIONS
+
+    return jsonify({"suggestions": autocomplete_index.suggest(request.args.get("q"), k)})
 
 
 @app.route("/page_search")
 def search_cpdl_page():
     """Search CPDL.org choralwiki for a specific PIECE's page."""
 
-    page_id = request.args.get("page_id")
+    try:
+        page_id = int(request.args.get("page_id"))
+    except (TypeError, ValueError):
+        flash("That isn't a CPDL page.")
+        return redirect("/")
+
+    piece = db.session.query(Piece.piece_id).filter_by(page_id=page_id).first()
+
+    if piece:
+        return redirect("/pieces/%s" % piece.piece_id)
+
+    # New to us: the import workers fetch & add it while the user watches the
+    # importing page.
+    if IMPORT_IN_BACKGROUND:
+        enqueue_import(page_id)
+        return redirect(url_for("importing", page_id=page_id,
+                                title=request.args.get("title")))
+
+    # Fetched & added once, however many people follow the same link at once.
+    try:
+        piece_id = ingest_page(page_id)
+    except CPDLUnavailable:
+        flash("CPDL isn't responding right now, please try again shortly.")
+        return redirect("/")
+
+    return redirect("/pieces/%s" % piece_id)
 
-    piece = Piece.query.filter_by(page_id=page_id).first()
 
-    if not piece:
-        payload = {'pageid': page_id}
+@app.route("/importing/<int:page_id>")
+def importing(page_id):
+    """Page shown while a CPDL page is imported in the background - polls
+       /importing/<page_id>.json and moves on to the piece when it's in."""
 
-        # cpdl_search = 'http://www1.cpdl.org/wiki/api.php?action=parse&format=json&pageid=3788'
+    status = import_status(page_id)
 
-        r1 = requests.get('http://www1.cpdl.org/wiki/api.php?action=parse&format=json', params=payload)
+    if status is None:
+        return redirect("/page_search?page_id=%s" % page_id)
 
-        results = r1.json()
+    if status['status'] == 'done':
+        return redirect("/pieces/%s" % status['piece_id'])
 
-        piece_id = parse_page_results(results, page_id)
+    return render_template("importing.html",
+                           page_id=page_id,
+                           title=request.args.get("title"),
+                           status=status)
 
-        piece = Piece.query.filter_by(piece_id=piece_id).first()
 
-    return redirect("/pieces/%s" % piece.piece_id)
+@app.route("/importing/<int:page_id>.json")
+def importing_status(page_id):
+    """The background import's status, piece_id (once it's done) and error
+       (if it failed)."""
+
+    status = import_status(page_id)
+
+    if status is None:
+        return jsonify({"message": "That page isn't being imported."}), 404
+
+    return jsonify(status)
 
 
 @app.route("/library")
@@ -222,17 +319,44 @@ def library():
 
     user = session.get("user_id")
 
-    userpieces = UserPiece.query.filter_by(user_id=user).all()
+    sort = request.args.get("sort", "title")
+
+    if sort not in LIBRARY_SORTS:
+        sort = "title"
 
-    usersheets = UserSheet.query.filter_by(user_id=user).all()
+    # The first page of each kind; the rest load from /library.json.
+    pages = {}
 
-    userfiles = UserAudioFile.query.filter_by(user_id=user).all()
+    for kind in LIBRARY_KINDS:
+        pages[kind] = library_page(user, kind, sort)
 
     return render_template("library.html",
                            user=user,
-                           userpieces=userpieces,
-                           usersheets=usersheets,
-                           userfiles=userfiles)
+                           sort=sort,
+                           pages=pages)
+
+
+@app.route("/library.json")
+def library_json():
+    """Next page of the user's pieces, sheets or files (?kind=), sorted by
+       title or composer (?sort=), after the ?after= cursor."""
+
+    try:
+        items, cursor = library_page(session.get("user_id"),
+                                     request.args.get("kind", "pieces"),
+                                     request.args.get("sort", "title"),
+                                     request.args.get("after"))
+    except ValueError:
+        return jsonify({"message": "Bad library request."}), 400
+
+    return jsonify({"items": items, "next": cursor})
+
+
+@app.route("/cache_stats.json")
+def cache_stats():
+    """Show the CPDL response cache's hit/miss counters and saved latency."""
+
+    return jsonify(response_cache.stats())
 
 
 ############## ROUTES TO DISPLAY INDIVIDUAL ITEM PAGE BY ID ####################
@@ -241,13 +365,52 @@ def user_detail(user_id):
     """Show info about user."""
 
     user = User.query.get(user_id)
-    groups = Group.query.all()
-    performers = Performer.query.all()
+
+    # Only the first page of groups & performers - the rest load on request
+    # from the json routes below.
+    groups, groups_next = groups_page(user_id)
+    performers, performers_next = performers_page(user_id)
+    pieces, sheets, files = recent_library(user_id)
 
     return render_template("user.html",
                            user=user,
+                           counts=dashboard_counts(user_id),
+                           pieces=pieces,
+                           sheets=sheets,
+                           files=files,
+                           concerts=(Concert.query.filter_by(user_id=user_id)
+                                                  .order_by(Concert.name)
+                                                  .all()),
                            groups=groups,
-                           performers=performers)
+                           groups_next=groups_next,
+                           performers=performers,
+                           performers_next=performers_next)
+
+
+@app.route("/users/<int:user_id>/groups.json")
+def user_groups(user_id):
+    """Next page of the user's groups, after the ?after= cursor."""
+
+    try:
+        groups, cursor = groups_page(user_id, request.args.get("after"))
+    except ValueError:
+        return jsonify({"message": "Bad cursor."}), 400
+
+    return jsonify({"groups": [group._asdict() for group in groups],
+                    "next": cursor})
+
+
+@app.route("/users/<int:user_id>/performers.json")
+def user_performers(user_id):
+    """Next page of the performers in the user's groups, after the ?after=
+       cursor."""
+
+    try:
+        performers, cursor = performers_page(user_id, request.args.get("after"))
+    except ValueError:
+        return jsonify({"message": "Bad cursor."}), 400
+
+    return jsonify({"performers": performers, "next": cursor})
 
 
 @app.route("/pieces/<int:piece_id>", methods=['GET'])
@@ -255,7 +418,7 @@ def piece_detail(piece_id):
     """Show logged in user info about a piece. allow them to choose a specific
     sheet music version of the piece, if any are available."""
 
-    piece = Piece.query.get(piece_id)
+    piece = Piece.query.options(*PIECE_PAGE).get(piece_id)
 
     return render_template("piece_page.html", piece=piece)
 
@@ -266,7 +429,7 @@ def sheet_detail(sheet_id):
        files. Allow them to assign parts to performers and/or add the sheet
        to a setlist."""
 
-    sheet = SheetMusic.query.get(sheet_id)
+    sheet = SheetMusic.query.options(*SHEET_PAGE).get(sheet_id)
 
     return render_template("sheet_page.html", sheet=sheet)
 
@@ -275,9 +438,11 @@ def sheet_detail(sheet_id):
 def concert_page(concert_id):
     """Show logged in user info about a concert."""
 
-    concert = Concert.query.get(concert_id)
+    concert = Concert.query.options(*CONCERT_PAGE).get(concert_id)
 
-    concert_sheets = ConcertSheet.query.filter_by(concert_id=concert_id).all()
+    concert_sheets = (ConcertSheet.query.options(*CONCERT_PAGE_SHEETS)
+                                        .filter_by(concert_id=concert_id)
+                                        .all())
 
     return render_template("concert_page.html", concert=concert, concert_sheets=concert_sheets)
 
@@ -295,7 +460,7 @@ def event_page(event_id):
 def group_page(group_code):
     """Show logged in user info about a concert."""
 
-    group = Group.query.get(group_code)
+    group = Group.query.options(*GROUP_PAGE).get(group_code)
 
     perfs = PerformerGroup.query.filter_by(group_code=group_code).all()
 
@@ -309,9 +474,13 @@ def performer_page(performer_id):
     performer = Performer.query.get(performer_id)
     print performer
 
-    perfgrps = PerformerGroup.query.filter_by(performer_id=performer_id).all()
+    perfgrps = (PerformerGroup.query.options(*PERFORMER_PAGE_GROUPS)
+                                    .filter_by(performer_id=performer_id)
+                                    .all())
 
-    perfinsts = PerformerInstrument.query.filter_by(performer_id=performer_id).all()
+    perfinsts = (PerformerInstrument.query.options(*PERFORMER_PAGE_INSTRUMENTS)
+                                          .filter_by(performer_id=performer_id)
+                                          .all())
 
     return render_template("performer_page.html", performer=performer,
                            perfgrps=perfgrps, perfinsts=perfinsts)
@@ -476,6 +645,51 @@ def del_uaudiofile():
 
     return jsonify(result)
 
+
+# Most changes one batch may hold.
+MAX_LIBRARY_CHANGES = 500
+
+
+@app.route("/library_changes.json", methods=['POST'])
+def library_changes():
+    """Adding and/or removing many pieces, sheets and files at once. Takes a
+       json body of {"changes": [{"op": "add"|"del", "kind": "piece"|"sheet"|
+       "file", "id": 123}, ...]}, applied in one transaction."""
+
+    user_id = session.get("user_id")
+
+    if user_id is None:
+        return jsonify({"message": "Log in to change your library."}), 401
+
+    body = request.get_json(silent=True)
+
+    # (Valid json needn't be an object - [] or "x" have no "changes".)
+    changes = body.get("changes") if isinstance(body, dict) else None
+
+    if not isinstance(changes, list) or len(changes) > MAX_LIBRARY_CHANGES:
+        return jsonify({"message": "Bad library changes."}), 400
+
+    try:
+        counts = change_library(user_id, changes)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    added = sum(n for (op, kind), n in counts.items() if op == 'add')
+    removed = sum(n for (op, kind), n in counts.items() if op == 'del')
+
+    messages = []
+
+    if added:
+        messages.append("{} item(s) added to your library.".format(added))
+    if removed:
+        messages.append("{} item(s) removed from your library.".format(removed))
+
+    result = {"message": " ".join(messages) or "Your library is up to date.",
+              "added": added,
+              "removed": removed}
+
+    return jsonify(result)
+
 ############ DUNDER MAIN STUFF ##############################################
 if __name__ == "__main__":
     # We have to set debug=True here, since it has to be True at the point
@@ -486,6 +700,9 @@ if __name__ == "__main__":
 
     connect_to_db(app)
 
+    # Warm the genre dictionary used when ingesting CPDL pages.
+    genre_cache.load()
+
     # Use the DebugToolbar
     DebugToolbarExtension(app)
 
@@ -0,0 +1,59 @@
+"""Coalesces concurrent calls for the same key into one.
+
+When a director shares a link to a piece we don't have yet, dozens of singers
+hit /page_search for the same page at once. Within a process, SingleFlight
+lets the first of them (the leader) do the work while the rest wait for, and
+share, its result - or its exception. (Across processes, see ingest_page in
+helper_functions.py.)"""
+
+import threading
+
+
+class _Flight(object):
+    """One call in progress, and what it came to."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """key -> the call in flight for it."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """Returns fn(*args), unless a call for key is already in flight, in
+           which case waits for it and returns (or raises) what it did."""
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+
+            if flight.error:
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = fn(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Later callers start a new flight (and see what this one wrote).
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result
+
@@ -1,117 +1,181 @@
 "use strict";
 
-// Success function when item added to or deleted from user's library.
-function alertLibraryResult(result, pieceid) {
-    var addSelectorString = "#add-"+pieceid;
-    var delSelectorString = "#del-"+pieceid;
-    var addButton = $(addSelectorString);
-    var delButton = $(delSelectorString);
-    if (addButton.prop("hidden")){
-      addButton.prop("hidden", false);
-    }else{
-      addButton.prop("hidden", true);
-    }
+// Library buttons for each kind of item: their class suffix ("add_usheet",
+// "del_usheet") and the data attribute holding the item's id.
+var libraryButtons = {"piece": ["upiece", "pieceid"],
+                      "sheet": ["usheet", "sheetid"],
+                      "file": ["ufile", "fileid"]};
+
+
+// Sends a batch of library changes - [{"op": "add"|"del", "kind": "piece"|
+// "sheet"|"file", "id": 123}, ...] - in one request, then flips the Add /
+// Remove buttons of every item changed.
+function changeLibrary(changes) {
+    $.ajax({url: "/library_changes.json",
+            type: "POST",
+            contentType: "application/json",
+            data: JSON.stringify({"changes": changes}),
+            success: function(result) {
+              $.each(changes, function(i, change) {
+                  var names = libraryButtons[change.kind];
+                  var selector = "[data-" + names[1] + "='" + change.id + "']";
+                  $(".add_" + names[0] + selector).prop("hidden", change.op === "add");
+                  $(".del_" + names[0] + selector).prop("hidden", change.op === "del");
+              });
+              alert(result.message);
+            }});
+}
 
-    if (delButton.prop("hidden")){
-      delButton.prop("hidden", false);
 
-    }else{
-      delButton.prop("hidden", true);
-      
-    }
-
-    alert(result.message);
+// event listener & handler for the Add / Remove from Library buttons.
+function libraryButtonClicked(kind) {
+    return function (evt) {
+        var button = $(evt.currentTarget);
+        var names = libraryButtons[kind];
+        var op = button.hasClass("add_" + names[0]) ? "add" : "del";
 
+        changeLibrary([{"op": op, "kind": kind, "id": button.data(names[1])}]);
+    };
 }
 
+$(".add_upiece, .del_upiece").on("click", libraryButtonClicked("piece"));
+$(".add_usheet, .del_usheet").on("click", libraryButtonClicked("sheet"));
+$(".add_ufile, .del_ufile").on("click", libraryButtonClicked("file"));
+
 
-// event listener & handler to delete Piece from UserPiece library.
-$(".del_upiece").on("click", function (evt) {
-    var formInput = {"piece_id": $(evt.currentTarget).data("pieceid")};
+// event listener & handler to add a sheet and all of its files at once.
+$(".add_usheet_files").on("click", function (evt) {
+    var changes = [{"op": "add", "kind": "sheet",
+                    "id": $(evt.currentTarget).data("sheetid")}];
 
-    console.log(evt.currentTarget);
-    console.log(formInput);
+    $(".add_ufile").each(function(i, button) {
+        changes.push({"op": "add", "kind": "file", "id": $(button).data("fileid")});
+    });
 
-    $.post("/del_upiece.json",
-           formInput,
-           function(evt) {
-           alertLibraryResult(evt, formInput.piece_id);
-           });
+    changeLibrary(changes);
 });
 
-// event listener & handler to add Piece to UserPiece library.
-$(".add_upiece").on("click", function (evt) {
 
-    var formInput = {"piece_id": $(evt.currentTarget).data("pieceid")};
+// event listener & handler to add every sheet in a concert's program.
+$(".add_program").on("click", function (evt) {
+    var changes = [];
 
-    // console.log(evt.currentTarget);
-    // console.log(formInput);
+    $(".program_sheet").each(function(i, row) {
+        changes.push({"op": "add", "kind": "sheet", "id": $(row).data("sheetid")});
+    });
 
-    $.post("/add_upiece.json",
-           formInput,
-           function(evt) {
-           alertLibraryResult(evt, formInput.piece_id);
-           });
+    changeLibrary(changes);
 });
 
 
-// event listener & handler to delete Sheet from UserSheet library.
-$(".del_usheet").on("click", function (evt) {
-    var formInput = {"sheet_id": $(evt.currentTarget).data("sheetid")};
+// Dashboard: loads the next page of groups / performers from the button's
+// data-url, after its data-next cursor, and appends them to the list.
+function loadMore(button, listSelector, key, makeItem) {
+    $.get(button.data("url"),
+          // attr, not data() - data() would parse the json cursor.
+          {"after": button.attr("data-next")},
+          function(result) {
+            var list = $(listSelector);
+            $.each(result[key], function(i, item) {
+                list.append(makeItem(item));
+            });
+            // null cursor = that was the last page.
+            button.attr("data-next", result.next || "");
+            button.prop("hidden", !result.next);
+          });
+}
 
-    console.log(evt.currentTarget);
-    console.log(formInput);
+$(".more-groups").on("click", function (evt) {
+    loadMore($(evt.currentTarget), "#user-groups", "groups", function(group) {
+        var link = $("<a>").attr("href", "/groups/" + group.group_code)
+                           .text(group.name);
+        return $("<li>").append(link, " ",
+                                $("<i class='smalltxt'>").text(group.members + " members"));
+    });
+});
 
-    $.post("/del_usheet.json",
-           formInput,
-           function(evt) {
-           alertLibraryResult(evt, formInput.sheet_id);
-           });
+$(".more-performers").on("click", function (evt) {
+    loadMore($(evt.currentTarget), "#user-performers", "performers", function(performer) {
+        var link = $("<a>").attr("href", "/performers/" + performer.performer_id)
+                           .text(performer.fname + " " + performer.lname);
+        var item = $("<li>").append(link, " ");
+        if (performer.instruments.length) {
+            item.append($("<i class='smalltxt'>").text("Parts: " + performer.instruments.join(" ")));
+        }
+        return item;
+    });
 });
 
-// event listener & handler to add Sheet to UserSheet library.
-$(".add_usheet").on("click", function (evt) {
+// Library: each kind of item, as a list item.
+var libraryItems = {
+    "pieces": function(piece) {
+        return $("<li>").append($("<a>").attr("href", "/pieces/" + piece.piece_id)
+                                        .text(piece.title + " (" + piece.composer + ")"));
+    },
+    "sheets": function(sheet) {
+        return $("<li>").append($("<a>").attr("href", "/sheets/" + sheet.sheet_id)
+                                        .text(sheet.title + " (" + sheet.composer + ")"),
+                                " ",
+                                $("<a>").attr("href", sheet.music_url)
+                                        .append($("<i class='smalltxt'>").text(sheet.edition_notes)));
+    },
+    "files": function(file) {
+        return $("<li>").append($("<a>").attr("href", file.url)
+                                        .text(file.title + " (" + file.composer + "), " + file.file_type));
+    }
+};
 
-    var formInput = {"sheet_id": $(evt.currentTarget).data("sheetid")};
+$(".more-library").on("click", function (evt) {
+    var button = $(evt.currentTarget);
+    var kind = button.data("kind");
+    loadMore(button, "#library-" + kind, "items", libraryItems[kind]);
+});
 
-    // console.log(evt.currentTarget);
-    // console.log(formInput);
 
-    $.post("/add_usheet.json",
-           formInput,
-           function(evt) {
-           alertLibraryResult(evt, formInput.sheet_id);
-           });
-});
+// Search box type-ahead: asks /autocomplete.json for suggestions once the
+// user pauses typing, and offers them in the box's datalist.
+var suggestTimer = null;
+
+$(".search-box").on("input", function (evt) {
+    var box = $(evt.currentTarget);
 
-// event listener & handler to delete audiofile from UserAudioFile library.
-$(".del_ufile").on("click", function (evt) {
-    var formInput = {"file_id": $(evt.currentTarget).data("fileid")};
+    clearTimeout(suggestTimer);
 
-    console.log(evt.currentTarget);
-    console.log(formInput);
+    suggestTimer = setTimeout(function() {
+        if (box.val().length < 2) {
+            return;
+        }
 
-    $.post("/del_uaudiofile.json",
-           formInput,
-           function(evt) {
-           alertLibraryResult(evt, formInput.file_id);
-           });
+        $.get("/autocomplete.json", {"q": box.val()}, function(result) {
+            var list = $("#" + box.attr("list")).empty();
+
+            $.each(result.suggestions, function(i, suggestion) {
+                list.append($("<option>").attr("value", suggestion.text)
+                                         .attr("label", suggestion.kind));
+            });
+        });
+    }, 150);
 });
 
-// event listener & handler to add file to UserAudioFile library.
-$(".add_ufile").on("click", function (evt) {
-    
-    console.log(evt.currentTarget);
-    console.log(formInput);
-    
-    var formInput = {"file_id": $(evt.currentTarget).data("fileid")};
-
-    // console.log(evt.currentTarget);
-    // console.log(formInput);
-
-    $.post("/add_uaudiofile.json",
-           formInput,
-           function(evt) {
-           alertLibraryResult(evt, formInput.file_id);
-           });
-});
\ No newline at end of file
+
+// Importing page: checks on the background import every second, and opens
+// the piece once it's in.
+function checkImport(status) {
+    $.get(status.data("url"), function(result) {
+        if (result.status === "done") {
+            window.location = "/pieces/" + result.piece_id;
+        } else if (result.status === "failed") {
+            status.find(".import-error").text(result.error || "");
+            status.find(".import-pending").prop("hidden", true);
+            status.find(".import-failed").prop("hidden", false);
+        } else {
+            setTimeout(function() { checkImport(status); }, 1000);
+        }
+    });
+}
+
+$(".import-status").each(function(i, status) {
+    if (!$(status).find(".import-pending").prop("hidden")) {
+        checkImport($(status));
+    }
+});
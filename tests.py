@@ -0,0 +1,221 @@
+"""Tests for Quirify. Nothing here needs PostgreSQL or cpdl.org:
+
+    python tests.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+
+import cpdl_search
+
+
+class CPDLSearchCacheTests(unittest.TestCase):
+    """Which CPDL search responses cpdl_results keeps in the search cache."""
+
+    def setUp(self):
+        cpdl_search.search_cache.clear()
+
+        # Stands in for CPDL: answers each search with the next response.
+        self.responses = []
+        self.calls = 0
+
+        def get_cpdl_json(params, use_cache=True):
+            self.calls += 1
+            return self.responses.pop(0)
+
+        self._get_cpdl_json = cpdl_search.get_cpdl_json
+        cpdl_search.get_cpdl_json = get_cpdl_json
+
+    def tearDown(self):
+        cpdl_search.get_cpdl_json = self._get_cpdl_json
+        cpdl_search.search_cache.clear()
+
+    def test_hits_are_cached(self):
+        self.responses = [{'batchcomplete': '',
+                           'query': {'pages': {'3788': {'title': 'Ave verum'}}}}]
+
+        self.assertEqual(cpdl_search.cpdl_results("Byrd"),
+                         (cpdl_search.CPDLResult(3788, 'Ave verum'),))
+        self.assertEqual(cpdl_search.cpdl_results(" byrd "),
+                         (cpdl_search.CPDLResult(3788, 'Ave verum'),))
+        self.assertEqual(self.calls, 1)
+
+    def test_nothing_found_is_cached(self):
+        self.responses = [{'batchcomplete': ''}]
+
+        self.assertEqual(cpdl_search.cpdl_results("zzyzx"), ())
+        self.assertEqual(cpdl_search.cpdl_results("zzyzx"), ())
+        self.assertEqual(self.calls, 1)
+
+    def test_error_is_not_cached(self):
+        self.responses = [{'error': {'code': 'internal_api_error_DBQueryError',
+                                     'info': 'Database query error'}},
+                          {'batchcomplete': '',
+                           'query': {'pages': {'3788': {'title': 'Ave verum'}}}}]
+
+        self.assertEqual(cpdl_search.cpdl_results("Byrd"), ())
+        self.assertIsNone(cpdl_search.search_cache.get("Byrd"))
+
+        # The next search asks CPDL again, and gets the real answer.
+        self.assertEqual(cpdl_search.cpdl_results("Byrd"),
+                         (cpdl_search.CPDLResult(3788, 'Ave verum'),))
+        self.assertEqual(self.calls, 2)
+
+
+############ QUERIES PER DETAIL PAGE #########################################
+
+# Related rows hung off each detail page's object in the small and the big
+# world - a page should take the same number of queries in both.
+SMALL = 1
+BIG = 20
+
+
+def make_world(n):
+    """Adds a user, piece, sheet, concert, group and performer, each with n
+       of everything its detail page shows, and returns the URL of each
+       page (and the user's id) as a dict."""
+
+    from model import (User, Piece, SheetMusic, AudioFile, Genre, PieceGenre,
+                       Owner, SheetMusicOwner, Provider, SheetMusicProvider,
+                       Concert, Event, ConcertSheet, Group, GroupSheet,
+                       Performer, PerformerGroup, Instrument,
+                       PerformerInstrument, Assignment, UserPiece, UserSheet,
+                       UserAudioFile, db)
+
+    def named(what, i=0):
+        return "{} {}-{}".format(what, n, i)
+
+    user = User(fname=named("First"), lname=named("Last"), password="pw",
+                email="user{}@example.com".format(n))
+    piece = Piece(title=named("Piece"), composer=named("Composer"),
+                  page_id=n)
+    sheet = SheetMusic(piece=piece, edition_notes=named("Notes"))
+    group = Group(group_code=named("G"), name=named("Group"),
+                  start_date=date(2000, 1, 1))
+    performer = Performer(fname=named("First"), lname=named("Last"),
+                          start_date=date(2000, 1, 1))
+    concert = Concert(user=user, name=named("Concert"))
+
+    db.session.add_all([user, piece, sheet, group, performer, concert])
+
+    for i in range(n):
+        # The piece's genres and sheets.
+        db.session.add(PieceGenre(piece=piece, genre=Genre(name=named("Genre", i))))
+        other_sheet = SheetMusic(piece=piece, edition_notes=named("Notes", i))
+
+        # The sheet's owners, providers and files.
+        db.session.add(SheetMusicOwner(sheet=sheet, owner=Owner(name=named("Owner", i))))
+        db.session.add(SheetMusicProvider(sheet=sheet,
+                                          provider=Provider(name=named("Provider", i))))
+        audiofile = AudioFile(sheet=sheet, file_type="mid",
+                              url="http://localhost/{}.mid".format(named("f", i)))
+
+        # The user's library.
+        db.session.add_all([UserPiece(user=user, piece=Piece(title=named("Mine", i),
+                                                             composer=named("C", i))),
+                            UserSheet(user=user, sheet=other_sheet),
+                            UserAudioFile(user=user, audiofile=audiofile)])
+
+        # The concert's events, and its sheets - each sung by the group, with
+        # the performer assigned.
+        db.session.add(Event(concert=concert, name=named("Event", i),
+                             start_day_time=datetime(2020, 1, 1, 19)))
+        concert_sheet = ConcertSheet(concert=concert,
+                                     sheet=SheetMusic(piece=Piece(title=named("Sung", i),
+                                                                  composer=named("C", i)),
+                                                      edition_notes=named("Notes", i),
+                                                      duration=180))
+        db.session.add(GroupSheet(group=group, concert_sheet=concert_sheet))
+
+        # The performer's groups and instruments (and a part in each sheet).
+        db.session.add(PerformerGroup(performer=performer,
+                                      group=Group(group_code=named("PG", i),
+                                                  name=named("Group", i),
+                                                  start_date=date(2000, 1, 1))))
+        db.session.add(PerformerGroup(performer=Performer(fname=named("F", i),
+                                                          lname=named("L", i),
+                                                          start_date=date(2000, 1, 1)),
+                                      group=group))
+        performer_instrument = PerformerInstrument(
+            performer=performer,
+            instrument=Instrument(instrument_code=named("I", i),
+                                  name=named("Instrument", i)))
+        db.session.add(Assignment(concert_sheet=concert_sheet,
+                                  performer_instrument=performer_instrument))
+
+    db.session.commit()
+
+    return {"user_id": user.user_id,
+            "/users/{}": "/users/{}".format(user.user_id),
+            "/pieces/{}": "/pieces/{}".format(piece.piece_id),
+            "/sheets/{}": "/sheets/{}".format(sheet.sheet_id),
+            "/concerts/{}": "/concerts/{}".format(concert.concert_id),
+            "/groups/{}": "/groups/{}".format(group.group_code),
+            "/performers/{}": "/performers/{}".format(performer.performer_id)}
+
+
+class QueryCountTests(unittest.TestCase):
+    """Each detail page's queries: no more than its QUERY_LIMITS, and no more
+       with BIG related rows than with SMALL ones."""
+
+    @classmethod
+    def setUpClass(cls):
+        from model import connect_to_db, db
+        from server import app
+
+        cls.work_dir = tempfile.mkdtemp(prefix="quirify_tests_")
+        connect_to_db(app, "sqlite:///" + os.path.join(cls.work_dir, "tests.db"))
+        app.config['TESTING'] = True
+
+        db.create_all()
+        cls.worlds = dict((n, make_world(n)) for n in (SMALL, BIG))
+        cls.app = app
+
+    @classmethod
+    def tearDownClass(cls):
+        from model import db
+
+        db.session.remove()
+        shutil.rmtree(cls.work_dir)
+
+    def page_queries(self, world, route):
+        """Returns (status code, queries) for one page, logged in as the
+           world's user, in a fresh session like a real request."""
+
+        from model import db
+        from query_profiles import count_queries
+
+        client = self.app.test_client()
+
+        with client.session_transaction() as sess:
+            sess["user_id"] = world["user_id"]
+
+        db.session.remove()
+
+        with count_queries() as queries:
+            response = client.get(world[route])
+
+        return response.status_code, queries[0]
+
+    def test_query_counts(self):
+        from query_profiles import QUERY_LIMITS
+
+        for route, limit in sorted(QUERY_LIMITS.items()):
+            small = self.page_queries(self.worlds[SMALL], route)
+            big = self.page_queries(self.worlds[BIG], route)
+
+            self.assertEqual(small[0], 200, route)
+            self.assertEqual(big[0], 200, route)
+            self.assertEqual(small[1], big[1],
+                             "{}: {} queries with {} related rows, {} with {}"
+                             .format(route, small[1], SMALL, big[1], BIG))
+            self.assertLessEqual(big[1], limit,
+                                 "{}: {} queries, limit {}".format(route, big[1],
+                                                                   limit))
+
+
+if __name__ == "__main__":
+    unittest.main()